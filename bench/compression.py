@@ -0,0 +1,101 @@
+"""
+Egress bandwidth saved by compressed deliveries against the CPU they cost.
+
+Builds JSON and binary deliveries of chat-like text (words of the compression samples in
+random order, plus some random tokens such as links and ids) at several message sizes and
+measures, per delivery:
+
+- the delivery size plain, with raw DEFLATE, and with the preset dictionary (compression.py)
+- the time to compress it once (what the server pays per broadcast and format) and to
+  decompress it (what every client pays)
+- the egress saved by one broadcast to a room of --room-size members, and those bytes per
+  microsecond of server CPU
+
+Usage:
+    python bench/compression.py
+    python bench/compression.py --sizes 256 1024 4000 --room-size 50 --output compression.json
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, SRC_DIR)
+
+import compression
+import protocol
+
+def chat_text(rng, size):
+    # Words of the dictionary's samples with a random token now and then, cut at size bytes.
+    words = " ".join(compression._CHAT_SAMPLES).split(" ")
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(words) if rng.random() > 0.1 else f"https://example.com/{rng.getrandbits(40):x}"
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)[:size]
+
+def timed(function, argument, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = function(argument)
+    return result, (time.perf_counter() - started) / repeat * 1e6
+
+def plain_deflate(data):
+    compressor = zlib.compressobj(compression.LEVEL, zlib.DEFLATED, compression.WBITS, compression.MEM_LEVEL)
+    return compressor.compress(data) + compressor.flush()
+
+def measure(rng, size, wire_format, room_size, repeat):
+    text = chat_text(rng, size)
+    if wire_format == "binary":
+        datagram = protocol.encode_message("alice", text.encode('utf-8'))
+    else:
+        datagram = json.dumps({"status": "success", "sender": "alice", "message": text}).encode('utf-8')
+    wrapped, compress_us = timed(compression.wrap, datagram, repeat)
+    _, decompress_us = timed(compression.unwrap, wrapped, repeat) if wrapped is not datagram else (None, 0.0)
+    saved = (len(datagram) - len(wrapped)) * room_size
+    return {
+        "message_size": size,
+        "format": wire_format,
+        "bytes": len(datagram),
+        "deflate_bytes": len(plain_deflate(datagram)) + protocol.COMPRESSED_HEADER.size,
+        "compressed_bytes": len(wrapped),
+        "ratio": round(len(wrapped) / len(datagram), 3),
+        "compress_us": round(compress_us, 2),
+        "decompress_us": round(decompress_us, 2),
+        "egress_saved_per_broadcast": saved,
+        "saved_bytes_per_cpu_us": round(saved / compress_us, 1) if compress_us and saved else 0,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compressed delivery bandwidth/CPU benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 256, 512, 1024, 2048, 4000],
+                        help="message sizes in bytes")
+    parser.add_argument("--room-size", type=int, default=10, help="members receiving each broadcast")
+    parser.add_argument("--repeat", type=int, default=2000, help="timed repetitions per measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    rng = random.Random(args.seed)
+    results = [measure(rng, size, wire_format, args.room_size, args.repeat)
+               for size in args.sizes for wire_format in ("json", "binary")]
+    result = json.dumps({"config": {"room_size": args.room_size, "threshold": compression.THRESHOLD,
+                                    "level": compression.LEVEL, "dictionary_bytes": len(compression.DICTIONARY)},
+                         "timestamp": time.time(), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    else:
+        print(result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Load generator and latency benchmark for the Online Chat Messenger server.
+
+Checks the non-functional requirement of requirement/requirements.md
+(10,000 packets/s, 500 rooms x 10 users, 2 messages/s per user) against a server
+launched locally from src/server.py.
+
+Every simulated user is an aio_client.ChatClient, the library the CLI client is built on,
+and all of them run on one asyncio event loop: each creates or joins its room over TCP,
+gets its own UDP socket, registers its endpoint and sends messages at a fixed rate. Each
+message carries its send time, so every delivery back to a room member gives one fan-out
+latency sample.
+
+The report is one JSON object (stdout, or --output) with the configuration, send rate,
+delivered rate, loss and p50/p99/p999 latency, so runs can be compared between versions.
+
+Usage:
+    python bench/loadgen.py                       # requirement profile, threaded engine
+    python bench/loadgen.py --engine asyncio --rooms 50 --duration 5
+    python bench/loadgen.py --protocol json --output bench_output.json
+    python bench/loadgen.py --message-size 2000 --no-compression   # egress without compression
+    python bench/loadgen.py --no-launch --tcp-port 5001 --udp-port 6001
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, SRC_DIR)
+
+from aio_client import ChatClient
+
+MESSAGE_PREFIX = "bench:"
+
+class BenchStats:
+
+    def __init__(self):
+        self.sent = 0
+        self.bytes_sent = 0
+        self.expected = 0
+        self.delivered = 0
+        # datagrams received; fewer than delivered when the server coalesces (--coalesce-window)
+        self.datagrams = 0
+        # UDP bytes received by all users, i.e. the server's egress
+        self.bytes_received = 0
+        self.latencies = []
+
+    def record(self, latency):
+        self.delivered += 1
+        self.latencies.append(latency)
+
+class BenchUser:
+    # One simulated chat member: a ChatClient whose deliveries are latency samples.
+
+    def __init__(self, stats, args, room_size):
+        self.stats = stats
+        self.room_size = room_size
+        # one-shot TCP requests and no heartbeats, so a user only costs its UDP socket
+        self.chat = ChatClient("127.0.0.1", args.tcp_port, args.udp_port, args.protocol, control_session=False,
+                               on_message=self.on_message, heartbeat_interval=0,
+                               compression=not args.no_compression)
+
+    def on_message(self, response):
+        message = response.get("message")
+        if message and message.startswith(MESSAGE_PREFIX):
+            sent_at = float(message[len(MESSAGE_PREFIX):].split(" ", 1)[0])
+            self.stats.record(time.perf_counter() - sent_at)
+
+    def send_message(self, padding):
+        self.stats.bytes_sent += self.chat.send(f"{MESSAGE_PREFIX}{time.perf_counter():.9f} {padding}")
+        self.stats.sent += 1
+        # the server delivers every message to all members, the sender included
+        self.stats.expected += self.room_size
+
+def free_port(kind):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+def launch_server(args):
+    command = [sys.executable, os.path.join(SRC_DIR, "server.py"),
+               "--host", "127.0.0.1", "--tcp-port", str(args.tcp_port), "--udp-port", str(args.udp_port),
+               "--engine", args.engine]
+    if args.workers:
+        command += ["--workers", str(args.workers)]
+    command += args.server_arg
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.tcp_port), timeout=0.2).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+async def setup_rooms(args, stats):
+    # Creates the rooms and joins their members, at most setup_concurrency TCP requests at a
+    # time; every user registers its UDP endpoint as it enters. Returns the users.
+    requests = asyncio.Semaphore(args.setup_concurrency)
+
+    async def enter(user, room_name, username, operation):
+        async with requests:
+            if operation == "create_room":
+                response = await user.chat.create_room(room_name, username)
+            else:
+                response = await user.chat.join_room(room_name, username)
+        if response.get("status") != "success":
+            raise RuntimeError(f"{operation} failed for {room_name}: {response}")
+
+    async def setup_room(index):
+        room_name = f"bench-room-{index}"
+        users = [BenchUser(stats, args, args.users) for _ in range(args.users)]
+        await enter(users[0], room_name, f"user-{index}-0", "create_room")
+        await asyncio.gather(*(enter(user, room_name, f"user-{index}-{user_index}", "join_room")
+                               for user_index, user in enumerate(users) if user_index))
+        return users
+
+    rooms = await asyncio.gather(*(setup_room(index) for index in range(args.rooms)))
+    return [user for users in rooms for user in users]
+
+async def drive(args):
+    stats = BenchStats()
+    users = await setup_rooms(args, stats)
+    await asyncio.sleep(args.settle)
+
+    # Pace sends in small ticks, round-robin over the users, at rate messages/s per user
+    padding = "x" * max(0, args.message_size)
+    total_rate = args.rate * len(users)
+    started = time.perf_counter()
+    next_user = 0
+    while True:
+        elapsed = time.perf_counter() - started
+        if elapsed >= args.duration:
+            break
+        due = int(elapsed * total_rate) - stats.sent
+        for _ in range(due):
+            users[next_user].send_message(padding)
+            next_user = (next_user + 1) % len(users)
+        await asyncio.sleep(args.tick)
+    send_time = time.perf_counter() - started
+
+    await asyncio.sleep(args.drain)
+    for user in users:
+        stats.datagrams += user.chat.datagrams
+        stats.bytes_received += user.chat.bytes_received
+        await user.chat.close()
+    return stats, send_time
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def report(args, stats, send_time):
+    latencies = sorted(stats.latencies)
+
+    def milliseconds(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "config": {
+            "engine": args.engine,
+            "workers": args.workers,
+            "protocol": args.protocol,
+            "rooms": args.rooms,
+            "users_per_room": args.users,
+            "rate_per_user": args.rate,
+            "duration": args.duration,
+            "message_size": args.message_size,
+            "compression": not args.no_compression,
+            "server_args": args.server_arg,
+        },
+        "timestamp": time.time(),
+        "sent": stats.sent,
+        "send_rate": round(stats.sent / send_time, 1) if send_time else 0,
+        "bytes_per_message": round(stats.bytes_sent / stats.sent, 1) if stats.sent else 0,
+        "expected_deliveries": stats.expected,
+        "delivered": stats.delivered,
+        "delivered_rate": round(stats.delivered / send_time, 1) if send_time else 0,
+        "datagram_rate": round(stats.datagrams / send_time, 1) if send_time else 0,
+        "egress_bytes_per_delivery": round(stats.bytes_received / stats.delivered, 1) if stats.delivered else 0,
+        "loss": round(1 - stats.delivered / stats.expected, 6) if stats.expected else 0,
+        "latency_ms": {
+            "p50": milliseconds(percentile(latencies, 0.50)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "p999": milliseconds(percentile(latencies, 0.999)),
+            "max": milliseconds(latencies[-1] if latencies else None),
+        },
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat server load generator")
+    parser.add_argument("--rooms", type=int, default=500)
+    parser.add_argument("--users", type=int, default=10, help="users per room")
+    parser.add_argument("--rate", type=float, default=2.0, help="messages per second per user")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--message-size", type=int, default=32, help="padding bytes per message")
+    parser.add_argument("--protocol", choices=("json", "binary"), default="binary")
+    parser.add_argument("--no-compression", action="store_true", help="do not negotiate compressed deliveries")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="extra argument passed to server.py (repeatable)")
+    parser.add_argument("--no-launch", action="store_true", help="use an already running server")
+    parser.add_argument("--tcp-port", type=int, default=0)
+    parser.add_argument("--udp-port", type=int, default=0)
+    parser.add_argument("--setup-concurrency", type=int, default=16)
+    parser.add_argument("--settle", type=float, default=0.5, help="seconds to wait after registering endpoints")
+    parser.add_argument("--drain", type=float, default=1.0, help="seconds to wait for deliveries after sending")
+    parser.add_argument("--tick", type=float, default=0.005)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.no_launch:
+        args.tcp_port = args.tcp_port or free_port(socket.SOCK_STREAM)
+        args.udp_port = args.udp_port or free_port(socket.SOCK_DGRAM)
+    raise_fd_limit(args.rooms * args.users + 256)
+
+    process = None if args.no_launch else launch_server(args)
+    try:
+        stats, send_time = asyncio.run(drive(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    result = json.dumps(report(args, stats, send_time), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    else:
+        print(result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Delivery benchmark of reliable mode on a lossy network.
+
+Launches a server (see loadgen.py) and puts a lossy UDP proxy between it and the clients:
+every client gets its own upstream socket, so the server still sees one endpoint per
+client, and each datagram is dropped with the given probability in either direction. TCP
+requests go to the server directly. For every loss rate the same chat load runs once with
+plain datagrams and once with reliable=True sessions (see reliable.py), and the report
+compares, per run:
+
+- delivery: unique messages received / messages expected (every member, sender included)
+- duplicates: messages a member received more than once
+- latency p50/p99 from send to first delivery, which shows the price of retransmits
+- datagrams the proxy forwarded and dropped, i.e. the overhead of sequence numbers and acks
+
+Usage:
+    python bench/reliability.py
+    python bench/reliability.py --loss 0 --loss 0.1 --rooms 20 --duration 5
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import socket
+import time
+
+from loadgen import free_port, launch_server, percentile
+from aio_client import ChatClient
+
+MESSAGE_PREFIX = "rel:"
+
+class LossyProxy:
+    # Forwards datagrams between clients and the server, dropping each with probability loss.
+
+    def __init__(self, server_address, loss, seed=0):
+        self.server_address = server_address
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.transport = None
+        # client address -> upstream transport
+        self.upstreams = {}
+        self.forwarded = 0
+        self.dropped = 0
+
+    def lost(self):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return True
+        self.forwarded += 1
+        return False
+
+    async def start(self):
+        # Binds an ephemeral port and returns it.
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _Downstream(self), local_addr=("127.0.0.1", 0))
+        return self.transport.get_extra_info("sockname")[1]
+
+    async def to_server(self, data, client_address):
+        upstream = self.upstreams.get(client_address)
+        if upstream is None:
+            loop = asyncio.get_running_loop()
+            upstream, _ = await loop.create_datagram_endpoint(
+                lambda: _Upstream(self, client_address), remote_addr=self.server_address)
+            self.upstreams[client_address] = upstream
+        if not self.lost():
+            upstream.sendto(data)
+
+    def close(self):
+        for upstream in self.upstreams.values():
+            upstream.close()
+        self.transport.close()
+
+class _Downstream(asyncio.DatagramProtocol):
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def datagram_received(self, data, address):
+        asyncio.ensure_future(self.proxy.to_server(data, address))
+
+class _Upstream(asyncio.DatagramProtocol):
+
+    def __init__(self, proxy, client_address):
+        self.proxy = proxy
+        self.client_address = client_address
+
+    def datagram_received(self, data, address):
+        if not self.proxy.lost():
+            self.proxy.transport.sendto(data, self.client_address)
+
+class Run:
+
+    def __init__(self):
+        self.sent = 0
+        self.expected = 0
+        self.delivered = 0
+        self.duplicates = 0
+        self.latencies = []
+
+class Member:
+
+    def __init__(self, run, args, proxy_port, reliable):
+        self.run = run
+        self.seen = set()
+        self.chat = ChatClient("127.0.0.1", args.tcp_port, proxy_port, args.protocol, control_session=False,
+                               on_message=self.on_message, heartbeat_interval=args.heartbeat, reliable=reliable)
+
+    def on_message(self, response):
+        message = response.get("message")
+        if not message or not message.startswith(MESSAGE_PREFIX):
+            return
+        message_id, sent_at = message[len(MESSAGE_PREFIX):].split(" ", 1)
+        if message_id in self.seen:
+            self.run.duplicates += 1
+            return
+        self.seen.add(message_id)
+        self.run.delivered += 1
+        self.run.latencies.append(time.perf_counter() - float(sent_at))
+
+async def measure(args, loss, reliable, label):
+    run = Run()
+    proxy = LossyProxy(("127.0.0.1", args.udp_port), loss, args.seed)
+    proxy_port = await proxy.start()
+    rooms = []
+    try:
+        for index in range(args.rooms):
+            members = [Member(run, args, proxy_port, reliable) for _ in range(args.users)]
+            room_name = f"{label}-{index}"
+            await members[0].chat.create_room(room_name, "user-0")
+            for user_index, member in enumerate(members[1:], 1):
+                await member.chat.join_room(room_name, f"user-{user_index}")
+            rooms.append(members)
+        # heartbeats repair lost connect datagrams before the measurement starts
+        await asyncio.sleep(args.settle)
+
+        senders = [member for members in rooms for member in members]
+        interval = 1.0 / (args.rate * len(senders))
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.duration:
+            member = senders[run.sent % len(senders)]
+            member.chat.send(f"{MESSAGE_PREFIX}{run.sent} {time.perf_counter():.9f}")
+            run.sent += 1
+            run.expected += args.users
+            await asyncio.sleep(interval)
+        await asyncio.sleep(args.drain)
+    finally:
+        for members in rooms:
+            for member in members:
+                await member.chat.close()
+        proxy.close()
+
+    latencies = sorted(run.latencies)
+    return {
+        "loss": loss,
+        "reliable": reliable,
+        "sent": run.sent,
+        "delivery": round(run.delivered / run.expected, 4) if run.expected else 0,
+        "duplicates": run.duplicates,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+            "p99": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        },
+        "datagrams_forwarded": proxy.forwarded,
+        "datagrams_dropped": proxy.dropped,
+    }
+
+async def drive(args):
+    results = []
+    for loss in args.loss:
+        for reliable in (False, True):
+            label = f"loss{int(loss * 100)}-{'reliable' if reliable else 'plain'}"
+            results.append(await measure(args, loss, reliable, label))
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reliable delivery benchmark on a lossy network")
+    parser.add_argument("--loss", type=float, action="append", help="drop probability per datagram (repeatable)")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--users", type=int, default=5, help="users per room")
+    parser.add_argument("--rate", type=float, default=2.0, help="messages per second per user")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds of sending")
+    parser.add_argument("--protocol", choices=("json", "binary"), default="binary")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread")
+    parser.add_argument("--heartbeat", type=float, default=0.5, help="client heartbeat interval")
+    parser.add_argument("--settle", type=float, default=1.5)
+    parser.add_argument("--drain", type=float, default=4.0, help="seconds to wait for retransmits after sending")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+    args.loss = args.loss or [0.0, 0.05, 0.2]
+    # launch_server() options this benchmark does not vary
+    args.workers = 0
+    args.server_arg = []
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.tcp_port = free_port(socket.SOCK_STREAM)
+    args.udp_port = free_port(socket.SOCK_DGRAM)
+
+    process = launch_server(args)
+    try:
+        results = asyncio.run(drive(args))
+    finally:
+        process.terminate()
+        process.wait()
+
+    result = json.dumps({"config": {"rooms": args.rooms, "users_per_room": args.users, "rate_per_user": args.rate,
+                                    "duration": args.duration, "protocol": args.protocol, "engine": args.engine},
+                         "timestamp": time.time(), "runs": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    else:
+        print(result)
+
+if __name__ == "__main__":
+    main()
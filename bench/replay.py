@@ -0,0 +1,224 @@
+"""
+Deterministic replay of captured server traffic, optionally under cProfile and tracemalloc.
+
+Reads a trace recorded with `python src/server.py --capture PATH` (see capture.py) and feeds
+it to a fresh in-process server: every TCP request goes through server.handle_tcp_connection()
+on a stub connection and every datagram through server.handle_udp_packet(), the function
+udp_handler() and the asyncio engine call, with a socket stand-in that only counts what
+would have been sent. The traffic of a real session therefore runs through exactly the
+server code it hit in production, without the network, as often as needed.
+
+The server issues its own tokens, so the tokens of the recorded TCP requests (leave,
+heartbeat) and datagrams (JSON, binary, reliable envelopes, first fragments, and the member
+ids and token tags of compact datagrams) are rewritten to the ones the replayed requests got. Rate limits are off unless
+--rate-limits is given, since replaying faster than real time would trip them; idle members
+are not reaped and reliable deliveries are not retransmitted.
+
+--speed 1 keeps the recorded timing, --speed 10 replays ten times faster and --speed 0 (the
+default) as fast as possible. --profile writes the cProfile statistics of the replay (for
+pstats or snakeviz) and adds the --top functions by own time to the report; --tracemalloc N
+traces allocations with N frames and adds the peak and the --top source lines holding the
+most memory at the end.
+
+The report is one JSON object with the records replayed, the wall time, datagrams sent and
+the profiles asked for.
+
+Usage:
+    python src/server.py --capture traffic.trace      # record, then stop the server
+    python bench/replay.py traffic.trace
+    python bench/replay.py traffic.trace --speed 1 --profile replay.prof --tracemalloc 20
+"""
+
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import time
+import tracemalloc
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, SRC_DIR)
+
+import protocol
+import server
+from capture import KIND_REQUEST, read_trace
+from metrics import STATS
+from tokens import TOKEN_SIZE
+
+# tokens are hex in JSON and binary datagrams
+TOKEN_PATTERN = re.compile(rb"(?<![0-9a-f])[0-9a-f]{%d}(?![0-9a-f])" % (2 * TOKEN_SIZE))
+
+class NullSocket:
+
+    def __init__(self):
+        self.datagrams = 0
+        self.bytes = 0
+
+    def sendto(self, data, address):
+        self.datagrams += 1
+        self.bytes += len(data)
+        return len(data)
+
+class StubConnection:
+    # A TCP connection that carries one request and keeps the response.
+
+    def __init__(self, data):
+        self.data = data
+        self.sent = b""
+
+    def recv(self, size):
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+    def sendall(self, data):
+        self.sent += data
+
+    def close(self):
+        pass
+
+class TokenMap:
+    # Recorded tokens -> the ones the replay issued, and recorded token tags -> the member id
+    # and tag of the issued token, since a compact datagram names its member by both.
+
+    def __init__(self):
+        self.tokens = {}
+        self.tags = {}
+
+    def add(self, recorded, issued):
+        if isinstance(recorded, str) and isinstance(issued, str) and recorded != issued:
+            self.tokens[recorded.encode('ascii')] = issued.encode('ascii')
+            claims = server.signer.decode(issued)
+            self.tags[protocol.token_tag(recorded)] = (claims[1] if claims is not None else None,
+                                                       protocol.token_tag(issued))
+
+    def rewrite_request(self, request):
+        # The request with its "token" (leave, heartbeat) replaced by the issued one.
+        token = request.get("token") if isinstance(request, dict) else None
+        issued = self.tokens.get(token.encode('ascii', 'replace')) if isinstance(token, str) else None
+        if issued is None:
+            return request
+        return dict(request, token=issued.decode('ascii'))
+
+    def rewrite(self, data):
+        if not self.tokens:
+            return data
+        if protocol.is_fragment(data):
+            # the token is at the start of the datagram, so in its first fragment
+            message_id, index, count, chunk = protocol.decode_fragment(data)
+            if index != 0:
+                return data
+            return protocol.encode_fragment(message_id, index, count, self.rewrite(bytes(chunk)))
+        if protocol.is_reliable(data):
+            seq, inner = protocol.decode_reliable(data)
+            return protocol.encode_reliable(seq, self.rewrite(bytes(inner)))
+        if protocol.is_compact(data):
+            op, member_id, tag, payload = protocol.decode_compact(data)
+            issued = self.tags.get(tag)
+            if issued is None:
+                return data
+            issued_member_id, issued_tag = issued
+            if issued_member_id is None:
+                issued_member_id = member_id
+            return protocol.encode_compact(op, issued_member_id, issued_tag, bytes(payload))
+        return TOKEN_PATTERN.sub(lambda match: self.tokens.get(match.group(), match.group()), data)
+
+def replay(records, speed):
+    # Feeds the records to the server's handlers. Returns the counters of the run.
+    sock = NullSocket()
+    tokens = TokenMap()
+    counts = {"requests": 0, "datagrams": 0, "errors": 0}
+    started = time.perf_counter()
+    for kind, at, address, data in records:
+        if speed:
+            delay = started + at / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if kind == KIND_REQUEST:
+            recorded = json.loads(data)
+            connection = StubConnection(json.dumps(tokens.rewrite_request(recorded["request"])).encode('utf-8'))
+            server.handle_tcp_connection(connection, address)
+            counts["requests"] += 1
+            if recorded.get("token") and connection.sent:
+                tokens.add(recorded["token"], json.loads(connection.sent).get("token"))
+        else:
+            counts["datagrams"] += 1
+            try:
+                server.handle_udp_packet(sock, tokens.rewrite(data), address)
+            except Exception:
+                # udp_handler() logs and carries on
+                counts["errors"] += 1
+    counts["seconds"] = round(time.perf_counter() - started, 6)
+    counts["sent_datagrams"] = sock.datagrams
+    counts["sent_bytes"] = sock.bytes
+    return counts
+
+def top_functions(profiler, limit):
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+    return [{"function": f"{os.path.basename(filename)}:{line}({name})", "calls": calls,
+             "tottime_ms": round(tottime * 1000, 3), "cumtime_ms": round(cumtime * 1000, 3)}
+            for (filename, line, name), (_, calls, tottime, cumtime, _) in rows]
+
+def top_allocations(snapshot, limit):
+    statistics = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("lineno")
+    return [{"site": f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+             "kib": round(stat.size / 1024, 1), "blocks": stat.count}
+            for stat in statistics[:limit]]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a captured traffic trace through the server's handlers")
+    parser.add_argument("trace", help="trace file written by server.py --capture")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed: 1 is real time, 0 as fast as possible")
+    parser.add_argument("--profile", help="write cProfile statistics of the replay to this file")
+    parser.add_argument("--top", type=int, default=25, help="functions and allocation sites in the report")
+    parser.add_argument("--tracemalloc", type=int, default=0, metavar="FRAMES",
+                        help="trace allocations keeping this many frames (0 disables)")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the server's default rate limits")
+    parser.add_argument("--metrics", action="store_true", help="enable the server's metrics and add them to the report")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    # read up front, so file I/O stays out of the timing and the profiles
+    records = list(read_trace(args.trace))
+    if not args.rate_limits:
+        server.limiter.configure(0, 0, 0, 0)
+    STATS.enabled = args.metrics
+
+    profiler = cProfile.Profile() if args.profile else None
+    if args.tracemalloc:
+        tracemalloc.start(args.tracemalloc)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        counts = replay(records, args.speed)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    report = {"config": {"trace": args.trace, "speed": args.speed, "rate_limits": args.rate_limits},
+              "timestamp": time.time(), "records": len(records), **counts}
+    if args.metrics:
+        report["metrics"] = STATS.snapshot()
+    if profiler is not None:
+        profiler.dump_stats(args.profile)
+        report["profile"] = {"file": args.profile, "top_functions": top_functions(profiler, args.top)}
+    if args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report["allocations"] = {"peak_kib": round(peak / 1024, 1), "top_sites": top_allocations(snapshot, args.top)}
+
+    result = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    else:
+        print(result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+asyncio client library for the Online Chat Messenger System.
+
+client.py used to be one user per process: a thread blocked in input() and a receiver thread
+polling its UDP socket every 0.5 s. A ChatClient is one chat session that lives entirely on
+an event loop: its TCP requests are coroutines, its UDP socket is a DatagramProtocol, and its
+heartbeat is a loop timer, so an idle session costs no thread and no wakeup, and one process
+can run thousands of sessions side by side (bench/loadgen.py, bots). The CLI in client.py
+is a thin wrapper around one ChatClient.
+
+The wire protocol is the one connect_to_server speaks: create_room/join_room over TCP (a
+persistent control session, see control.py, or one-shot JSON requests when the server does
+not keep sessions, e.g. --workers), then UDP datagrams in the negotiated format built by
+client.build_packet, with compact datagrams when the server hands out a member id.
+
+Deliveries are either pushed to callbacks or pulled:
+
+    chat = ChatClient(on_message=print)             # callback per message
+    async for delivery in chat: ...                 # or iterate over them
+
+Chat messages and system messages (decoded datagrams, see client.decode_responses) go to
+on_message and room events pushed over the control session go to on_event; whatever has no
+callback is queued for the async iterator, which ends when the session is closed. The queue
+holds at most QUEUE_SIZE deliveries and drops the oldest beyond that (counted in dropped).
+
+With compression=True (the default, see client.USE_COMPRESSION) the session asks for large
+deliveries and join histories to be compressed (see compression.py); client.decode_responses
+undoes it, and join_room returns the history decompressed either way.
+
+With reliable=True the session asks the server for reliable delivery (see reliable.py). If
+the server confirms it, chat messages and leaves are sent with sequence numbers and resent
+until acked, and deliveries are acked and deduplicated, so neither direction loses or
+repeats messages on a lossy network. Servers that do not offer it (--workers, --cluster)
+leave the session on plain datagrams.
+
+With fragmentation=True (the default) the session asks for fragmentation (see fragments.py): if
+the server confirms it with a "fragment_size", datagrams larger than that are sent as
+fragments and fragmented deliveries are reassembled, so messages far beyond one MTU (pasted
+logs, code blocks) neither get truncated nor rely on IP fragmentation.
+
+Classes:
+    ChatClient: One chat session (room membership, UDP endpoint, control session).
+Global Variables:
+    QUEUE_SIZE (int): Deliveries kept for the async iterator.
+    LEAVE_TIMEOUT (float): Seconds leave() waits for a reliable leave to be acked.
+"""
+
+import asyncio
+import itertools
+import json
+
+import client
+import compression
+import control
+import fragments
+import protocol
+import reliable
+
+QUEUE_SIZE = 1024
+# seconds leave() waits for a reliable leave to be acked before closing anyway
+LEAVE_TIMEOUT = 2.0
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, chat):
+        self.chat = chat
+
+    def datagram_received(self, data, address):
+        self.chat.datagrams += 1
+        self.chat.bytes_received += len(data)
+        self.chat._receive(data)
+
+    def error_received(self, exc):
+        pass
+
+class ChatClient:
+
+    def __init__(self, host=client.TCP_HOST, tcp_port=client.TCP_PORT, udp_port=client.UDP_PORT,
+                 wire_protocol=client.WIRE_PROTOCOL, control_session=client.USE_CONTROL_SESSION,
+                 on_message=None, on_event=None, heartbeat_interval=client.HEARTBEAT_INTERVAL, timeout=10.0,
+                 reliable=False, compression=client.USE_COMPRESSION, fragmentation=True):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.wire_protocol = wire_protocol
+        self.control_session = control_session
+        self.on_message = on_message
+        self.on_event = on_event
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+        self.reliable = reliable
+        self.compression = compression
+        self.fragmentation = fragmentation
+        # set by a successful create_room/join_room
+        self.room_name = None
+        self.username = None
+        self.token = None
+        self.binary = False
+        self.member_id = None
+        self.transport = None
+        # reliable.Link once the server confirmed reliable delivery
+        self.link = None
+        # largest datagram sent whole once the server confirmed fragmentation, else None
+        self.fragment_size = None
+        # fragmented deliveries waiting for the rest
+        self._reassembly = fragments.Reassembler()
+        # datagrams and bytes received, deliveries the iterator queue dropped
+        self.datagrams = 0
+        self.bytes_received = 0
+        self.dropped = 0
+        self.closed = False
+        # created on first use, inside the running loop
+        self._queue = None
+        self._heartbeat = None
+        self._retransmit = None
+        # control session: the stream writer, its reader task and the requests awaiting a response
+        self._writer = None
+        self._reader_task = None
+        self._ids = itertools.count(1)
+        self._waiting = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        queue = self._deliveries()
+        delivery = await queue.get()
+        if delivery is None:
+            # close() wakes the iterator up; keep the marker for any other waiter
+            queue.put_nowait(None)
+            raise StopAsyncIteration
+        return delivery
+
+    def _deliveries(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    # Rooms
+
+    async def create_room(self, room_name, username, password=None):
+        return await self._enter_room("create_room", room_name, username, password)
+
+    async def join_room(self, room_name, username, password=None, history=None):
+        # history limits the backlog of recent messages sent along with the response
+        return await self._enter_room("join_room", room_name, username, password, history)
+
+    async def _enter_room(self, operation, room_name, username, password=None, history=None):
+        fields = {"room_name": room_name, "username": username}
+        if self.wire_protocol:
+            fields["protocol"] = self.wire_protocol
+        if password:
+            fields["password"] = password
+        if history is not None:
+            fields["history"] = history
+        if self.reliable:
+            fields["reliable"] = True
+        if self.compression:
+            fields["compression"] = compression.NAME
+        if self.fragmentation:
+            fields["fragments"] = True
+        response = await self.request(operation, **fields)
+        if response.get("status") != "success":
+            return response
+        if "history_zlib" in response:
+            response["history"] = compression.decompress_history(response.pop("history_zlib"))
+
+        self.room_name = room_name
+        self.username = username
+        self.token = response["token"]
+        # the binary format only if the server confirmed it and the names fit its header
+        self.binary = response.get("protocol") == "binary" and protocol.fits(room_name, self.token)
+        self.member_id = response.get("member_id") if self.binary else None
+        self.link = reliable.Link() if response.get("reliable") else None
+        self.fragment_size = response.get("fragment_size")
+        if self.transport is None:
+            loop = asyncio.get_running_loop()
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: _DatagramProtocol(self), remote_addr=(self.host, self.udp_port))
+        # tells the server where to deliver the room's messages
+        self._send_packet("connect")
+        if self.heartbeat_interval and self._heartbeat is None:
+            self._heartbeat = asyncio.get_running_loop().call_later(self.heartbeat_interval, self._send_heartbeat)
+        return response
+
+    async def list_rooms(self, limit=None, cursor=None):
+        return await self.request("list_rooms", **self._page_fields(limit, cursor))
+
+    async def search_rooms(self, prefix, limit=None, cursor=None):
+        return await self.request("search_rooms", prefix=prefix, **self._page_fields(limit, cursor))
+
+    async def top_rooms(self, limit=None):
+        return await self.request("top_rooms", **self._page_fields(limit, None))
+
+    @staticmethod
+    def _page_fields(limit, cursor):
+        fields = {}
+        if limit is not None:
+            fields["limit"] = limit
+        if cursor is not None:
+            fields["cursor"] = cursor
+        return fields
+
+    # Messages
+
+    def send(self, message_text):
+        # Sends a chat message to the room. UDP never blocks, so this is not a coroutine.
+        return self._send_packet("message", message_text)
+
+    async def leave(self, timeout=LEAVE_TIMEOUT):
+        # Leaves the room (closing it if this session is the host) and closes the session.
+        # In a reliable session the leave is retransmitted like a message, so the session stays
+        # open until it and anything sent before it were acked (or given up), at most timeout s.
+        if self.transport is not None and self.token is not None:
+            self._send_packet("leave")
+            if self.link is not None:
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + timeout
+                while self.link.send.unacked and loop.time() < deadline:
+                    await asyncio.sleep(reliable.RETRANSMIT_INTERVAL)
+        await self.close()
+
+    def _send_packet(self, operation, message_text=None):
+        packet = client.build_packet(operation, self.token, self.room_name, self.username, message_text,
+                                     self.binary, self.member_id)
+        if self.link is not None and operation in ("message", "leave"):
+            # connects and heartbeats are repeated anyway; these must not be lost
+            seq = self.link.send.push(packet, asyncio.get_running_loop().time())
+            packet = protocol.encode_reliable(seq, packet)
+            if self._retransmit is None:
+                self._retransmit = asyncio.get_running_loop().call_later(reliable.RETRANSMIT_INTERVAL, self._resend)
+        self._sendto(packet)
+        return len(packet)
+
+    def _sendto(self, packet):
+        if self.fragment_size and len(packet) > self.fragment_size:
+            for fragment in fragments.split(packet, self.fragment_size):
+                self.transport.sendto(fragment)
+        else:
+            self.transport.sendto(packet)
+
+    def _resend(self):
+        self._retransmit = None
+        if self.closed or self.link is None:
+            return
+        for seq, packet in self.link.send.due(asyncio.get_running_loop().time()):
+            self._sendto(protocol.encode_reliable(seq, packet))
+        if self.link.send.unacked:
+            self._retransmit = asyncio.get_running_loop().call_later(reliable.RETRANSMIT_INTERVAL, self._resend)
+
+    def _receive(self, data):
+        # Delivers the responses of a datagram, batches included: reassembles fragments, and in
+        # a reliable session acks and deduplicates the deliveries.
+        link = self.link
+        parts = protocol.decode_batch(data) if protocol.is_batch(data) else (data,)
+        acked = False
+        for part in parts:
+            if protocol.is_fragment(part):
+                try:
+                    part = self._reassembly.add(None, part, asyncio.get_running_loop().time())
+                except ValueError:
+                    continue
+                if part is None:
+                    continue
+            if link is not None and protocol.is_ack(part):
+                link.send.ack(*protocol.decode_ack(part), asyncio.get_running_loop().time())
+                continue
+            if link is not None and protocol.is_reliable(part):
+                seq, part = protocol.decode_reliable(part)
+                acked = True
+                if not link.receive.received(seq):
+                    continue
+            try:
+                responses = client.decode_responses(bytes(part))
+            except ValueError:
+                continue
+            for response in responses:
+                self._deliver(self.on_message, response)
+        if acked:
+            self.transport.sendto(link.receive.ack())
+
+    def _send_heartbeat(self):
+        if self.closed:
+            return
+        self._send_packet("heartbeat")
+        self._heartbeat = asyncio.get_running_loop().call_later(self.heartbeat_interval, self._send_heartbeat)
+
+    def _deliver(self, callback, delivery):
+        if callback is not None:
+            callback(delivery)
+            return
+        queue = self._deliveries()
+        if queue.qsize() >= QUEUE_SIZE:
+            queue.get_nowait()
+            self.dropped += 1
+        queue.put_nowait(delivery)
+
+    # TCP requests
+
+    async def request(self, operation, **fields):
+        # Sends a request over the control session, opening it on first use, or as a one-shot
+        # request when sessions are disabled or the server does not keep them.
+        request = dict(fields, operation=operation)
+        if self.control_session:
+            try:
+                if self._writer is None:
+                    await self._open_session()
+                return await self._session_request(request)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                self.control_session = False
+                self._close_session()
+        return await self._one_shot(request)
+
+    async def _one_shot(self, request):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.tcp_port), self.timeout)
+        try:
+            writer.write(json.dumps(request).encode('utf-8'))
+            await writer.drain()
+            # the server closes the connection after its response
+            return json.loads((await asyncio.wait_for(reader.read(), self.timeout)).decode('utf-8'))
+        finally:
+            writer.close()
+
+    async def _open_session(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.tcp_port), self.timeout)
+        self._writer = writer
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_frames(reader))
+
+    async def _session_request(self, request):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[request_id] = future
+        try:
+            self._writer.write(control.encode_frame(dict(request, id=request_id)))
+            await self._writer.drain()
+            response = await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._waiting.pop(request_id, None)
+        response.pop("id", None)
+        return response
+
+    async def _read_frames(self, reader):
+        try:
+            while True:
+                (length,) = control.FRAME_HEADER.unpack(await reader.readexactly(control.FRAME_HEADER.size))
+                if length > control.MAX_FRAME_SIZE:
+                    break
+                message = json.loads((await reader.readexactly(length)).decode('utf-8'))
+                future = self._waiting.get(message.get("id"))
+                if future is not None:
+                    if not future.done():
+                        future.set_result(message)
+                elif "event" in message:
+                    self._deliver(self.on_event, message)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Control session closed."))
+
+    def _close_session(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        if self._retransmit is not None:
+            self._retransmit.cancel()
+            self._retransmit = None
+        if self.transport is not None:
+            self.transport.close()
+        self._close_session()
+        self._deliveries().put_nowait(None)
@@ -0,0 +1,176 @@
+"""
+asyncio engine for the Online Chat Messenger System server.
+
+Runs the same create_room/join_room/message/leave operations as the threaded engine in
+server.py, but serves every TCP connection and UDP datagram from a single event loop
+instead of starting a thread per TCP accept and blocking on recvfrom.
+Select it with `python server.py --engine asyncio`.
+
+Classes:
+    UDPServerProtocol: DatagramProtocol that hands every datagram to server.handle_udp_packet.
+Functions:
+    handle_tcp_client(reader, writer):
+        Handles one TCP connection created by asyncio.start_server.
+    await_password(request, address):
+        Runs the password hashing or check of a request on the hasher pool.
+    read_legacy_request(reader, data):
+        Reads a one-shot JSON request until it is complete.
+    serve_control_session(reader, writer, address, first):
+        Serves a persistent control session until the client disconnects.
+    reap_periodically(transport):
+        Reaps idle members every REAP_INTERVAL seconds on the event loop.
+    retransmit_periodically(transport):
+        Resends unacked reliable deliveries every RETRANSMIT_INTERVAL seconds on the event loop.
+    start(host, tcp_port, udp_port):
+        Binds the TCP server and the UDP endpoint and returns them.
+    serve(host, tcp_port, udp_port):
+        Starts both endpoints and serves until cancelled.
+    run(host, tcp_port, udp_port):
+        Entry point used by server.main().
+"""
+
+import asyncio
+import json
+import logging
+
+import control
+import server
+from reliable import RETRANSMITS, RETRANSMIT_INTERVAL
+from server import (
+    TCP_PORT, UDP_PORT, BUFFER_SIZE, TCP_BACKLOG,
+    REAP_INTERVAL, process_tcp_request, handle_control_request, handle_udp_packet, reap_idle_members
+)
+
+log = logging.getLogger("chat.aio_server")
+
+async def handle_tcp_client(reader, writer):
+    # Handles tcp connections: one JSON request (create or join a chat room), or a persistent
+    # control session if the connection starts with a frame header (see control.py).
+    address = writer.get_extra_info("peername")
+    try:
+        first = await reader.read(1)
+        if control.is_legacy_request(first):
+            request = await read_legacy_request(reader, first)
+            response = process_tcp_request(request, address, kdf=await await_password(request, address))
+
+            writer.write(json.dumps(response).encode('utf-8'))
+            await writer.drain()
+        elif first:
+            await serve_control_session(reader, writer, address, first)
+    except Exception as e:
+        log.warning("Error handling TCP connection: %s", e)
+    finally:
+        writer.close()
+
+async def await_password(request, address):
+    # scrypt takes tens of milliseconds, so the loop serves other clients until it is done.
+    # Returns the finished future (or None) for process_tcp_request, which reports its errors.
+    kdf = server.password_future(request, address)
+    if kdf is not None:
+        try:
+            await asyncio.wrap_future(kdf)
+        except Exception:
+            pass
+    return kdf
+
+async def read_legacy_request(reader, data):
+    # Keeps reading until the bytes received so far parse as one JSON object.
+    while True:
+        chunk = await reader.read(BUFFER_SIZE)
+        data += chunk
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            if not chunk or len(data) > control.MAX_FRAME_SIZE:
+                raise
+
+async def serve_control_session(reader, writer, address, first):
+    session = control.Session(writer.write, address, abort=writer.transport.abort,
+                              buffered=writer.transport.get_write_buffer_size)
+    try:
+        header = first + await reader.readexactly(control.FRAME_HEADER.size - len(first))
+        while True:
+            (length,) = control.FRAME_HEADER.unpack(header)
+            if length > control.MAX_FRAME_SIZE:
+                raise ValueError(f"Frame of {length} bytes exceeds the limit.")
+            request = json.loads((await reader.readexactly(length)).decode('utf-8'))
+            kdf = await await_password(request, address) if isinstance(request, dict) else None
+            session.send(handle_control_request(request, address, session, kdf))
+            await writer.drain()
+            header = await reader.readexactly(control.FRAME_HEADER.size)
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        control.SESSIONS.forget(session)
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    # Receives chat datagrams and distributes them through the shared UDP handler.
+    # The transport is passed in place of a socket: it exposes the same sendto(data, address).
+
+    def __init__(self):
+        self.transport = None
+        # what responses are sent with: the transport, or a coalesce.Coalescer wrapping it
+        self.sender = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sender = transport
+
+    def datagram_received(self, data, address):
+        try:
+            handle_udp_packet(self.sender, data, address)
+        except Exception as e:
+            log.warning("Error handling UDP handler: %s", e)
+
+    def error_received(self, exc):
+        log.warning("UDP endpoint error: %s", exc)
+
+def reap_periodically(transport):
+    if transport.is_closing():
+        return
+    try:
+        reap_idle_members(server.udp_transport)
+    except Exception as e:
+        log.warning("Error reaping idle members: %s", e)
+    asyncio.get_running_loop().call_later(REAP_INTERVAL, reap_periodically, transport)
+
+def retransmit_periodically(transport):
+    if transport.is_closing():
+        return
+    try:
+        RETRANSMITS.tick(server.udp_transport)
+    except Exception as e:
+        log.warning("Error retransmitting: %s", e)
+    asyncio.get_running_loop().call_later(RETRANSMIT_INTERVAL, retransmit_periodically, transport)
+
+async def start(host="0.0.0.0", tcp_port=TCP_PORT, udp_port=UDP_PORT):
+    # Binds both endpoints on the running loop and returns (tcp_server, udp_transport).
+    loop = asyncio.get_running_loop()
+    udp_transport, udp_protocol = await loop.create_datagram_endpoint(UDPServerProtocol, local_addr=(host, udp_port))
+    server.tune_udp_socket(udp_transport.get_extra_info("socket"))
+    server.udp_transport = udp_transport
+    if server.COALESCE_WINDOW > 0:
+        # flushed by the loop, so the transport is only ever used from the loop's thread
+        from coalesce import Coalescer
+        udp_protocol.sender = server.udp_transport = Coalescer(
+            udp_transport, server.COALESCE_WINDOW, BUFFER_SIZE, loop.call_later)
+    loop.call_later(REAP_INTERVAL, reap_periodically, udp_transport)
+    if server.RELIABLE_DELIVERY:
+        loop.call_later(RETRANSMIT_INTERVAL, retransmit_periodically, udp_transport)
+    tcp_server = await asyncio.start_server(handle_tcp_client, host, tcp_port, backlog=TCP_BACKLOG)
+    return tcp_server, udp_transport
+
+async def serve(host="0.0.0.0", tcp_port=TCP_PORT, udp_port=UDP_PORT):
+    tcp_server, udp_transport = await start(host, tcp_port, udp_port)
+    log.info("Server (asyncio) is running on TCP:%d and UDP:%d", tcp_port, udp_port)
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        udp_transport.close()
+
+def run(host="0.0.0.0", tcp_port=TCP_PORT, udp_port=UDP_PORT):
+    try:
+        asyncio.run(serve(host, tcp_port, udp_port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,92 @@
+"""
+Capture of a server's incoming traffic for deterministic replay.
+
+With `python server.py --capture PATH` every TCP request and every UDP datagram the server
+handles is appended to a trace file, with the time it arrived and its source address, so
+the traffic of a real session can be fed through the handlers again with sockets stubbed
+out (bench/replay.py), as often as needed and under cProfile or tracemalloc.
+
+The trace is a binary file: HEADER, then one record per request or datagram:
+
+    kind (1 byte) | seconds since the capture started (8 bytes, double) | port (2 bytes)
+    | ip length (1 byte) | data length (4 bytes) | ip (ASCII) | data
+
+A datagram record holds the datagram as received (fragments, reliable and compact
+envelopes included). A request record holds the JSON of {"request": ..., "token": ...}: the
+request dict as the engine decoded it, and the token the server answered with, which lets
+a replay map the tokens in the recorded datagrams to the ones it issues itself. Requests
+are recorded once answered, so a datagram that uses a token always follows the request
+that issued it. Traces contain tokens and room passwords and should be handled as such.
+
+Classes:
+    TraceWriter: Appends records to a trace file; thread safe.
+Functions:
+    read_trace(path): Yields (kind, at, address, data) for every record of a trace.
+Global Variables:
+    KIND_REQUEST (int): Record kind of a TCP request.
+    KIND_DATAGRAM (int): Record kind of a UDP datagram.
+"""
+
+import json
+import struct
+import threading
+import time
+
+HEADER = b"CHATTRC1"
+RECORD = struct.Struct("!BdHBI")
+
+KIND_REQUEST = 1
+KIND_DATAGRAM = 2
+
+class TraceWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._file = open(path, "wb")
+        self._file.write(HEADER)
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def request(self, request, response, address):
+        # Records a TCP request once it was answered with response.
+        data = json.dumps({"request": request, "token": response.get("token")}).encode('utf-8')
+        self._write(KIND_REQUEST, data, address)
+
+    def datagram(self, data, address):
+        self._write(KIND_DATAGRAM, data, address)
+
+    def _write(self, kind, data, address):
+        ip = address[0].encode('ascii') if address else b""
+        port = address[1] if address else 0
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(RECORD.pack(kind, time.monotonic() - self._started, port, len(ip), len(data)))
+            self._file.write(ip)
+            self._file.write(data)
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read_trace(path):
+    # Raises ValueError if the file is not a trace or a record is cut short.
+    with open(path, "rb") as f:
+        if f.read(len(HEADER)) != HEADER:
+            raise ValueError(f"{path} is not a traffic trace.")
+        while True:
+            header = f.read(RECORD.size)
+            if not header:
+                return
+            if len(header) < RECORD.size:
+                raise ValueError("Truncated trace record.")
+            kind, at, port, ip_length, length = RECORD.unpack(header)
+            ip = f.read(ip_length)
+            data = f.read(length)
+            if len(ip) < ip_length or len(data) < length:
+                raise ValueError("Truncated trace record.")
+            yield kind, at, (ip.decode('ascii'), port), data
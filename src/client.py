@@ -11,17 +11,34 @@ Constants:
     TCP_PORT (int): Port number for TCP connection, default is 5000
     UDP_PORT (int): Port number for UDP connection, default is 6000
     BUFFER_SIZE (int): Buffer size for socket communication, default is 4096
+    WIRE_PROTOCOL (str): UDP wire format requested from the server (env CHAT_PROTOCOL), default is "binary"
+    HEARTBEAT_INTERVAL (float): Seconds between UDP heartbeats, well below the server's idle timeout
+    USE_CONTROL_SESSION (bool): Keep a persistent control session open (env CHAT_CONTROL_SESSION), default is True
+    USE_COMPRESSION (bool): Ask for compressed deliveries (env CHAT_COMPRESSION), default is True
 
 Functions:
-    connect_to_server(host, room_name, username, operation): Establishes a TCP connection
-        to the server for room creation or joining.
+    connect_to_server(host, room_name, username, operation, wire_protocol, password): Establishes
+        a TCP connection to the server for room creation or joining, optionally asking for a UDP
+        wire format ("json" or "binary") and giving the room's password.
+    print_history(messages): Prints the recent messages sent with a join_room response.
+    build_packet(operation, token, room_name, username, message_text, binary, member_id): Encodes
+        a UDP packet as JSON, or in the binary or (with a member_id) compact format of protocol.py.
+    decode_responses(data): Decodes a received datagram, unpacking coalesced batches and
+        compressed deliveries, into a list of response dicts.
+    print_response(response): Prints a chat or system message received over UDP.
+    run_session(room_name, username, operation, password): The CLI's chat session, run on an
+        event loop with an aio_client.ChatClient.
     main(): Entry point for the client application, handles user input and initial connection.
 """
 
+import asyncio
 import socket
 import json
-import threading
-import sys
+import getpass
+import os
+
+import compression
+import protocol
 
 # Constants
 # TCP and UDP settings
@@ -29,10 +46,19 @@ TCP_HOST = "localhost"
 TCP_PORT = 5001
 UDP_PORT = 6001
 BUFFER_SIZE = 4096
+# UDP wire format requested from the server ("binary" or "json")
+WIRE_PROTOCOL = os.environ.get("CHAT_PROTOCOL", "binary")
+# keeps the member from being reaped by the server's idle timeout (server.IDLE_TIMEOUT)
+HEARTBEAT_INTERVAL = 10.0
+# keep the TCP connection open as a control session (see control.py)
+USE_CONTROL_SESSION = os.environ.get("CHAT_CONTROL_SESSION", "1") != "0"
+# large deliveries and join histories compressed with a preset dictionary (see compression.py)
+USE_COMPRESSION = os.environ.get("CHAT_COMPRESSION", "1") != "0"
 
 # Function to connect to the server
 # and create or join a chat room
-def connect_to_server(host, room_name, username, operation):
+def connect_to_server(host, room_name, username, operation, wire_protocol=None, password=None):
+    client_socket = None
     try:
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client_socket.connect((host, TCP_PORT))
@@ -42,75 +68,118 @@ def connect_to_server(host, room_name, username, operation):
             "room_name": room_name,
             "username": username
         }
+        if wire_protocol:
+            request["protocol"] = wire_protocol
+        if password:
+            request["password"] = password
 
         client_socket.send(json.dumps(request).encode('utf-8'))
 
-        response = client_socket.recv(BUFFER_SIZE).decode('utf-8')
-        return json.loads(response)
+        # the server closes the connection after its response, which may span several
+        # segments when it carries the room's history
+        chunks = []
+        while True:
+            chunk = client_socket.recv(BUFFER_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(b"".join(chunks).decode('utf-8'))
 
     except Exception as e:
         print(f"Error connecting to server: {e}")
         return {"status": "error", "message": str(e)}
     finally:
-        client_socket.close()
+        if client_socket:
+            client_socket.close()
+
+def print_history(messages):
+    for entry in messages:
+        print(f"{entry['sender']}: {entry['message']}")
+
+def print_event(event):
+    print(f"\n[{event.get('room_name')}] {event.get('username')}: {event.get('event')}")
+
+# Function to build a UDP packet in the negotiated wire format
+def build_packet(operation, token, room_name, username, message_text=None, binary=False, member_id=None):
+    if binary:
+        payload = message_text.encode('utf-8') if message_text is not None else b""
+        if member_id is not None:
+            # the server gave us ids: name the member by id and prove it with the token's tag
+            return protocol.encode_compact(protocol.OPERATION_CODES[operation], member_id, protocol.token_tag(token), payload)
+        return protocol.encode_request(protocol.OPERATION_CODES[operation], room_name, token, payload)
+
+    packet = {
+        "operation": operation,
+        "token": token,
+        "room_name": room_name,
+        "username": username
+    }
+    if message_text is not None:
+        packet["message"] = message_text
+    return json.dumps(packet).encode('utf-8')
+
+# A server with outbound coalescing packs several datagrams into one batch (see coalesce.py)
+def decode_responses(data):
+    datagrams = protocol.decode_batch(data) if protocol.is_batch(data) else [data]
+    responses = []
+    for datagram in datagrams:
+        if compression.is_compressed(datagram):
+            datagram = compression.unwrap(datagram)
+        if protocol.is_binary(datagram):
+            responses.append(protocol.decode_delivery(datagram))
+        else:
+            responses.append(json.loads(bytes(datagram).decode('utf-8')))
+    return responses
+
+# Prints a chat or system message received over UDP
+def print_response(response):
+    if response.get("status") == "success":
+        if "message" in response and "sender" in response:
+            print(f"{response['sender']}: {response['message']}")
+        elif "system_message" in response:
+            print(f"[SYSTEM] {response['system_message']}")
+    else:
+        print(f"[ERROR] {response.get('message', 'Unknown error')}")
 
-# Function to send and receive messages
-def message_sender(udp_socket, server_address, token, room_name, username):
-    print("Message sender started.")
-    print(f"Using token: {token}")
-    print(f"Room name: {room_name}")
-    print(f"server address: {server_address}")
+# The chat session of the CLI: one aio_client.ChatClient, with input() run off the event loop
+async def run_session(room_name, username, operation, password=None):
+    from aio_client import ChatClient
+    chat = ChatClient(TCP_HOST, TCP_PORT, UDP_PORT, WIRE_PROTOCOL, USE_CONTROL_SESSION,
+                      on_message=print_response, on_event=print_event, heartbeat_interval=HEARTBEAT_INTERVAL)
+    try:
+        if operation == "create_room":
+            response = await chat.create_room(room_name, username, password)
+        else:
+            response = await chat.join_room(room_name, username, password)
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"Error connecting to server: {e}")
+        await chat.close()
+        return
+    backlog = response.pop("history", ())
+    print(f"Full response object: {response}")
 
-    while True:
-        message_text = input()
+    if response["status"] != "success":
+        print(f"Failed to connect: {response.get('message', 'Unknown error')}")
+        await chat.close()
+        return
 
+    print(f"Connected to server: token: {response['token']}")
+    print_history(backlog)
+    print(f"Room name: {room_name}")
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            message_text = await loop.run_in_executor(None, input)
+        except EOFError:
+            # Ctrl-D leaves the room like "exit"
+            message_text = "exit"
         if message_text.lower() == "exit":
             print("Exiting chat room.")
-            exit_message = {
-                "operation": "leave",
-                "token": token,
-                "room_name": room_name,
-                "username": username
-            }
-            udp_socket.sendto(json.dumps(exit_message).encode('utf-8'), server_address) 
+            await chat.leave()
             break
+        print(f"Sending message: {message_text}")
+        chat.send(message_text)
 
-        message = {
-            "operation": "message",
-            "token": token,
-            "room_name": room_name,
-            "username": username,
-            "message": message_text
-        }
-
-        print(f"Sending message: {message}")
-
-        udp_socket.sendto(json.dumps(message).encode('utf-8'), server_address)
-
-def message_receiver(udp_socket):
-
-    udp_socket.settimeout(0.5)
-
-    while True:
-     try:
-        data, _ = udp_socket.recvfrom(BUFFER_SIZE)
-        response = json.loads(data.decode('utf-8'))
-
-        if response["status"] == "success":
-            if "message" in response and "sender" in response:
-                print(f"{response['sender']}: {response['message']}")
-            elif "system_message" in response:
-                print(f"[SYSTEM] {response['system_message']}")
-        else:
-            print(f"[ERROR] {response.get('message', 'Unknown error')}")
-     except socket.timeout:
-         continue
-     except json.JSONDecodeError:
-         print("[ERROR] Failed to decode message.")
-     except Exception as e:
-         print(f"[ERROR] An error occurred: {e}")
-         break
-        
 def main():
     print("Welcome to the Chat Room!")
     print("1. Create a new room")
@@ -119,30 +188,14 @@ def main():
 
     username = input("Enter your username: ")
     room_name = input("Enter the room name: ")
+    # creating with a password protects the room; joining a protected room needs it
+    password = getpass.getpass("Enter the room password (empty for none): ")
 
     operation = "create_room" if choice == "1" else "join_room"
-    response = connect_to_server(TCP_HOST, room_name, username, operation)
-    print(f"Full response object: {response}")
-
-    if response["status"] == "success":
-        print(f"Connected to server: token: {response['token']}")
-        try:
-            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            server_address = (TCP_HOST, UDP_PORT)
-
-            receiver_thread = threading.Thread(target=message_receiver, args=(udp_socket, ))
-            receiver_thread.daemon = True
-            receiver_thread.start()
-
-            message_sender(udp_socket, server_address, response['token'], room_name, username)
-        except Exception as e:
-            print(f"Error in message handling: {e}")
-        finally:
-            udp_socket.close()
-            sys.exit(0)
-
-    else:
-        print(f"Failed to connect: {response.get('message', 'Unknown error')}")
+    try:
+        asyncio.run(run_session(room_name, username, operation, password))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     main()
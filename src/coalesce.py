@@ -0,0 +1,100 @@
+"""
+Outbound coalescing of chat datagrams.
+
+In a busy room every message becomes one datagram per member, so the egress packet rate is
+messages x members. With `python server.py --coalesce-window MS` the fan-out sends through
+a Coalescer instead of the socket: datagrams for the same recipient are held for up to the
+window and then sent as one batch datagram (protocol.encode_batch) of at most BUFFER_SIZE
+bytes, which clients unpack (client.decode_responses). Fragments (see fragments.py) are
+sized to fit one MTU and are never batched, so they are sent at once. A recipient that got a single
+datagram in the window receives it unchanged, so quiet rooms only pay the added latency,
+which is bounded by the window: the first datagram held arms one flush of everything
+pending.
+
+The flush is driven by a thread of its own (run(), threaded engine) or by the event loop
+(call_later, asyncio engine). Batches are counted as coalesced_batches and the datagrams
+they carry as coalesced_datagrams.
+
+Classes:
+    Coalescer: Socket stand-in that batches datagrams per recipient.
+Global Variables:
+    DEFAULT_WINDOW (float): Suggested window in seconds.
+"""
+
+import logging
+import threading
+import time
+
+import protocol
+from metrics import STATS
+
+log = logging.getLogger("chat.coalesce")
+
+DEFAULT_WINDOW = 0.005
+
+class Coalescer:
+
+    def __init__(self, sock, window=DEFAULT_WINDOW, max_size=4096, call_later=None):
+        self.sock = sock
+        self.window = window
+        self.max_size = max_size
+        # call_later(delay, callback) of an event loop; without it run() must be started on a thread
+        self.call_later = call_later
+        # recipient address -> [batch size in bytes, datagrams]
+        self.pending = {}
+        self.armed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def sendto(self, data, address):
+        size = len(data)
+        if protocol.BATCH_HEADER.size + protocol.BATCH_ENTRY.size + size > self.max_size or protocol.is_fragment(data):
+            return self.sock.sendto(data, address)
+        full = None
+        with self._lock:
+            entry = self.pending.get(address)
+            if entry is not None and entry[0] + protocol.BATCH_ENTRY.size + size > self.max_size:
+                full = self.pending.pop(address)
+                entry = None
+            if entry is None:
+                entry = self.pending[address] = [protocol.BATCH_HEADER.size, []]
+            entry[0] += protocol.BATCH_ENTRY.size + size
+            entry[1].append(bytes(data))
+            arm = not self.armed
+            self.armed = True
+        if full is not None:
+            self._send(address, full[1])
+        if arm:
+            if self.call_later is not None:
+                self.call_later(self.window, self.flush)
+            else:
+                self._wake.set()
+        return size
+
+    def flush(self):
+        # Sends everything pending.
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            self.armed = False
+        for address, (_, datagrams) in pending.items():
+            try:
+                self._send(address, datagrams)
+            except OSError as e:
+                log.warning("Error sending coalesced datagrams: %s", e)
+
+    def _send(self, address, datagrams):
+        if len(datagrams) == 1:
+            self.sock.sendto(datagrams[0], address)
+            return
+        self.sock.sendto(protocol.encode_batch(datagrams), address)
+        if STATS.enabled:
+            STATS.inc("coalesced_batches")
+            STATS.inc("coalesced_datagrams", len(datagrams))
+
+    def run(self):
+        # Flush loop of the threaded engine: waits for a datagram, then flushes after the window.
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            time.sleep(self.window)
+            self.flush()
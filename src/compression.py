@@ -0,0 +1,162 @@
+"""
+Compression of large deliveries with a preset dictionary.
+
+A message can be as large as the server's BUFFER_SIZE and every broadcast sends it to each
+member of the room, so large messages dominate the egress bandwidth. A client that sends
+"compression": NAME with create_room/join_room (and is confirmed with the same value) gets
+deliveries of at least THRESHOLD bytes as a raw DEFLATE stream (protocol.OP_COMPRESSED):
+
+    magic (1 byte) | OP_COMPRESSED (1 byte) | deflate(datagram)
+
+where datagram is the JSON or binary delivery the member would otherwise get. Chat text is
+short and repetitive (JSON keys, usernames, system messages, common words), which plain
+zlib cannot exploit in a single message, so both sides prime zlib with the same preset
+DICTIONARY. It is trained on chat samples with train_dictionary(): the substrings that save
+the most bytes, most valuable last (zlib reaches the end of the window most cheaply), with
+the wire skeletons of the deliveries at the very end. NAME carries the dictionary's
+Adler-32, so a client and a server with different dictionaries never agree on compression.
+
+A broadcast is compressed once per wire format and the same bytes are sent to every member
+that negotiated compression (see fanout.py), so the CPU cost does not grow with the room.
+A delivery is sent compressed only if that makes it smaller. Compressors and decompressors
+are copied from primed templates, so the dictionary is not processed again per message.
+
+Join responses carry the room's recent messages; when compression is negotiated and the
+history is large it is sent as base64 of its compressed JSON in "history_zlib" instead
+(compress_history/decompress_history).
+
+Functions:
+    train_dictionary(samples, size): Builds a preset dictionary from sample texts.
+    compress(data): Raw DEFLATE of data with the preset dictionary.
+    decompress(data, max_size): Inverse of compress(), bounded to max_size bytes.
+    is_compressed(data): Whether a datagram is a compressed delivery.
+    wrap(datagram): The compressed delivery of a datagram, or the datagram if not smaller.
+    unwrap(data): The delivery inside a compressed datagram.
+    compress_history(messages): The "history_zlib" field of a join response, or None.
+    decompress_history(field): The messages of a "history_zlib" field.
+Global Variables:
+    DICTIONARY (bytes): The preset dictionary shared by clients and servers.
+    NAME (str): The value negotiated as "compression", tied to DICTIONARY.
+    THRESHOLD (int): Deliveries shorter than this are sent uncompressed (server
+        --compress-threshold; 0 stops the server from offering compression).
+    LEVEL (int): zlib compression level.
+    MAX_SIZE (int): Upper bound of a decompressed delivery or history.
+"""
+
+import base64
+import collections
+import json
+import zlib
+
+import protocol
+
+THRESHOLD = 256
+LEVEL = 6
+MAX_SIZE = 1 << 20
+DICTIONARY_SIZE = 2048
+# raw DEFLATE: no zlib header or checksum, the datagram boundary frames the stream. An 8 KiB
+# window covers the dictionary and the largest datagram; the smaller window and hash table
+# make copying a primed compressor several times cheaper than with zlib's maximum.
+WBITS = -13
+MEM_LEVEL = 8
+
+# what chat rooms typically say; the dictionary is trained on these
+_CHAT_SAMPLES = (
+    "hi everyone, how are you doing today?",
+    "hello! I'm doing well, thanks for asking. what about you?",
+    "good morning, did anyone see the message I sent yesterday?",
+    "thanks, that makes sense. I will take a look at it later today.",
+    "can you send me the link again? I think I missed it.",
+    "sorry, I was away from my keyboard for a minute.",
+    "let me know when you are ready and we can get started.",
+    "that sounds great, see you all tomorrow!",
+    "does anyone know what time the meeting starts?",
+    "I don't think that is going to work, but we can try something else.",
+    "please check the document and tell me what you think about it.",
+    "yes, I agree with you. let's do it that way then.",
+    "no problem, happy to help. just ask if you have any other questions.",
+    "I'm going to grab some coffee, back in five minutes.",
+    "has anyone tried the new version yet? is it working for you?",
+    "the server was down for a while this morning, it should be fine now.",
+    "thank you so much for your help, I really appreciate it!",
+    "what do you think we should do about this problem?",
+    "it was really nice to talk to you, have a good night.",
+    "I will be there in about ten minutes, please wait for me.",
+)
+
+# the fixed parts of the deliveries; appended after the trained text so they sit closest
+_SKELETONS = (
+    '{"status": "success", "system_message": "',
+    ' has joined the room.", " has left the room.", " has timed out.", ".closing the room."',
+    '{"status": "success", "sender": "',
+    '", "message": "',
+)
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    # Picks the word n-grams of the samples that cover the most bytes (occurrences times
+    # length) until size bytes, least valuable first.
+    counts = collections.Counter()
+    for sample in samples:
+        words = sample.split(" ")
+        for length in range(1, 5):
+            for start in range(len(words) - length + 1):
+                counts[" ".join(words[start:start + length]) + " "] += 1
+    scored = sorted((count * len(text), text) for text, count in counts.items())
+    chosen = []
+    total = 0
+    for score, text in reversed(scored):
+        if total + len(text) > size:
+            continue
+        if any(text in other for other in chosen):
+            continue
+        chosen.append(text)
+        total += len(text)
+    return "".join(reversed(chosen)).encode('utf-8')
+
+DICTIONARY = train_dictionary(_CHAT_SAMPLES) + "".join(_SKELETONS).encode('utf-8')
+NAME = f"zlib-{zlib.adler32(DICTIONARY):08x}"
+
+_COMPRESSOR = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS, MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+_DECOMPRESSOR = zlib.decompressobj(WBITS, DICTIONARY)
+
+def compress(data):
+    compressor = _COMPRESSOR.copy()
+    return compressor.compress(data) + compressor.flush()
+
+def decompress(data, max_size=MAX_SIZE):
+    decompressor = _DECOMPRESSOR.copy()
+    try:
+        result = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt compressed data: {e}") from None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("Compressed data is truncated or too large.")
+    return result
+
+def is_compressed(data):
+    return len(data) >= protocol.COMPRESSED_HEADER.size and data[0] == protocol.MAGIC \
+        and data[1] == protocol.OP_COMPRESSED
+
+def wrap(datagram):
+    if len(datagram) < THRESHOLD:
+        return datagram
+    compressed = protocol.COMPRESSED_HEADER.pack(protocol.MAGIC, protocol.OP_COMPRESSED) + compress(datagram)
+    return compressed if len(compressed) < len(datagram) else datagram
+
+def unwrap(data):
+    return decompress(memoryview(data)[protocol.COMPRESSED_HEADER.size:])
+
+def compress_history(messages):
+    # None when the history is too small for compression to pay off after base64
+    data = json.dumps(messages).encode('utf-8')
+    if len(data) < THRESHOLD:
+        return None
+    packed = base64.b64encode(compress(data)).decode('ascii')
+    return packed if len(packed) < len(data) else None
+
+def decompress_history(field):
+    try:
+        data = base64.b64decode(field, validate=True)
+    except (TypeError, ValueError):
+        raise ValueError("Malformed history.") from None
+    return json.loads(decompress(data).decode('utf-8'))
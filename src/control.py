@@ -0,0 +1,210 @@
+"""
+Persistent, length-prefixed TCP control channel.
+
+The original control protocol is one JSON request per TCP connection, read with a single
+recv(). A control session instead keeps the connection open and exchanges frames:
+
+    length (4 bytes, big endian) | UTF-8 JSON object
+
+Requests carry an "id" that the server copies into the matching response, so a client can
+pipeline several requests (create_room, join_room, list_rooms, search_rooms, leave, ...) without
+waiting. Frames without an "id" that carry an "event" key are pushed by the server, e.g.
+when a member joins or leaves one of the session's rooms.
+
+The server tells the two styles apart by the first byte: a legacy request starts with '{',
+while a frame starts with the high byte of its length, which is 0 for any frame under
+MAX_FRAME_SIZE.
+
+Classes:
+    FrameReader: Reads whole frames from a blocking socket, whatever the recv() boundaries.
+    Session: Server side of one control connection; send() never blocks its caller.
+    QueuedSession: Session on a blocking socket, written by its own thread from a bounded outbox.
+    SessionRegistry: Maps tokens to the sessions that obtained them, for pushed events.
+Functions:
+    encode_frame(message): Serializes a dict into a frame.
+    is_legacy_request(first_bytes): Whether a connection uses the one-shot JSON protocol.
+    read_legacy_request(sock, data): Reads a one-shot JSON request until it is complete.
+Global Variables:
+    SESSIONS (SessionRegistry): The control sessions of this process.
+    OUTBOX_SIZE (int): Frames a QueuedSession holds before it is dropped.
+    MAX_BUFFERED (int): Bytes a session may leave unsent before it is dropped.
+"""
+
+import json
+import logging
+import queue
+import socket
+import struct
+import threading
+
+from metrics import STATS
+
+log = logging.getLogger("chat.control")
+
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20
+OUTBOX_SIZE = 256
+MAX_BUFFERED = 4 * MAX_FRAME_SIZE
+
+def encode_frame(message):
+    body = json.dumps(message).encode('utf-8')
+    return FRAME_HEADER.pack(len(body)) + body
+
+def is_legacy_request(first_bytes):
+    return first_bytes[:1] == b"{"
+
+def read_legacy_request(sock, data, buffer_size=4096):
+    # Keeps reading until the bytes received so far parse as one JSON object.
+    while True:
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            if len(data) > MAX_FRAME_SIZE:
+                raise
+        chunk = sock.recv(buffer_size)
+        if not chunk:
+            return json.loads(data.decode('utf-8'))
+        data += chunk
+
+class FrameReader:
+
+    def __init__(self, sock, initial=b""):
+        self.sock = sock
+        self.buffer = bytearray(initial)
+
+    def _fill(self, size):
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(max(4096, size - len(self.buffer)))
+            if not chunk:
+                return False
+            self.buffer += chunk
+        return True
+
+    def read_frame(self):
+        # Returns the next decoded frame, or None at end of stream.
+        if not self._fill(FRAME_HEADER.size):
+            return None
+        (length,) = FRAME_HEADER.unpack_from(self.buffer)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {length} bytes exceeds the limit.")
+        if not self._fill(FRAME_HEADER.size + length):
+            return None
+        body = bytes(self.buffer[FRAME_HEADER.size:FRAME_HEADER.size + length])
+        del self.buffer[:FRAME_HEADER.size + length]
+        return json.loads(body.decode('utf-8'))
+
+class Session:
+    # Server side of a control connection. write is a callable taking the frame bytes that
+    # never blocks: StreamWriter.write for the asyncio engine, the outbox of a QueuedSession
+    # for the threaded one. Events are pushed from whatever thread changed the room, so a
+    # client that stops reading is dropped (abort closes its connection) rather than making
+    # that thread wait; buffered returns the bytes written but not yet sent.
+
+    def __init__(self, write, address, abort=None, buffered=None):
+        self.write = write
+        self.address = address
+        self.abort = abort
+        self.buffered = buffered
+        self.tokens = set()
+        self.closed = False
+
+    def send(self, message):
+        if self.closed:
+            return
+        if self.buffered is not None and self.buffered() > MAX_BUFFERED:
+            self.drop("client is not reading")
+            return
+        try:
+            self.write(encode_frame(message))
+        except OSError as e:
+            self.drop(e)
+
+    def drop(self, reason):
+        if self.closed:
+            return
+        log.info("Dropping control session %s: %s", self.address, reason)
+        self.closed = True
+        if STATS.enabled:
+            STATS.inc("control_sessions_dropped")
+        if self.abort is not None:
+            try:
+                self.abort()
+            except OSError:
+                pass
+
+class QueuedSession(Session):
+    # Control session on a blocking socket (threaded engine). Frames go to a bounded outbox
+    # that a writer thread of the session drains with sendall(), so send() never blocks;
+    # a full outbox drops the session and shuts the socket down, which ends its reader.
+
+    def __init__(self, sock, address, outbox_size=OUTBOX_SIZE):
+        super().__init__(self._enqueue, address, abort=lambda: sock.shutdown(socket.SHUT_RDWR))
+        self.sock = sock
+        self._outbox = queue.Queue(outbox_size)
+        threading.Thread(target=self._drain, daemon=True).start()
+
+    def _enqueue(self, frame):
+        try:
+            self._outbox.put_nowait(frame)
+        except queue.Full:
+            self.drop("outbox full")
+
+    def _drain(self):
+        # Runs until the session is closed and its outbox is empty.
+        while True:
+            try:
+                frame = self._outbox.get(timeout=1.0)
+            except queue.Empty:
+                if self.closed:
+                    return
+                continue
+            try:
+                self.sock.sendall(frame)
+            except OSError as e:
+                self.drop(e)
+                return
+
+class SessionRegistry:
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def bind(self, token, session):
+        with self._lock:
+            self._sessions[token] = session
+            session.tokens.add(token)
+
+    def unbind(self, token):
+        with self._lock:
+            session = self._sessions.pop(token, None)
+            if session is not None:
+                session.tokens.discard(token)
+
+    def get(self, token):
+        return self._sessions.get(token)
+
+    def forget(self, session):
+        session.closed = True
+        with self._lock:
+            for token in session.tokens:
+                if self._sessions.get(token) is session:
+                    del self._sessions[token]
+            session.tokens.clear()
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def push(self, tokens, event, exclude=None):
+        # Sends an event to the sessions owning any of the given tokens, once per session.
+        if not self._sessions:
+            return
+        notified = set()
+        for token in tokens:
+            session = self._sessions.get(token)
+            if session is not None and session is not exclude and id(session) not in notified:
+                notified.add(id(session))
+                session.send(event)
+
+SESSIONS = SessionRegistry()
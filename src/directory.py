@@ -0,0 +1,114 @@
+"""
+Room directory: listing and prefix search of the rooms.
+
+list_rooms used to build the whole room list on every request, which with tens of thousands
+of rooms means a large response and a scan of every room per request, and clients had no way
+to find a room without knowing its exact name. The RoomDirectory keeps the room names in a
+sorted list, maintained incrementally: the registry calls update() when a room is created or
+its membership changes and remove() when it closes (and in a cluster the federation does
+the same for rooms announced by other nodes). A new room is one bisect.insort, a membership
+change is a dict assignment, so the directory adds nothing per datagram.
+
+Names are ordered by their casefold()ed form, so a search for "chat" finds "Chat-Lobby".
+page() answers both list_rooms and search_rooms with keyset pagination: the cursor is the
+name of the last room of the previous page and the next page starts right after it with one
+bisect, so paging stays O(log n + limit) and consistent while rooms come and go.
+
+top() returns the rooms with the most members. Selecting them is a scan of every room, so
+the result is cached and recomputed at most every top_ttl seconds, and only if the
+directory changed since; a burst of top_rooms requests costs one scan.
+
+Classes:
+    RoomDirectory: Sorted index of room names with their member counts.
+Global Variables:
+    DEFAULT_LIMIT (int): Rooms per page when the request gives no limit.
+    MAX_LIMIT (int): Upper bound of the rooms per page.
+    TOP_SIZE (int): Rooms kept in the cached top rooms view.
+    TOP_TTL (float): Seconds the top rooms view may be stale.
+"""
+
+import bisect
+import heapq
+import threading
+import time
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+TOP_SIZE = 50
+TOP_TTL = 1.0
+
+class RoomDirectory:
+
+    def __init__(self, top_ttl=TOP_TTL):
+        self.top_ttl = top_ttl
+        # (name.casefold(), name) of every room, sorted
+        self._index = []
+        # name -> member count
+        self._members = {}
+        self._lock = threading.Lock()
+        # bumped on every change, so the top view knows whether it is outdated
+        self._version = 0
+        # (version, time.monotonic(), [(name, members), ...]) of the last top view
+        self._top = None
+
+    def __len__(self):
+        return len(self._members)
+
+    def update(self, room_name, members):
+        # Records the member count of a room, adding it to the index if it is new.
+        with self._lock:
+            if room_name not in self._members:
+                bisect.insort(self._index, (room_name.casefold(), room_name))
+            self._members[room_name] = members
+            self._version += 1
+
+    def remove(self, room_name):
+        with self._lock:
+            if self._members.pop(room_name, None) is None:
+                return
+            key = (room_name.casefold(), room_name)
+            index = bisect.bisect_left(self._index, key)
+            if index < len(self._index) and self._index[index] == key:
+                del self._index[index]
+            self._version += 1
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+            self._members.clear()
+            self._version += 1
+            self._top = None
+
+    def page(self, prefix="", cursor=None, limit=DEFAULT_LIMIT):
+        # Returns ([(name, members), ...], next_cursor) of at most limit rooms whose name starts
+        # with prefix (ignoring case), after the room named cursor. next_cursor is None on the
+        # last page.
+        limit = max(1, min(limit, MAX_LIMIT))
+        folded = prefix.casefold()
+        start = (folded, "")
+        if cursor is not None:
+            # cursor + "\0" is the smallest name after the cursor
+            start = max(start, (cursor.casefold(), cursor + "\0"))
+        with self._lock:
+            index = bisect.bisect_left(self._index, start)
+            rooms = []
+            for key, name in self._index[index:index + limit + 1]:
+                if not key.startswith(folded):
+                    break
+                rooms.append((name, self._members[name]))
+        if len(rooms) > limit:
+            del rooms[limit:]
+            return rooms, rooms[-1][0]
+        return rooms, None
+
+    def top(self, limit=TOP_SIZE, now=None):
+        # Returns up to limit (at most TOP_SIZE) rooms with the most members, largest first.
+        now = time.monotonic() if now is None else now
+        top = self._top
+        if top is None or (top[0] != self._version and now - top[1] >= self.top_ttl):
+            with self._lock:
+                version = self._version
+                members = self._members
+                rooms = heapq.nlargest(TOP_SIZE, members.items(), key=lambda item: item[1])
+            self._top = top = (version, now, rooms)
+        return top[2][:max(0, min(limit, TOP_SIZE))]
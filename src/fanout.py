@@ -0,0 +1,253 @@
+"""
+Broadcast fan-out helpers for the chat server.
+
+A broadcast payload is serialized once with encode() and the same bytes object is sent
+to every recipient with send_to_all(). When batched sending is enabled and the platform
+provides sendmmsg(2) (Linux), the whole fan-out is handed to the kernel in one syscall;
+otherwise, or for objects that are not real sockets (asyncio transports, mocks), it falls
+back to one sendto() per recipient. Senders that queue datagrams instead of sending them
+(pipeline.QueueSender) provide send_all(data, addresses) and get the whole fan-out at once.
+
+broadcast_message() and broadcast_system() fan a room event out to a Room from the
+registry: members using JSON and members using the binary protocol each get one encoding,
+built only if the room has members in that format. deliver() sends it: members that
+negotiated compression get it compressed once per format (see compression.py; the CPU time
+is recorded as compress_us and the egress saved as compression_bytes_saved), and members with
+reliable delivery get it wrapped with their own sequence number (see reliable.py). A
+delivery larger than fragments.FRAGMENT_SIZE is split once, after compression, and the same
+fragments go to every member that negotiated fragmentation (see fragments.py); members that
+did not are skipped for deliveries above fragments.MAX_DATAGRAM_SIZE (oversize_dropped).
+
+Functions:
+    encode(payload): Serializes a response dict to UTF-8 JSON bytes.
+    send_to_all(sock, data, addresses): Sends the same bytes to every address.
+    broadcast_message(sock, room, sender, message): Delivers a chat message to a room.
+    broadcast_system(sock, room, text): Delivers a system message to a room.
+    deliver(sock, room, json_data, binary_data): Sends an encoded delivery to every member of a room.
+    compress(data, recipients): Compresses a delivery for the members that negotiated it.
+    send_fragmented(sock, data, addresses, fragmenting): send_to_all() that splits large data
+        for the addresses in fragmenting.
+    set_batched_send(enabled): Turns the sendmmsg path on or off.
+    sendmmsg_available(): Whether sendmmsg could be loaded on this platform.
+Global Variables:
+    BATCHED_SEND (bool): Whether send_to_all() tries sendmmsg first.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import socket
+import sys
+import time
+
+import compression
+import fragments
+import protocol
+import reliable
+from metrics import STATS
+
+BATCHED_SEND = False
+
+# Linux caps a single sendmmsg call at UIO_MAXIOV messages
+MAX_BATCH = 1024
+
+def encode(payload):
+    # Serializes a response once so the bytes can be reused for every recipient.
+    return json.dumps(payload).encode('utf-8')
+
+def set_batched_send(enabled):
+    global BATCHED_SEND
+    BATCHED_SEND = bool(enabled) and sendmmsg_available()
+    return BATCHED_SEND
+
+def send_to_all(sock, data, addresses):
+    # Sends data to every (ip, port) in addresses. Returns the number of datagrams sent.
+    if not addresses:
+        return 0
+    if BATCHED_SEND and len(addresses) > 1 and isinstance(sock, socket.socket):
+        sent = _sendmmsg(sock, data, addresses)
+        if sent is not None:
+            # sendmmsg may stop early on a full send buffer; finish the rest one by one
+            for address in addresses[sent:]:
+                sock.sendto(data, address)
+            return len(addresses)
+    elif not isinstance(sock, socket.socket):
+        # looked up on the class, so mocks and transports without it keep the loop below
+        send_all = getattr(type(sock), "send_all", None)
+        if send_all is not None:
+            return send_all(sock, data, addresses)
+    for address in addresses:
+        sock.sendto(data, address)
+    return len(addresses)
+
+def broadcast_message(sock, room, sender, message):
+    # message is a str (JSON senders) or a bytes/memoryview payload (binary senders).
+    # Returns the number of datagrams sent.
+    json_data = binary_data = None
+    if room.json_addresses or room.compressed_json_addresses or room.reliable_members:
+        text = message if isinstance(message, str) else str(message, 'utf-8')
+        response = {
+            "status": "success",
+            "sender": sender,
+            "message": text
+        }
+        json_data = encode(response)
+    if room.binary_addresses or room.compressed_binary_addresses or room.reliable_members:
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+        binary_data = protocol.encode_message(sender, payload)
+    return deliver(sock, room, json_data, binary_data)
+
+def broadcast_system(sock, room, text):
+    json_data = binary_data = None
+    if room.json_addresses or room.compressed_json_addresses or room.reliable_members:
+        response = {
+            "status": "success",
+            "system_message": text
+        }
+        json_data = encode(response)
+    if room.binary_addresses or room.compressed_binary_addresses or room.reliable_members:
+        binary_data = protocol.encode_system(text)
+    return deliver(sock, room, json_data, binary_data)
+
+def deliver(sock, room, json_data, binary_data):
+    # Sends a delivery, encoded once per wire format, to every member of a room. Members that
+    # negotiated compression get it compressed once per format; reliable members get it
+    # wrapped with their own sequence number, and the windows keep the shared bytes for
+    # retransmission. Returns the number of datagrams sent.
+    fragmenting = room.fragment_addresses
+    sent = send_fragmented(sock, json_data, room.json_addresses, fragmenting) \
+        + send_fragmented(sock, binary_data, room.binary_addresses, fragmenting)
+    compressed_json = compressed_binary = None
+    if room.compressed_json_addresses:
+        compressed_json = compress(json_data, len(room.compressed_json_addresses))
+        sent += send_fragmented(sock, compressed_json, room.compressed_json_addresses, fragmenting)
+    if room.compressed_binary_addresses:
+        compressed_binary = compress(binary_data, len(room.compressed_binary_addresses))
+        sent += send_fragmented(sock, compressed_binary, room.compressed_binary_addresses, fragmenting)
+    members = room.reliable_members
+    if members:
+        now = time.monotonic()
+        for member in members:
+            if not member.compressed:
+                datagram = binary_data if member.binary else json_data
+            elif member.binary:
+                compressed_binary = compressed_binary or compress(binary_data, 1)
+                datagram = compressed_binary
+            else:
+                compressed_json = compressed_json or compress(json_data, 1)
+                datagram = compressed_json
+            reliable.send(sock, member, datagram, now)
+        sent += len(members)
+    return sent
+
+def send_fragmented(sock, data, addresses, fragmenting):
+    # send_to_all(), except that data larger than a fragment is split once and the addresses
+    # in fragmenting get the fragments. The other addresses cannot receive more than
+    # fragments.MAX_DATAGRAM_SIZE and are skipped for larger data. Returns the number of
+    # recipients sent to.
+    if not addresses or len(data) <= fragments.FRAGMENT_SIZE:
+        return send_to_all(sock, data, addresses)
+    if fragmenting:
+        split = tuple(address for address in addresses if address in fragmenting)
+        whole = tuple(address for address in addresses if address not in fragmenting) \
+            if len(split) < len(addresses) else ()
+    else:
+        split, whole = (), addresses
+    sent = len(split)
+    if whole:
+        if len(data) <= fragments.MAX_DATAGRAM_SIZE:
+            sent += send_to_all(sock, data, whole)
+        elif STATS.enabled:
+            STATS.inc("oversize_dropped", len(whole))
+    if split:
+        for fragment in fragments.split(data):
+            send_to_all(sock, fragment, split)
+        if STATS.enabled:
+            STATS.inc("fragmented_deliveries")
+    return sent
+
+def compress(data, recipients):
+    # The compressed delivery of data (data itself if compressing does not pay off), with
+    # its CPU time and the egress saved for recipients members recorded when metrics are on.
+    if not STATS.enabled:
+        return compression.wrap(data)
+    started = time.perf_counter_ns()
+    compressed = compression.wrap(data)
+    if compressed is not data:
+        STATS.observe("compress_us", (time.perf_counter_ns() - started) // 1000)
+        STATS.inc("compression_bytes_saved", (len(data) - len(compressed)) * recipients)
+    return compressed
+
+# sendmmsg(2) through ctypes. Only IPv4 destinations are batched.
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),
+        ("sin_addr", ctypes.c_ubyte * 4),
+        ("sin_zero", ctypes.c_ubyte * 8),
+    ]
+
+_libc_sendmmsg = None
+_loaded = False
+
+def sendmmsg_available():
+    global _libc_sendmmsg, _loaded
+    if not _loaded:
+        _loaded = True
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+                _libc_sendmmsg = libc.sendmmsg
+                _libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+                _libc_sendmmsg.restype = ctypes.c_int
+            except (OSError, AttributeError):
+                _libc_sendmmsg = None
+    return _libc_sendmmsg is not None
+
+def _sockaddr(address):
+    addr = _sockaddr_in()
+    addr.sin_family = socket.AF_INET
+    addr.sin_port = socket.htons(address[1])
+    addr.sin_addr[:] = list(socket.inet_aton(address[0]))
+    return addr
+
+def _sendmmsg(sock, data, addresses):
+    # Returns how many datagrams the kernel accepted, or None if the batch could not be used.
+    if not sendmmsg_available() or sock.family != socket.AF_INET:
+        return None
+    try:
+        names = [_sockaddr(address) for address in addresses[:MAX_BATCH]]
+    except (OSError, TypeError):
+        return None
+
+    buffer = ctypes.create_string_buffer(data, len(data))
+    iov = _iovec(ctypes.cast(buffer, ctypes.c_void_p), len(data))
+    messages = (_mmsghdr * len(names))()
+    for message, name in zip(messages, names):
+        message.msg_hdr.msg_name = ctypes.cast(ctypes.pointer(name), ctypes.c_void_p)
+        message.msg_hdr.msg_namelen = ctypes.sizeof(name)
+        message.msg_hdr.msg_iov = ctypes.pointer(iov)
+        message.msg_hdr.msg_iovlen = 1
+
+    sent = _libc_sendmmsg(sock.fileno(), messages, len(names), 0)
+    if sent < 0:
+        return None
+    return sent
@@ -0,0 +1,390 @@
+"""
+Cross-node room federation for the chat server.
+
+`python server.py --cluster a,b,c --node-id a --broker 127.0.0.1:7001` runs one node of a
+cluster. Every room is owned by exactly one node, chosen by consistent hashing of its name
+(HashRing), and lives only in that node's registry. Clients may talk to any node:
+
+- TCP create_room/join_room/leave requests for a room owned elsewhere are forwarded to the
+  owner, which answers through the origin node.
+- UDP datagrams for a room owned elsewhere are forwarded to the owner together with the
+  client's address and the node they arrived at.
+- The owner fans out as usual through a RelaySender: recipients whose datagrams arrived at
+  another node are relayed to that node, once per node and broadcast, and sent from its UDP
+  socket, so every client keeps hearing from the node it talks to.
+- Owners announce the member count of their rooms, so the room directory (list_rooms,
+  search_rooms, top_rooms) covers the whole cluster.
+
+Nodes talk through a pub/sub Broker with one channel per node ("node.<id>") plus "rooms"
+for announcements. LocalBroker delivers in-process (tests, several nodes in one process);
+LoopbackBroker talks to a small UDP broker (`python federation.py --port 7001`) and stands
+in for a real message bus between processes on one machine. Any object with the same
+subscribe/publish methods can be plugged in.
+
+Messages between nodes start with a type byte:
+    T request forwarded to the owner      JSON {"id", "origin", "request", "address"}
+    R response to a forwarded request     JSON {"id", "response"}
+    M room announcement                   JSON {"node", "room", "members"}
+    U client datagram for the owner       ip (4) | port (2) | origin length (1) | origin | datagram
+    D datagrams to send from a node       count (2) | count x (ip (4) | port (2)) | datagram
+
+Classes:
+    HashRing: Consistent hash ring mapping room names to nodes.
+    LocalBroker: In-process pub/sub.
+    LoopbackBroker: Pub/sub client for the UDP loopback broker.
+    BrokerServer: The UDP loopback broker.
+    RelaySender: Socket stand-in that relays datagrams for remote members to their node.
+    Federation: One node of the cluster.
+"""
+
+import argparse
+import bisect
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import socket
+import struct
+import threading
+
+from workers import peek_room_name
+
+log = logging.getLogger("chat.federation")
+
+ROOMS_CHANNEL = "rooms"
+REQUEST_TIMEOUT = 5.0
+# client routes a RelaySender keeps before evicting the least recently used
+MAX_ROUTES = 65536
+
+ADDRESS = struct.Struct("!4sH")
+DATAGRAM_HEADER = struct.Struct("!4sHB")
+COUNT = struct.Struct("!H")
+
+def node_channel(node_id):
+    return f"node.{node_id}"
+
+class HashRing:
+    # Each node gets `replicas` points on the ring; a key belongs to the next point clockwise.
+    # Adding or removing a node only moves the rooms adjacent to its points.
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = list(nodes)
+        points = []
+        for node in self.nodes:
+            for replica in range(replicas):
+                points.append((self._hash(f"{node}#{replica}"), node))
+        points.sort()
+        self._keys = [key for key, _ in points]
+        self._owners = [owner for _, owner in points]
+
+    @staticmethod
+    def _hash(value):
+        # md5 is stable across processes and spreads short names evenly
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], "big")
+
+    def owner(self, key):
+        index = bisect.bisect(self._keys, self._hash(key))
+        return self._owners[index % len(self._owners)]
+
+class LocalBroker:
+    # Delivers every message synchronously to the subscribers in this process.
+
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, channel, callback):
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def publish(self, channel, message):
+        for callback in self._subscribers.get(channel, ()):
+            callback(message)
+
+    def close(self):
+        self._subscribers.clear()
+
+# Loopback broker wire format: op (1 byte) | channel length (1 byte) | channel | payload
+# op S subscribes the sender to the channel, op P publishes the payload on it.
+BROKER_HEADER = struct.Struct("!cB")
+
+def _broker_packet(op, channel, payload=b""):
+    channel_bytes = channel.encode('utf-8')
+    return BROKER_HEADER.pack(op, len(channel_bytes)) + channel_bytes + payload
+
+def _parse_broker_packet(packet):
+    op, length = BROKER_HEADER.unpack_from(packet)
+    start = BROKER_HEADER.size
+    return op, packet[start:start + length].decode('utf-8'), packet[start + length:]
+
+class BrokerServer:
+    # Relays every published datagram to the subscribers of its channel.
+
+    def __init__(self, host="127.0.0.1", port=7001):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.subscribers = {}
+
+    def serve_forever(self):
+        while True:
+            try:
+                packet, address = self.sock.recvfrom(65535)
+                op, channel, _ = _parse_broker_packet(packet)
+            except OSError:
+                break
+            except (ValueError, struct.error):
+                continue
+            if op == b"S":
+                self.subscribers.setdefault(channel, set()).add(address)
+            elif op == b"P":
+                for subscriber in self.subscribers.get(channel, ()):
+                    self.sock.sendto(packet, subscriber)
+
+    def close(self):
+        self.sock.close()
+
+class LoopbackBroker:
+    # Client of a BrokerServer. Callbacks run on the receiver thread.
+
+    RESUBSCRIBE_INTERVAL = 5.0
+
+    def __init__(self, host="127.0.0.1", port=7001):
+        self.broker_address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(self.RESUBSCRIBE_INTERVAL)
+        self._subscribers = {}
+        self._closed = False
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def subscribe(self, channel, callback):
+        self._subscribers.setdefault(channel, []).append(callback)
+        self.sock.sendto(_broker_packet(b"S", channel), self.broker_address)
+
+    def publish(self, channel, message):
+        self.sock.sendto(_broker_packet(b"P", channel, message), self.broker_address)
+
+    def _receive(self):
+        while not self._closed:
+            try:
+                packet, _ = self.sock.recvfrom(65535)
+            except socket.timeout:
+                # subscriptions are soft state; renew them in case the broker restarted
+                for channel in list(self._subscribers):
+                    self.sock.sendto(_broker_packet(b"S", channel), self.broker_address)
+                continue
+            except OSError:
+                break
+            try:
+                op, channel, payload = _parse_broker_packet(packet)
+                for callback in self._subscribers.get(channel, ()):
+                    callback(payload)
+            except Exception as e:
+                log.warning("Error handling broker message: %s", e)
+
+    def close(self):
+        self._closed = True
+        self.sock.close()
+
+class RelaySender:
+    # Passed to the fan-out in place of the UDP socket. Addresses of clients that talk to
+    # another node are relayed there; inside batch(), all datagrams of one broadcast for the
+    # same node go out as a single relay message.
+
+    def __init__(self, sock, node_id, publish, max_routes=MAX_ROUTES):
+        self.sock = sock
+        self.node_id = node_id
+        self.publish = publish
+        self.max_routes = max_routes
+        # client address -> node it talks to, for clients of other nodes, least recently
+        # heard from first; clients that went away without leaving are evicted beyond max_routes
+        self.routes = collections.OrderedDict()
+        self._routes_lock = threading.Lock()
+        self._local = threading.local()
+
+    def route(self, address, node):
+        # Records that a client talks to another node.
+        with self._routes_lock:
+            self.routes[address] = node
+            self.routes.move_to_end(address)
+            while len(self.routes) > self.max_routes:
+                self.routes.popitem(last=False)
+
+    def unroute(self, address):
+        # Records that a client talks to this node.
+        with self._routes_lock:
+            self.routes.pop(address, None)
+
+    def sendto(self, data, address):
+        node = self.routes.get(address)
+        if node is None:
+            return self.sock.sendto(data, address)
+        pending = getattr(self._local, "pending", None)
+        if pending is None:
+            self._relay(node, data, [address])
+        else:
+            key = (node, id(data))
+            if key not in pending:
+                pending[key] = (data, [])
+            pending[key][1].append(address)
+        return len(data)
+
+    @contextlib.contextmanager
+    def batch(self):
+        self._local.pending = {}
+        try:
+            yield self
+        finally:
+            pending, self._local.pending = self._local.pending, None
+            for (node, _), (data, addresses) in pending.items():
+                self._relay(node, data, addresses)
+
+    def _relay(self, node, data, addresses):
+        header = COUNT.pack(len(addresses)) + b"".join(
+            ADDRESS.pack(socket.inet_aton(ip), port) for ip, port in addresses
+        )
+        self.publish(node_channel(node), b"D" + header + bytes(data))
+
+class Federation:
+
+    def __init__(self, node_id, nodes, broker, process_request, process_datagram):
+        if node_id not in nodes:
+            raise ValueError(f"Node {node_id} is not part of the cluster {nodes}.")
+        self.node_id = node_id
+        self.ring = HashRing(nodes)
+        self.broker = broker
+        # process_request(request, address) -> response dict, for rooms owned here
+        self.process_request = process_request
+        # process_datagram(sender, data, address), for rooms owned here
+        self.process_datagram = process_datagram
+        self.sender = None
+        # room name -> (owner node, member count) announced by other nodes
+        self.remote_rooms = {}
+        # directory.RoomDirectory the announced rooms are added to, if any
+        self.directory = None
+        self._ids = itertools.count(1)
+        self._waiting = {}
+        self._condition = threading.Condition()
+
+    def attach(self, sock):
+        # Starts serving with the node's UDP socket; returns the sender to fan out with.
+        self.sender = RelaySender(sock, self.node_id, self.broker.publish)
+        self.broker.subscribe(node_channel(self.node_id), self.handle_message)
+        self.broker.subscribe(ROOMS_CHANNEL, self.handle_announcement)
+        return self.sender
+
+    def owner(self, room_name):
+        return self.ring.owner(room_name)
+
+    def is_local(self, room_name):
+        return self.ring.owner(room_name) == self.node_id
+
+    # TCP requests
+
+    def forward_request(self, request, address):
+        # Sends a request to the owner of its room and waits for the response.
+        request_id = next(self._ids)
+        message = {"id": request_id, "origin": self.node_id, "request": request, "address": list(address)}
+        with self._condition:
+            self._waiting[request_id] = None
+        try:
+            self.broker.publish(node_channel(self.owner(request["room_name"])), b"T" + json.dumps(message).encode('utf-8'))
+            with self._condition:
+                if not self._condition.wait_for(lambda: self._waiting[request_id] is not None, REQUEST_TIMEOUT):
+                    return {"status": "error", "message": "Owner node unavailable."}
+                return self._waiting[request_id]
+        finally:
+            with self._condition:
+                self._waiting.pop(request_id, None)
+
+    def _answer_request(self, message):
+        response = self.process_request(message["request"], tuple(message["address"]))
+        reply = {"id": message["id"], "response": response}
+        self.broker.publish(node_channel(message["origin"]), b"R" + json.dumps(reply).encode('utf-8'))
+
+    def _receive_response(self, message):
+        with self._condition:
+            if message["id"] in self._waiting:
+                self._waiting[message["id"]] = message["response"]
+                self._condition.notify_all()
+
+    # Room directory
+
+    def announce(self, room_name, members):
+        # Tells the cluster how many members a room owned here has (0 once it is closed).
+        message = {"node": self.node_id, "room": room_name, "members": members}
+        self.broker.publish(ROOMS_CHANNEL, b"M" + json.dumps(message).encode('utf-8'))
+
+    def handle_announcement(self, payload):
+        message = json.loads(payload[1:].decode('utf-8'))
+        if message["node"] == self.node_id:
+            return
+        if message["members"]:
+            self.remote_rooms[message["room"]] = (message["node"], message["members"])
+            if self.directory is not None:
+                self.directory.update(message["room"], message["members"])
+        else:
+            self.remote_rooms.pop(message["room"], None)
+            if self.directory is not None:
+                self.directory.remove(message["room"])
+
+    # UDP
+
+    def handle_datagram(self, data, address):
+        # Handles a datagram received from a client, forwarding it if another node owns the room.
+        room_name = peek_room_name(data)
+        owner = self.owner(room_name) if isinstance(room_name, str) else self.node_id
+        if owner == self.node_id:
+            self.sender.unroute(address)
+            with self.sender.batch():
+                self.process_datagram(self.sender, data, address)
+        else:
+            origin = self.node_id.encode('utf-8')
+            header = DATAGRAM_HEADER.pack(socket.inet_aton(address[0]), address[1], len(origin)) + origin
+            self.broker.publish(node_channel(owner), b"U" + header + bytes(data))
+
+    def _receive_datagram(self, payload):
+        ip, port, origin_length = DATAGRAM_HEADER.unpack_from(payload)
+        start = DATAGRAM_HEADER.size
+        origin = payload[start:start + origin_length].decode('utf-8')
+        address = (socket.inet_ntoa(ip), port)
+        self.sender.route(address, origin)
+        with self.sender.batch():
+            self.process_datagram(self.sender, payload[start + origin_length:], address)
+
+    def _deliver(self, payload):
+        (count,) = COUNT.unpack_from(payload)
+        start = COUNT.size + count * ADDRESS.size
+        data = payload[start:]
+        for index in range(count):
+            ip, port = ADDRESS.unpack_from(payload, COUNT.size + index * ADDRESS.size)
+            self.sender.sock.sendto(data, (socket.inet_ntoa(ip), port))
+
+    def handle_message(self, message):
+        kind, payload = message[:1], message[1:]
+        if kind == b"U":
+            self._receive_datagram(payload)
+        elif kind == b"D":
+            self._deliver(payload)
+        elif kind == b"T":
+            # answered on a thread: the broker's receiver must stay free for the response path
+            threading.Thread(target=self._answer_request, args=(json.loads(payload.decode('utf-8')),), daemon=True).start()
+        elif kind == b"R":
+            self._receive_response(json.loads(payload.decode('utf-8')))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Loopback pub/sub broker for chat server clusters")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7001)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    broker = BrokerServer(args.host, args.port)
+    log.info("Broker is running on UDP:%d", broker.address[1])
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Fragmentation and reassembly of datagrams larger than one MTU.
+
+Both sides read datagrams into BUFFER_SIZE (4096) bytes, so a larger datagram used to be
+truncated by recvfrom() and then failed to decode, and anything above ~1.2 KB was already
+left to IP fragmentation, where losing any one IP fragment loses the whole datagram and
+some paths drop IP fragments altogether. A client that sends "fragments": true with
+create_room/join_room (and is confirmed with "fragment_size") sends and receives every
+datagram larger than FRAGMENT_SIZE as a series of fragments (protocol.OP_FRAGMENT):
+
+    magic (1 byte) | OP_FRAGMENT (1 byte) | message id (4 bytes) | index (2 bytes)
+    | count (2 bytes) | chunk
+
+FRAGMENT_SIZE keeps every fragment within the IPv6 minimum MTU, so pasted logs and code
+blocks travel as ordinary datagrams. The fragmented datagram is whatever would have been
+sent whole: a request or delivery, compressed (see compression.py) or wrapped for reliable
+delivery (see reliable.py), so retransmission resends every fragment of a lost datagram.
+A broadcast is fragmented once and the same fragments go to every member that negotiated
+fragmentation (see fanout.py). A reassembled message can be far larger than what a member
+without fragmentation can receive (MAX_DATAGRAM_SIZE), so those members are skipped for
+such a delivery and counted as oversize_dropped, while the rest of the room still gets it.
+
+A Reassembler collects the fragments per (source, message id) and returns the datagram
+once every fragment arrived, in any order. Its memory is bounded three ways. A message may
+not exceed max_size bytes, and a fragment whose count is more than max_size bytes take in
+FRAGMENT_SIZE fragments is dropped before anything is allocated for it (fragments_rejected);
+parts are kept by index as they arrive, so an incomplete message holds only what was
+received. An incomplete message is dropped timeout seconds after its first fragment
+(fragments_expired), and beyond max_pending messages or max_bytes buffered the oldest
+incomplete message is evicted (fragments_evicted). Completed messages are counted as
+fragments_reassembled.
+
+Classes:
+    Reassembler: Bounded reassembly buffer.
+Functions:
+    split(data, size): The fragments of a datagram (the datagram itself if it fits).
+    sendto(sock, data, address): Sends a datagram to one address, in fragments if needed.
+Global Variables:
+    FRAGMENT_SIZE (int): Largest datagram sent whole, and the size of every fragment.
+    MAX_DATAGRAM_SIZE (int): Largest datagram sent to a member that does not use fragments.
+    MAX_MESSAGE_SIZE (int): Default upper bound of a reassembled datagram.
+    MAX_PENDING (int): Default number of incomplete messages kept.
+    MAX_BUFFERED (int): Default bytes of incomplete messages kept.
+    REASSEMBLY_TIMEOUT (float): Default seconds an incomplete message is kept.
+"""
+
+import collections
+import itertools
+import threading
+
+import protocol
+from metrics import STATS
+
+# 1280 bytes of IPv6 minimum MTU, less 40 bytes of IPv6 and 8 of UDP header, with some room
+FRAGMENT_SIZE = 1200
+# the receive buffer of clients; a member that does not use fragments gets nothing larger
+MAX_DATAGRAM_SIZE = 4096
+MAX_MESSAGE_SIZE = 64 * 1024
+MAX_PENDING = 1024
+MAX_BUFFERED = 8 * 1024 * 1024
+REASSEMBLY_TIMEOUT = 5.0
+
+# message ids of this process; a receiver tells senders apart by their address
+_message_ids = itertools.count(1)
+
+def split(data, size=FRAGMENT_SIZE):
+    if len(data) <= size:
+        return [data]
+    chunk = size - protocol.FRAGMENT_HEADER.size
+    count = -(-len(data) // chunk)
+    if count > 0xFFFF:
+        raise ValueError("Datagram too large to fragment.")
+    message_id = next(_message_ids) & 0xFFFFFFFF
+    view = memoryview(data)
+    return [protocol.encode_fragment(message_id, index, count, view[index * chunk:(index + 1) * chunk])
+            for index in range(count)]
+
+def sendto(sock, data, address):
+    for fragment in split(data):
+        sock.sendto(fragment, address)
+
+class _Partial:
+    __slots__ = ("count", "parts", "size", "deadline")
+
+    def __init__(self, count, deadline):
+        self.count = count
+        # index -> chunk; the count comes from the peer, so no slots are allocated up front
+        self.parts = {}
+        self.size = 0
+        self.deadline = deadline
+
+class Reassembler:
+
+    def __init__(self, max_size=MAX_MESSAGE_SIZE, max_pending=MAX_PENDING, max_bytes=MAX_BUFFERED,
+                 timeout=REASSEMBLY_TIMEOUT):
+        self.max_size = max_size
+        self.max_pending = max_pending
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        # the most fragments a message within max_size can take
+        self.max_fragments = -(-max_size // (FRAGMENT_SIZE - protocol.FRAGMENT_HEADER.size))
+        # (source, message id) -> _Partial, oldest first
+        self._pending = collections.OrderedDict()
+        # bytes held by incomplete messages
+        self.buffered = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, source, data, now):
+        # Takes a fragment from source. Returns the whole datagram once its last fragment
+        # arrived, else None. Raises ValueError for a malformed fragment.
+        message_id, index, count, chunk = protocol.decode_fragment(data)
+        if index >= count:
+            raise ValueError("Fragment index out of range.")
+        if count == 1:
+            return bytes(chunk)
+        if count > self.max_fragments:
+            if STATS.enabled:
+                STATS.inc("fragments_rejected")
+            return None
+        key = (source, message_id)
+        with self._lock:
+            self._expire(now)
+            partial = self._pending.get(key)
+            if partial is None:
+                partial = self._pending[key] = _Partial(count, now + self.timeout)
+            elif partial.count != count:
+                self._drop(key, "fragments_rejected")
+                return None
+            if index in partial.parts:
+                return None
+            if partial.size + len(chunk) > self.max_size:
+                self._drop(key, "fragments_rejected")
+                return None
+            partial.parts[index] = bytes(chunk)
+            partial.size += len(chunk)
+            self.buffered += len(chunk)
+            if len(partial.parts) == count:
+                del self._pending[key]
+                self.buffered -= partial.size
+                if STATS.enabled:
+                    STATS.inc("fragments_reassembled")
+                parts = partial.parts
+                return b"".join(parts[index] for index in range(count))
+            while len(self._pending) > self.max_pending or self.buffered > self.max_bytes:
+                self._drop(next(iter(self._pending)), "fragments_evicted")
+        return None
+
+    def expire(self, now):
+        # Drops the incomplete messages whose timeout passed. add() does this as it goes.
+        with self._lock:
+            self._expire(now)
+
+    def _expire(self, now):
+        # deadlines grow with insertion order, so the expired messages are at the front
+        pending = self._pending
+        while pending:
+            key = next(iter(pending))
+            if pending[key].deadline > now:
+                break
+            self._drop(key, "fragments_expired")
+
+    def _drop(self, key, counter):
+        partial = self._pending.pop(key)
+        self.buffered -= partial.size
+        if STATS.enabled:
+            STATS.inc(counter)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self.buffered = 0
@@ -0,0 +1,165 @@
+"""
+Bounded per-room message history for the chat server.
+
+Nothing used to be kept once a message had been broadcast, so a member joining a room saw
+none of the earlier conversation. Every room now gets a ring buffer of its most recent
+messages, preallocated to a fixed capacity when the room's first message arrives, and the
+join_room response carries the buffered messages in one batch.
+
+Memory is bounded twice: per room by the ring capacity (the oldest message is overwritten)
+and globally by max_bytes, an estimate of the memory held by all rooms. When the global cap
+is exceeded the oldest messages of the whole server are evicted first, whichever room they
+belong to, so quiet rooms keep their history while a busy room cannot take it all.
+
+Appends are serialized by a lock: they come from the UDP path, while snapshots for join
+responses come from TCP handler threads.
+
+Classes:
+    RoomHistory: Fixed-capacity ring buffer of one room's messages.
+    MessageHistory: The rings of all rooms with the global memory cap and eviction.
+Global Variables:
+    DEFAULT_CAPACITY (int): Messages kept per room.
+    DEFAULT_MAX_BYTES (int): Global memory cap in bytes.
+    ENTRY_OVERHEAD (int): Bytes accounted per message on top of its text.
+"""
+
+import collections
+import threading
+import time
+
+DEFAULT_CAPACITY = 100
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+# rough size of an entry tuple, its float and two str headers
+ENTRY_OVERHEAD = 160
+
+class RoomHistory:
+    # entries[(start + i) % capacity] is the i-th oldest message, for i < count.
+    # Messages are numbered in append order; start_seq is the number of the oldest one.
+    __slots__ = ("entries", "sizes", "start", "count", "start_seq", "closed")
+
+    def __init__(self, capacity):
+        # (timestamp, sender, message) tuples
+        self.entries = [None] * capacity
+        self.sizes = [0] * capacity
+        self.start = 0
+        self.count = 0
+        self.start_seq = 0
+        self.closed = False
+
+    def append(self, entry, size):
+        # Stores an entry and returns the size of the entry it overwrote (0 if none).
+        capacity = len(self.entries)
+        if self.count < capacity:
+            index = (self.start + self.count) % capacity
+            self.count += 1
+            freed = 0
+        else:
+            index = self.start
+            freed = self.sizes[index]
+            self.start = (self.start + 1) % capacity
+            self.start_seq += 1
+        self.entries[index] = entry
+        self.sizes[index] = size
+        return freed
+
+    def drop_oldest(self):
+        # Removes the oldest entry and returns its size.
+        index = self.start
+        size = self.sizes[index]
+        self.entries[index] = None
+        self.sizes[index] = 0
+        self.start = (self.start + 1) % len(self.entries)
+        self.start_seq += 1
+        self.count -= 1
+        return size
+
+    def end_seq(self):
+        return self.start_seq + self.count
+
+    def recent(self, limit=None):
+        # Returns the newest `limit` entries (all if None), oldest first.
+        count = self.count if limit is None else min(limit, self.count)
+        capacity = len(self.entries)
+        first = self.start + self.count - count
+        return [self.entries[(first + i) % capacity] for i in range(count)]
+
+class MessageHistory:
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, max_bytes=DEFAULT_MAX_BYTES):
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._total_bytes = 0
+        # (RoomHistory, seq) of every message in append order, for global eviction.
+        # Entries already overwritten by their ring are skipped when they come up.
+        self._order = collections.deque()
+        self.configure(capacity, max_bytes)
+
+    def configure(self, capacity=DEFAULT_CAPACITY, max_bytes=DEFAULT_MAX_BYTES):
+        # Sets the limits and drops the stored history. A capacity of 0 disables history.
+        with self._lock:
+            self.capacity = capacity
+            self.max_bytes = max_bytes
+            self._clear()
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._rooms.clear()
+        self._order.clear()
+        self._total_bytes = 0
+
+    def append(self, room_name, sender, message):
+        if self.capacity <= 0:
+            return
+        if not isinstance(message, str):
+            # binary datagrams carry the text as an undecoded payload (see protocol.py)
+            message = str(message, 'utf-8', 'replace')
+        entry = (time.time(), sender, message)
+        size = ENTRY_OVERHEAD + len(sender) + len(message)
+        with self._lock:
+            room = self._rooms.get(room_name)
+            if room is None:
+                room = self._rooms[room_name] = RoomHistory(self.capacity)
+            self._order.append((room, room.end_seq()))
+            self._total_bytes += size - room.append(entry, size)
+            self._evict()
+
+    def _evict(self):
+        order = self._order
+        while self._total_bytes > self.max_bytes and order:
+            room, seq = order.popleft()
+            if not room.closed and seq == room.start_seq and room.count:
+                self._total_bytes -= room.drop_oldest()
+        # Overwritten entries stay in the order until they reach the front; compact it
+        # when they outnumber the live ones so it stays proportional to the stored messages.
+        if len(order) > 2 * self.capacity * max(len(self._rooms), 1) + 1024:
+            self._order = collections.deque(
+                (room, seq) for room, seq in order if not room.closed and seq >= room.start_seq
+            )
+
+    def recent(self, room_name, limit=None):
+        # Returns the room's buffered messages as dicts, oldest first.
+        with self._lock:
+            room = self._rooms.get(room_name)
+            entries = room.recent(limit) if room is not None else []
+        return [
+            {"sender": sender, "message": message, "timestamp": timestamp}
+            for timestamp, sender, message in entries
+        ]
+
+    def drop_room(self, room_name):
+        with self._lock:
+            room = self._rooms.pop(room_name, None)
+            if room is not None:
+                room.closed = True
+                self._total_bytes -= sum(room.sizes)
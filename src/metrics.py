@@ -0,0 +1,193 @@
+"""
+Metrics and logging for the chat server.
+
+Replaces the per-packet print() calls of the UDP handler. Logging goes through the standard
+logging module: per-packet lines are DEBUG and guarded with isEnabledFor(), so they cost
+nothing at the default INFO level, and RateLimitFilter stops a flood of identical warnings
+(e.g. one per malformed datagram) from becoming the bottleneck itself.
+
+STATS collects counters and histograms for the UDP hot path:
+    packets_in.<operation>, packets_out.<operation>, decode_errors, unknown_tokens,
+    rate_limited.token and rate_limited.room (see ratelimit.py), members_timed_out,
+    compression_bytes_saved (see fanout.py), fanout_size, handler_latency_us and compress_us
+    histograms, and messages per room.
+Gauges are functions sampled when a snapshot is taken, e.g. the queue_depth.<queue> of the
+staged pipeline (see pipeline.py), whose drops are counted as queue_dropped.<queue>.
+Metrics are disabled by default; the handlers check STATS.enabled (one attribute read)
+before touching them. start_reporting() enables them and exposes snapshot() as JSON on a
+local HTTP endpoint (GET /stats) and/or logs it periodically.
+
+Classes:
+    RateLimitFilter: logging.Filter allowing a burst of records per message per interval.
+    Histogram: Power-of-two bucket histogram.
+    Metrics: Counters, histograms, gauges and per-room message counts.
+Functions:
+    configure_logging(level): Sets up the "chat" logger with rate limiting.
+    start_reporting(port, interval): Enables STATS and starts the endpoint and/or dumps.
+Global Variables:
+    STATS (Metrics): The metrics of this process.
+"""
+
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger("chat.metrics")
+
+class RateLimitFilter(logging.Filter):
+    # Lets `burst` records with the same message template through per `interval` seconds.
+    # The number of suppressed records is appended to the next record that gets through.
+
+    def __init__(self, burst=10, interval=1.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window_start, count, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - window_start >= self.interval:
+                window_start, count = now, 0
+            if count >= self.burst:
+                self._windows[key] = (window_start, count, suppressed + 1)
+                return False
+            self._windows[key] = (window_start, count + 1, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+def configure_logging(level="INFO"):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    handler.addFilter(RateLimitFilter())
+    logger = logging.getLogger("chat")
+    logger.handlers[:] = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+class Histogram:
+    # Bucket i counts values in [2**(i-1), 2**i); bucket 0 counts values below 1.
+    __slots__ = ("buckets", "count", "total")
+
+    def __init__(self):
+        self.buckets = [0] * 32
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        index = int(value).bit_length()
+        self.buckets[index if index < 32 else 31] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the given fraction of the samples.
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return 1 << index
+        return 1 << 31
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 2) if self.count else None,
+            "p50": self.percentile(0.50),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+        }
+
+class Metrics:
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+        # name -> function returning the current value
+        self.gauges = {}
+        # room name -> messages since the last snapshot
+        self.room_messages = {}
+        self._last_snapshot = self.started
+        self._lock = threading.Lock()
+
+    # Updates are plain dict operations without a lock: the UDP path runs on one thread
+    # (or one event loop) per process, and a lost increment from a TCP thread is acceptable.
+    def inc(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, function):
+        # Registers a value that is read only when a snapshot is taken; reset() keeps it.
+        self.gauges[name] = function
+
+    def room_message(self, room_name):
+        self.room_messages[room_name] = self.room_messages.get(room_name, 0) + 1
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+        self.room_messages.clear()
+
+    def snapshot(self, top_rooms=20):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._last_snapshot, 1e-9)
+            room_messages, self.room_messages = self.room_messages, {}
+            self._last_snapshot = now
+        busiest = sorted(room_messages.items(), key=lambda item: item[1], reverse=True)[:top_rooms]
+        return {
+            "uptime": round(now - self.started, 3),
+            "counters": dict(self.counters),
+            "histograms": {name: histogram.snapshot() for name, histogram in list(self.histograms.items())},
+            "gauges": {name: function() for name, function in list(self.gauges.items())},
+            "room_message_rate": {name: round(count / elapsed, 2) for name, count in busiest},
+        }
+
+STATS = Metrics()
+
+class _StatsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/stats":
+            self.send_error(404)
+            return
+        body = json.dumps(STATS.snapshot()).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def _dump_periodically(interval):
+    while True:
+        time.sleep(interval)
+        log.info("stats %s", json.dumps(STATS.snapshot()))
+
+def start_reporting(port=None, interval=None, host="127.0.0.1"):
+    # Enables metrics; serves them on http://host:port/stats and/or logs them every interval seconds.
+    STATS.enabled = True
+    if port:
+        httpd = ThreadingHTTPServer((host, port), _StatsRequestHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        log.info("Stats endpoint on http://%s:%d/stats", host, port)
+    if interval:
+        threading.Thread(target=_dump_periodically, args=(interval,), daemon=True).start()
@@ -0,0 +1,166 @@
+"""
+Password-protected rooms.
+
+A room created with a "password" stores only an scrypt hash of it; join_room has to present
+the same password. scrypt is memory hard (128 * n * r bytes per hash, 16 MiB with the
+defaults), which is what makes a leaked hash expensive to brute force, but it also costs
+tens of milliseconds of CPU per create or join. Hashing therefore never runs on the thread
+that asked for it: a PasswordHasher runs it on a small pool of worker threads (hashlib.scrypt
+releases the GIL) and hands back a concurrent.futures.Future. The threaded engine waits on
+the future in the connection's own thread, the asyncio engine awaits it, so neither the
+accept loop nor the event loop stalls during a join storm.
+
+The pool is bounded twice: `workers` threads hash at a time, which caps the memory taken by
+scrypt, and at most `max_pending` jobs may be queued or running. Beyond that a request fails
+right away with Busy (counted as kdf_rejected) instead of queueing without limit.
+
+Clients that reconnect (a flaky network, a bot restarting) would pay the KDF on every join.
+A successful verification is therefore remembered for cache_ttl seconds, keyed by a keyed
+BLAKE2b digest of the stored hash, the client's IP and the password, so the cache holds no
+password and only the same client with the same password for the same room hits it
+(kdf_cache_hits). Identical verifications that arrive while one is running share its future
+and count as hits too.
+
+Hash records look like "scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>", so the cost parameters can
+be raised later without invalidating existing rooms.
+
+Classes:
+    Busy: Raised when the hashing pool is full.
+    PasswordHasher: Bounded pool for hashing and verifying passwords, with a verification cache.
+Functions:
+    hash_password(password, salt, n, r, p): Returns the hash record of a password.
+    check_password(password, record): Whether a password matches a hash record.
+Global Variables:
+    SCRYPT_N, SCRYPT_R, SCRYPT_P (int): Default scrypt cost parameters.
+    DEFAULT_WORKERS (int): Default number of hashing threads.
+    MAX_PENDING (int): Default bound of queued and running hashing jobs.
+    CACHE_TTL (float): Default lifetime of a cached verification in seconds.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from metrics import STATS
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+HASH_SIZE = 32
+
+DEFAULT_WORKERS = 2
+MAX_PENDING = 64
+CACHE_TTL = 60.0
+CACHE_SIZE = 4096
+
+class Busy(Exception):
+    pass
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * n * r * p, dklen=HASH_SIZE)
+
+def hash_password(password, salt=None, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    salt = os.urandom(SALT_SIZE) if salt is None else salt
+    return f"scrypt${n}${r}${p}${salt.hex()}${_scrypt(password, salt, n, r, p).hex()}"
+
+def check_password(password, record):
+    try:
+        scheme, n, r, p, salt, expected = record.split("$")
+        if scheme != "scrypt":
+            return False
+        derived = _scrypt(password, bytes.fromhex(salt), int(n), int(r), int(p))
+    except (AttributeError, ValueError):
+        return False
+    return hmac.compare_digest(derived, bytes.fromhex(expected))
+
+class PasswordHasher:
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_pending=MAX_PENDING, cache_ttl=CACHE_TTL,
+                 cache_size=CACHE_SIZE, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+        self.max_pending = max_pending
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.params = (n, r, p)
+        self.pending = 0
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kdf")
+        self._lock = threading.Lock()
+        # cache key -> time.monotonic() the verification expires at, oldest first
+        self._verified = collections.OrderedDict()
+        # cache key -> Future of a verification that is running
+        self._running = {}
+        # keys the cache digests; never leaves the process
+        self._key = os.urandom(32)
+
+    def configure(self, workers=DEFAULT_WORKERS, max_pending=MAX_PENDING):
+        # Replaces the pool; jobs already submitted finish on the old one.
+        with self._lock:
+            previous = self._pool
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kdf")
+            self.max_pending = max_pending
+        previous.shutdown(wait=False)
+
+    def _submit(self, function, *args):
+        # Returns a Future of function(*args) run on the pool, or one failed with Busy.
+        with self._lock:
+            if self.pending >= self.max_pending:
+                future = concurrent.futures.Future()
+                future.set_exception(Busy("Password hashing queue is full."))
+                if STATS.enabled:
+                    STATS.inc("kdf_rejected")
+                return future
+            self.pending += 1
+            future = self._pool.submit(function, *args)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def hash(self, password):
+        # Future of the hash record of a new room's password.
+        n, r, p = self.params
+        return self._submit(hash_password, password, None, n, r, p)
+
+    def verify(self, record, password, client):
+        # Future of whether password matches record. client (the peer's IP) scopes the cache.
+        key = hashlib.blake2b(f"{record}\0{client}\0{password}".encode('utf-8'), key=self._key, digest_size=16).digest()
+        now = time.monotonic()
+        with self._lock:
+            expires = self._verified.get(key)
+            running = self._running.get(key)
+            if running is None and expires is not None and expires > now:
+                running = concurrent.futures.Future()
+                running.set_result(True)
+            if running is not None:
+                if STATS.enabled:
+                    STATS.inc("kdf_cache_hits")
+                return running
+        future = self._submit(check_password, password, record)
+        with self._lock:
+            self._running[key] = future
+        # runs right away if the future is already done, so the entry never outlives it
+        future.add_done_callback(lambda done: self._remember(key, done))
+        return future
+
+    def _remember(self, key, future):
+        with self._lock:
+            if self._running.get(key) is future:
+                del self._running[key]
+            if future.cancelled() or future.exception() is not None or not future.result():
+                return
+            if self.cache_ttl > 0:
+                self._verified[key] = time.monotonic() + self.cache_ttl
+                self._verified.move_to_end(key)
+                while len(self._verified) > self.cache_size:
+                    self._verified.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._verified.clear()
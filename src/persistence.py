@@ -0,0 +1,248 @@
+"""
+Write-ahead journal and snapshots of the room registry.
+
+Without persistence every room and token is lost when the server restarts, and all clients
+have to run connect_to_server again at the same moment. With `--state-dir DIR` the server
+keeps two kinds of files there:
+
+    journal-<generation>.log  one JSON array per line for every create/join/leave:
+                              ["create", room, token, username, ip(, password hash)]
+                              ["join", room, token, username, ip]
+                              ["leave", room, token]
+    snapshot                  a header line {"version", "generation", "rooms"}, then one line
+                              per room: [room, host, [[token, username, ip], ...](, password hash)]
+    token.key                 the key member tokens are signed with (see tokens.py), so
+                              restored tokens still verify
+
+Journal records are appended to an in-memory batch while the registry lock is held (see
+RoomRegistry.journal) and a background thread swaps the batch out and writes and fsyncs it
+every fsync_interval seconds (group commit) without holding the lock record() takes, so a
+create/join never waits for the disk. A crash loses at most the last fsync_interval
+seconds of changes.
+
+A snapshot is cut under the registry lock together with a switch to a new journal
+generation; it is then written to a temporary file, fsynced and renamed over the old one,
+after which the older journals are deleted. Recovery loads the snapshot through mmap, line
+by line, rebuilding each room in one step (RoomRegistry.restore_room), then replays every
+journal from the snapshot's generation on. A torn last line from a crash is ignored.
+Restored members count as just seen, so clients have a full idle timeout to send their
+next heartbeat, which also teaches the server their UDP endpoint again.
+
+Classes:
+    StateStore: Journal, snapshots and recovery for one RoomRegistry.
+Global Variables:
+    SNAPSHOT_VERSION (int): Format version written in the snapshot header.
+"""
+
+import json
+import logging
+import mmap
+import os
+import re
+import threading
+import time
+
+log = logging.getLogger("chat.persistence")
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_NAME = "snapshot"
+JOURNAL_PATTERN = re.compile(r"^journal-(\d+)\.log$")
+
+def _journal_name(generation):
+    return f"journal-{generation:08d}.log"
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class StateStore:
+
+    def __init__(self, directory, registry, fsync_interval=0.05, snapshot_interval=60.0):
+        self.directory = directory
+        self.registry = registry
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.generation = 0
+        # records since the last snapshot, to skip snapshots when nothing changed
+        self.records = 0
+        self._batch = []
+        # the open journal and its generation; only flush() and close() touch them
+        self._file = None
+        self._file_generation = None
+        # (generation, batch) of the journal generations _rotate() replaced, until flush()
+        self._retired = []
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _journal_generations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            match = JOURNAL_PATTERN.match(name)
+            if match:
+                generations.append(int(match.group(1)))
+        return sorted(generations)
+
+    # Recovery
+
+    def recover(self):
+        # Loads the snapshot and replays the journals into the registry, then compacts them
+        # into a fresh snapshot and attaches the journal. Returns the number of members restored.
+        started = time.perf_counter()
+        self.registry.journal = None
+        generation = self._load_snapshot()
+        replayed = 0
+        for journal_generation in self._journal_generations():
+            if journal_generation >= generation:
+                replayed += self._replay(self._path(_journal_name(journal_generation)))
+                generation = journal_generation
+
+        self.generation = generation
+        self.snapshot()
+        self.registry.journal = self.record
+        members = sum(len(room[2]) for room in self.registry.export())
+        log.info("Restored %d rooms and %d members (%d journal records) in %.3fs",
+                 len(self.registry), members, replayed, time.perf_counter() - started)
+        return members
+
+    def _load_snapshot(self):
+        path = self._path(SNAPSHOT_NAME)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = json.loads(mm.readline())
+            if header.get("version") != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version {header.get('version')}.")
+            restore_room = self.registry.restore_room
+            for line in iter(mm.readline, b""):
+                restore_room(*json.loads(line))
+        return header["generation"]
+
+    def _replay(self, path):
+        registry = self.registry
+        count = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn write at the end of a journal that was being appended to
+                    log.warning("Ignoring a truncated record at the end of %s", path)
+                    break
+                operation = record[0]
+                if operation == "create":
+                    registry.create_room(*record[1:])
+                elif operation == "join":
+                    registry.join_room(*record[1:])
+                elif operation == "leave":
+                    registry.leave(*record[1:])
+                count += 1
+        return count
+
+    # Journal
+
+    def record(self, record):
+        # Called by the registry under its lock; the batch is written by the flusher.
+        line = json.dumps(record, separators=(",", ":"))
+        with self._lock:
+            self._batch.append(line)
+            self.records += 1
+
+    def flush(self):
+        # Writes and fsyncs the pending batch. Only swapping the batch out takes the lock
+        # record() needs, so the registry never waits for the disk; _file_lock keeps the
+        # batches in order, the retired generations' before the current one's.
+        with self._file_lock:
+            with self._lock:
+                batch, self._batch = self._batch, []
+                generation = self.generation
+                retired, self._retired = self._retired, []
+            for old_generation, old_batch in retired:
+                self._append(old_generation, old_batch)
+            self._append(generation, batch)
+
+    def _append(self, generation, batch):
+        # Runs under _file_lock. The journal of a generation is opened on its first batch.
+        if self._file is not None and self._file_generation != generation:
+            self._file.close()
+            self._file = None
+        if not batch:
+            return
+        if self._file is None:
+            self._file = open(self._path(_journal_name(generation)), "a", encoding="utf-8")
+            self._file_generation = generation
+        self._file.write("\n".join(batch) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _rotate(self):
+        # Starts the next journal generation. Runs under the registry lock (via export()), so
+        # it only sets the batch aside; flush() writes it and opens the next journal.
+        with self._lock:
+            if self._batch:
+                self._retired.append((self.generation, self._batch))
+            self._batch = []
+            self.generation += 1
+            self.records = 0
+
+    # Snapshots
+
+    def snapshot(self):
+        # Writes a snapshot of the registry and drops the journals it covers.
+        rooms = self.registry.export(while_locked=self._rotate)
+        generation = self.generation
+        # the retired journals are complete on disk before the snapshot replaces them
+        self.flush()
+
+        path = self._path(SNAPSHOT_NAME)
+        temporary = path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"version": SNAPSHOT_VERSION, "generation": generation, "rooms": len(rooms)}) + "\n")
+            for room in rooms:
+                # the password hash is only written for protected rooms
+                f.write(json.dumps(room if room[3] is not None else room[:3], separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        _fsync_directory(self.directory)
+
+        for old_generation in self._journal_generations():
+            if old_generation < generation:
+                os.remove(self._path(_journal_name(old_generation)))
+        return generation
+
+    # Background flushing
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        last_snapshot = time.monotonic()
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.flush()
+                if self.snapshot_interval and self.records and time.monotonic() - last_snapshot >= self.snapshot_interval:
+                    self.snapshot()
+                    last_snapshot = time.monotonic()
+            except Exception as e:
+                log.warning("Error persisting state: %s", e)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._file_lock, self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,164 @@
+"""
+Staged UDP pipeline for the threaded engine.
+
+udp_handler() receives, decodes, validates and sends every fan-out datagram on one thread,
+so a slow broadcast stops the reading of the socket and the kernel receive buffer
+overflows. With `python server.py --senders N` the work is split into stages connected by
+bounded queues:
+
+    receive (1 thread)  recvfrom -> ingress queue
+    route   (1 thread)  decode, validate, rate limit, encode -> egress queue
+    send    (N threads) egress queue -> sendto / sendmmsg
+
+The route stage stays single threaded, so the registry sees the same access pattern as
+before. Its sender is a QueueSender: the fan-out helpers hand it each encoded payload with
+its whole recipient tuple (send_all), so one queue item carries one broadcast.
+
+When a queue is full its policy decides: "block" waits for room (backpressure to the
+previous stage), "drop_newest" discards the new item and "drop_oldest" discards the item at
+the head. The ingress queue never blocks, since blocking the receive stage would just move
+the overflow back into the kernel; the egress queue blocks by default, so a slow network
+slows routing down instead of discarding work already done. Drops are counted as
+queue_dropped.<queue> and depths are exposed as queue_depth.<queue> gauges (see metrics.py).
+
+Classes:
+    BoundedQueue: queue.Queue with a full-queue policy and a drop counter.
+    QueueSender: Socket stand-in that enqueues datagrams for the send stage.
+    Pipeline: The stages and their threads.
+Global Variables:
+    DROP_POLICIES (tuple): The accepted full-queue policies.
+"""
+
+import logging
+import queue
+import threading
+
+from fanout import send_to_all
+from metrics import STATS
+
+log = logging.getLogger("chat.pipeline")
+
+DROP_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+class BoundedQueue:
+
+    def __init__(self, name, maxsize, policy="block"):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy {policy!r}.")
+        self.name = name
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, item):
+        # Returns False if the item (or, with drop_oldest, an older one) was discarded.
+        if self.policy == "block":
+            self.queue.put(item)
+            return True
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        if self.policy == "drop_oldest":
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                pass
+        self.dropped += 1
+        if STATS.enabled:
+            STATS.inc(f"queue_dropped.{self.name}")
+        return False
+
+    def get(self):
+        return self.queue.get()
+
+    def depth(self):
+        return self.queue.qsize()
+
+class QueueSender:
+    # Passed to the fan-out in place of the socket; the send stage does the actual sending.
+
+    def __init__(self, egress):
+        self.egress = egress
+
+    def send_all(self, data, addresses):
+        self.egress.put((data, addresses))
+        return len(addresses)
+
+    def sendto(self, data, address):
+        self.egress.put((data, (address,)))
+        return len(data)
+
+class Pipeline:
+
+    def __init__(self, sock, handler, senders=1, queue_size=4096, ingress_policy="drop_newest",
+                 egress_policy="block", buffer_size=4096):
+        self.sock = sock
+        # handler(sender, data, address) handles one datagram, e.g. server.handle_udp_packet
+        self.handler = handler
+        self.senders = max(1, senders)
+        self.buffer_size = buffer_size
+        self.ingress = BoundedQueue("ingress", queue_size, ingress_policy)
+        self.egress = BoundedQueue("egress", queue_size, egress_policy)
+        self.sender = QueueSender(self.egress)
+        # what the route stage passes to the handler: the QueueSender, or a wrapper of it
+        # (e.g. coalesce.Coalescer) set by the caller before start()
+        self.route_sender = self.sender
+        self.threads = []
+
+    def start(self):
+        STATS.gauge("queue_depth.ingress", self.ingress.depth)
+        STATS.gauge("queue_depth.egress", self.egress.depth)
+        targets = [self.receive, self.route] + [self.send] * self.senders
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        log.info("UDP pipeline started with %d sender(s)", self.senders)
+        return self
+
+    def stop(self):
+        # Lets the route and send stages finish the queued work and exit.
+        self.ingress.queue.put(None)
+
+    def receive(self):
+        recvfrom = self.sock.recvfrom
+        put = self.ingress.put
+        while True:
+            try:
+                put(recvfrom(self.buffer_size))
+            except OSError as e:
+                log.warning("UDP receive stage stopped: %s", e)
+                self.stop()
+                break
+
+    def route(self):
+        get = self.ingress.get
+        while True:
+            item = get()
+            if item is None:
+                break
+            data, address = item
+            try:
+                self.handler(self.route_sender, data, address)
+            except Exception as e:
+                log.warning("Error handling UDP handler: %s", e)
+        for _ in range(self.senders):
+            self.egress.queue.put(None)
+
+    def send(self):
+        get = self.egress.get
+        while True:
+            item = get()
+            if item is None:
+                break
+            data, addresses = item
+            try:
+                send_to_all(self.sock, data, addresses)
+            except OSError as e:
+                log.warning("Error sending UDP datagrams: %s", e)
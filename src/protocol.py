@@ -0,0 +1,241 @@
+"""
+Compact binary wire protocol for chat datagrams.
+
+JSON datagrams always start with '{', so a datagram whose first byte is MAGIC is binary
+and both formats can share the UDP port. A client asks for the binary format by sending
+"protocol": "binary" in its TCP create_room/join_room request; the server confirms it in
+the response and afterwards answers each member in the format its datagrams arrive in.
+
+Client -> server (REQUEST_HEADER):
+    magic (1 byte) | op (1 byte) | room name length (1 byte) | token length (1 byte)
+    | room name | token | payload (UTF-8 message for OP_MESSAGE)
+The username is not repeated in every packet; the server knows it from the token.
+
+Client -> server, compact (COMPACT_HEADER), once the TCP response gave a member_id:
+    MAGIC_COMPACT (1 byte) | op (1 byte) | member id (4 bytes) | token tag (8 bytes) | payload
+14 bytes of header instead of 4 + room name + token (58 bytes). The server finds the member
+by id in a table and authenticates it by the tag, a hash of its token (token_tag), so the
+token itself is not sent; answers are binary deliveries.
+
+Server -> client (DELIVERY_HEADER):
+    magic (1 byte) | op (1 byte) | sender length (1 byte) | sender | payload
+OP_DELIVER_MESSAGE carries the sender's username and the message, OP_DELIVER_SYSTEM
+carries a system message with an empty sender.
+
+Server -> client batch (BATCH_HEADER), sent when outbound coalescing is on (coalesce.py):
+    magic (1 byte) | OP_BATCH (1 byte) | count (2 bytes) | count x (length (2 bytes) | datagram)
+Each datagram is a complete JSON or binary delivery, so JSON clients get the envelope too.
+
+Reliable delivery (see reliable.py), in both directions once negotiated:
+    magic (1 byte) | OP_RELIABLE (1 byte) | sequence number (4 bytes) | datagram
+    magic (1 byte) | OP_ACK (1 byte) | cumulative ack (4 bytes) | bitmap (4 bytes)
+The wrapped datagram is any request (client -> server) or delivery (server -> client). An ack
+confirms every sequence number up to the cumulative one, and bit i of the bitmap confirms
+cumulative + 2 + i.
+
+Compressed delivery (see compression.py), server -> client once negotiated:
+    magic (1 byte) | OP_COMPRESSED (1 byte) | raw DEFLATE of a delivery
+
+Fragment (see fragments.py), in both directions once negotiated:
+    magic (1 byte) | OP_FRAGMENT (1 byte) | message id (4 bytes) | index (2 bytes)
+    | count (2 bytes) | chunk
+
+Decoding works on a memoryview of the datagram: room name and token are decoded straight
+from the view and the payload is returned as a view, so the server can forward a message
+without ever turning it into a str.
+
+Functions:
+    is_binary(data): Whether a datagram uses the binary format.
+    fits(room_name, token): Whether the names fit in the one-byte length fields.
+    encode_request(op, room_name, token, payload): Builds a client -> server datagram.
+    decode_request(data): Parses a client -> server datagram into (op, room_name, token, payload).
+    token_tag(token): The tag identifying a token in compact datagrams.
+    is_compact(data): Whether a datagram uses the compact id-based format.
+    encode_compact(op, member_id, tag, payload): Builds a compact client -> server datagram.
+    decode_compact(data): Parses a compact datagram into (op, member_id, tag, payload).
+    encode_message(sender, payload): Builds a chat message delivery.
+    encode_system(text): Builds a system message delivery.
+    decode_delivery(data): Parses a delivery into the same dict as the JSON responses.
+    is_batch(data): Whether a datagram is a batch of coalesced datagrams.
+    encode_batch(datagrams): Packs several datagrams into one.
+    decode_batch(data): Returns the datagrams packed in a batch as memoryviews.
+    is_reliable(data): Whether a datagram is a sequenced reliable datagram.
+    encode_reliable(seq, datagram): Wraps a datagram with its sequence number.
+    decode_reliable(data): Returns (seq, datagram) of a reliable datagram.
+    is_ack(data): Whether a datagram is an ack.
+    encode_ack(cumulative, bitmap): Builds an ack.
+    decode_ack(data): Returns (cumulative, bitmap) of an ack.
+    is_fragment(data): Whether a datagram is a fragment of a larger one.
+    encode_fragment(message_id, index, count, chunk): Builds a fragment.
+    decode_fragment(data): Returns (message_id, index, count, chunk) of a fragment.
+"""
+
+import hashlib
+import struct
+
+MAGIC = 0xC1
+MAGIC_COMPACT = 0xC2
+
+# client -> server operations
+OP_CONNECT = 1
+OP_MESSAGE = 2
+OP_LEAVE = 3
+OP_HEARTBEAT = 4
+
+# server -> client operations
+OP_DELIVER_MESSAGE = 0x81
+OP_DELIVER_SYSTEM = 0x82
+OP_BATCH = 0x83
+
+# reliable delivery, both directions
+OP_RELIABLE = 0x84
+OP_ACK = 0x85
+# compressed delivery, server -> client
+OP_COMPRESSED = 0x86
+# fragment of a larger datagram, both directions
+OP_FRAGMENT = 0x87
+
+OPERATION_CODES = {"connect": OP_CONNECT, "message": OP_MESSAGE, "leave": OP_LEAVE, "heartbeat": OP_HEARTBEAT}
+OPERATION_NAMES = {code: name for name, code in OPERATION_CODES.items()}
+
+REQUEST_HEADER = struct.Struct("!BBBB")
+DELIVERY_HEADER = struct.Struct("!BBB")
+COMPACT_HEADER = struct.Struct("!BBI8s")
+BATCH_HEADER = struct.Struct("!BBH")
+BATCH_ENTRY = struct.Struct("!H")
+RELIABLE_HEADER = struct.Struct("!BBI")
+ACK = struct.Struct("!BBII")
+COMPRESSED_HEADER = struct.Struct("!BB")
+FRAGMENT_HEADER = struct.Struct("!BBIHH")
+
+MAX_NAME_LENGTH = 255
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MAGIC
+
+def fits(room_name, token):
+    return len(room_name.encode('utf-8')) <= MAX_NAME_LENGTH and len(token.encode('utf-8')) <= MAX_NAME_LENGTH
+
+def encode_request(op, room_name, token, payload=b""):
+    room_bytes = room_name.encode('utf-8')
+    token_bytes = token.encode('utf-8')
+    if len(room_bytes) > MAX_NAME_LENGTH or len(token_bytes) > MAX_NAME_LENGTH:
+        raise ValueError("Room name or token too long for the binary protocol.")
+    return b"".join((REQUEST_HEADER.pack(MAGIC, op, len(room_bytes), len(token_bytes)), room_bytes, token_bytes, payload))
+
+def decode_request(data):
+    view = memoryview(data)
+    if len(view) < REQUEST_HEADER.size:
+        raise ValueError("Truncated binary packet.")
+    magic, op, room_length, token_length = REQUEST_HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError("Not a binary packet.")
+    room_end = REQUEST_HEADER.size + room_length
+    token_end = room_end + token_length
+    if len(view) < token_end:
+        raise ValueError("Truncated binary packet.")
+    room_name = str(view[REQUEST_HEADER.size:room_end], 'utf-8')
+    token = str(view[room_end:token_end], 'utf-8')
+    return op, room_name, token, view[token_end:]
+
+def token_tag(token):
+    return hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+
+def is_compact(data):
+    return len(data) > 0 and data[0] == MAGIC_COMPACT
+
+def encode_compact(op, member_id, tag, payload=b""):
+    return COMPACT_HEADER.pack(MAGIC_COMPACT, op, member_id, tag) + payload
+
+def decode_compact(data):
+    view = memoryview(data)
+    if len(view) < COMPACT_HEADER.size:
+        raise ValueError("Truncated compact packet.")
+    _, op, member_id, tag = COMPACT_HEADER.unpack_from(view)
+    return op, member_id, tag, view[COMPACT_HEADER.size:]
+
+def encode_message(sender, payload):
+    sender_bytes = sender.encode('utf-8')[:MAX_NAME_LENGTH]
+    return b"".join((DELIVERY_HEADER.pack(MAGIC, OP_DELIVER_MESSAGE, len(sender_bytes)), sender_bytes, payload))
+
+def encode_system(text):
+    return DELIVERY_HEADER.pack(MAGIC, OP_DELIVER_SYSTEM, 0) + text.encode('utf-8')
+
+def decode_delivery(data):
+    # Returns the same dict the JSON format would have carried.
+    view = memoryview(data)
+    magic, op, sender_length = DELIVERY_HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError("Not a binary packet.")
+    payload_start = DELIVERY_HEADER.size + sender_length
+    payload = str(view[payload_start:], 'utf-8')
+    if op == OP_DELIVER_MESSAGE:
+        sender = str(view[DELIVERY_HEADER.size:payload_start], 'utf-8', 'replace')
+        return {"status": "success", "sender": sender, "message": payload}
+    if op == OP_DELIVER_SYSTEM:
+        return {"status": "success", "system_message": payload}
+    raise ValueError(f"Unknown delivery op {op}.")
+
+def is_batch(data):
+    return len(data) >= BATCH_HEADER.size and data[0] == MAGIC and data[1] == OP_BATCH
+
+def encode_batch(datagrams):
+    parts = [BATCH_HEADER.pack(MAGIC, OP_BATCH, len(datagrams))]
+    for datagram in datagrams:
+        parts.append(BATCH_ENTRY.pack(len(datagram)))
+        parts.append(datagram)
+    return b"".join(parts)
+
+def decode_batch(data):
+    view = memoryview(data)
+    magic, op, count = BATCH_HEADER.unpack_from(view)
+    if magic != MAGIC or op != OP_BATCH:
+        raise ValueError("Not a batch packet.")
+    datagrams = []
+    offset = BATCH_HEADER.size
+    for _ in range(count):
+        if len(view) < offset + BATCH_ENTRY.size:
+            raise ValueError("Truncated batch packet.")
+        (length,) = BATCH_ENTRY.unpack_from(view, offset)
+        offset += BATCH_ENTRY.size
+        if len(view) < offset + length:
+            raise ValueError("Truncated batch packet.")
+        datagrams.append(view[offset:offset + length])
+        offset += length
+    return datagrams
+
+def is_reliable(data):
+    return len(data) >= RELIABLE_HEADER.size and data[0] == MAGIC and data[1] == OP_RELIABLE
+
+def encode_reliable(seq, datagram):
+    return RELIABLE_HEADER.pack(MAGIC, OP_RELIABLE, seq) + datagram
+
+def decode_reliable(data):
+    view = memoryview(data)
+    if len(view) < RELIABLE_HEADER.size:
+        raise ValueError("Truncated reliable packet.")
+    _, _, seq = RELIABLE_HEADER.unpack_from(view)
+    return seq, view[RELIABLE_HEADER.size:]
+
+def is_ack(data):
+    return len(data) == ACK.size and data[0] == MAGIC and data[1] == OP_ACK
+
+def encode_ack(cumulative, bitmap):
+    return ACK.pack(MAGIC, OP_ACK, cumulative, bitmap)
+
+def decode_ack(data):
+    _, _, cumulative, bitmap = ACK.unpack(data)
+    return cumulative, bitmap
+
+def is_fragment(data):
+    return len(data) >= FRAGMENT_HEADER.size and data[0] == MAGIC and data[1] == OP_FRAGMENT
+
+def encode_fragment(message_id, index, count, chunk):
+    return FRAGMENT_HEADER.pack(MAGIC, OP_FRAGMENT, message_id, index, count) + chunk
+
+def decode_fragment(data):
+    view = memoryview(data)
+    if len(view) < FRAGMENT_HEADER.size:
+        raise ValueError("Truncated fragment.")
+    _, _, message_id, index, count = FRAGMENT_HEADER.unpack_from(view)
+    return message_id, index, count, view[FRAGMENT_HEADER.size:]
@@ -0,0 +1,74 @@
+"""
+Token bucket rate limiting of chat messages.
+
+Every message is fanned out to the whole room, so one client sending as fast as it can
+multiplies into room-size times the egress and keeps the UDP handler busy. Messages are
+therefore checked against two token buckets before they are broadcast: one per member
+(token) and one per room, refilled continuously at `rate` messages per second up to
+`burst`. A message that finds either bucket empty is dropped.
+
+The bucket state lives in the Member and Room records of the registry (allowance,
+allowance_at), which the UDP handler has already looked up, so a check is a few float
+operations with no dict lookup, no lock and no allocation, and the state goes away with
+the member or room. Buckets start full.
+
+Only "message" datagrams are limited; connect, heartbeat and leave do not fan out chat
+traffic.
+
+Classes:
+    RateLimiter: Per-token and per-room limits, with counters of the messages dropped.
+Global Variables:
+    DEFAULT_TOKEN_RATE, DEFAULT_TOKEN_BURST (float): Default per-member limit.
+    DEFAULT_ROOM_RATE, DEFAULT_ROOM_BURST (float): Default per-room limit.
+"""
+
+# well above the 2 messages/s per user and 10 users per room of requirement/requirements.md
+DEFAULT_TOKEN_RATE = 10.0
+DEFAULT_TOKEN_BURST = 20.0
+DEFAULT_ROOM_RATE = 100.0
+DEFAULT_ROOM_BURST = 200.0
+
+class RateLimiter:
+
+    def __init__(self, token_rate=DEFAULT_TOKEN_RATE, token_burst=DEFAULT_TOKEN_BURST,
+                 room_rate=DEFAULT_ROOM_RATE, room_burst=DEFAULT_ROOM_BURST):
+        self.configure(token_rate, token_burst, room_rate, room_burst)
+        # messages dropped because of each limit
+        self.dropped = {"token": 0, "room": 0}
+
+    def configure(self, token_rate=DEFAULT_TOKEN_RATE, token_burst=DEFAULT_TOKEN_BURST,
+                  room_rate=DEFAULT_ROOM_RATE, room_burst=DEFAULT_ROOM_BURST):
+        # A rate of 0 disables that limit; the burst defaults to one second worth of rate.
+        self.token_rate = token_rate
+        self.token_burst = max(token_burst or token_rate, 1.0)
+        self.room_rate = room_rate
+        self.room_burst = max(room_burst or room_rate, 1.0)
+        self.enabled = bool(token_rate or room_rate)
+
+    def allow(self, member, room, now):
+        # Returns None if the message may be sent (and charges both buckets),
+        # or the name of the limit that dropped it ("token" or "room").
+        if self.token_rate:
+            member_tokens = member.allowance + (now - member.allowance_at) * self.token_rate
+            if member_tokens > self.token_burst:
+                member_tokens = self.token_burst
+            member.allowance_at = now
+            if member_tokens < 1.0:
+                member.allowance = member_tokens
+                self.dropped["token"] += 1
+                return "token"
+        if self.room_rate:
+            room_tokens = room.allowance + (now - room.allowance_at) * self.room_rate
+            if room_tokens > self.room_burst:
+                room_tokens = self.room_burst
+            room.allowance_at = now
+            if room_tokens < 1.0:
+                room.allowance = room_tokens
+                if self.token_rate:
+                    member.allowance = member_tokens
+                self.dropped["room"] += 1
+                return "room"
+            room.allowance = room_tokens - 1.0
+        if self.token_rate:
+            member.allowance = member_tokens - 1.0
+        return None
@@ -0,0 +1,470 @@
+"""
+Room and token registry for the chat server.
+
+Replaces the module level `rooms`/`tokens` dicts of server.py. Membership is kept in a
+per-room dict keyed by token (O(1) lookup and removal, insertion ordered), every token
+maps to a compact Member record, and each room keeps a precomputed tuple of recipient
+addresses that is rebuilt only when its membership changes, so a broadcast needs no
+per-member lookups.
+
+A member's address is the (ip, port) its UDP packets actually come from. It is unknown
+until the first UDP packet carrying a valid token arrives (see update_endpoint), and
+members without a known endpoint are not included in the recipients. An endpoint belongs
+to at most one token, so clients sharing an IP (or a NAT) are told apart by port.
+Members are answered in the wire format (JSON or binary, see protocol.py) their datagrams
+arrive in, so rooms also keep their recipients split by format.
+
+Idle members are expired with a TimerWheel (see timers.py) when an idle timeout is set.
+Activity only updates Member.last_seen (touch); the wheel holds one timer per member, and a
+timer that fires for a member seen since is simply rescheduled, so refreshing a member on
+every datagram costs an attribute write and expiring it is O(1) amortized.
+
+Rooms and members get small integer ids that are never reused, which the server signs
+into the member's token (see tokens.py) and hands to the client. With decode_token set, the
+registry reads the ids and expiry back from the token, so a restored or replayed member
+keeps the ids its token carries; tokens it cannot decode (tests, older state) get fresh ids.
+With issue_token set, open_room() and admit() allocate the ids and issue the token under the
+lock once the request is known to succeed, so refused requests allocate nothing.
+The UDP data plane looks members and rooms up by id (member_by_id, room_by_id) in tables
+that are plain lists indexed by the id, so a compact datagram (protocol.encode_compact)
+needs no string hashing at all; a member is authenticated by the tag of its token
+(protocol.token_tag), kept on the record.
+
+Members that negotiated compressed deliveries have recipient tuples of their own, and
+members that negotiated reliable delivery carry a reliable.Link and are kept apart from the
+per-format address tuples in Room.reliable_members, since each of them gets its own
+sequence numbers (see reliable.py). The addresses of members that negotiated fragmentation
+are kept in Room.fragment_addresses, which fan-out only consults for deliveries larger than
+fragments.FRAGMENT_SIZE. set_delivery() switches these options on for a member.
+
+With a directory attached (see directory.py) the registry reports every room and member
+count change to it while the lock is held, so list_rooms/search_rooms never scan the rooms.
+
+When a journal is attached (see persistence.py) every successful create/join/leave is
+passed to it while the lock is held, so the journal order is the order the changes were
+applied in and export() can cut a snapshot that lines up exactly with a journal position.
+
+Mutations are serialized by a lock, which makes the registry safe to share between the
+threaded engine's handler threads. Reads used on the UDP hot path (is_member, recipients)
+are single dict lookups and attribute reads, so they do not take the lock; this also keeps
+them cheap to call from the asyncio event loop.
+
+Classes:
+    Member: One token issued to a user in a room.
+    Room: One chat room with its host token, members and recipient addresses.
+    RoomRegistry: Thread-safe store of rooms and members shared by both engines.
+"""
+
+import threading
+import time
+
+from protocol import token_tag
+from timers import TimerWheel
+
+class Member:
+    __slots__ = ("token", "tag", "id", "username", "ip", "room_name", "room_id", "expires", "address",
+                 "binary", "last_seen", "allowance", "allowance_at", "link", "compressed",
+                 "fragmented")
+
+    def __init__(self, token, username, ip, room_name, member_id=0, room_id=0, expires=float("inf")):
+        self.token = token
+        # authenticates the member's compact datagrams, which carry the id instead of the token
+        self.tag = token_tag(token)
+        self.id = member_id
+        self.username = username
+        self.ip = ip
+        self.room_name = room_name
+        self.room_id = room_id
+        # unix time the token expires at
+        self.expires = expires
+        # learned UDP endpoint (ip, port), None until the client sends its first datagram
+        self.address = None
+        # whether the member speaks the binary wire protocol
+        self.binary = False
+        # time.monotonic() of the member's last request or datagram
+        self.last_seen = time.monotonic()
+        # token bucket of the member's messages, see ratelimit.py; starts full
+        self.allowance = float("inf")
+        self.allowance_at = 0.0
+        # reliable.Link of a member that negotiated reliable delivery, None otherwise
+        self.link = None
+        # whether the member negotiated compressed deliveries (see compression.py)
+        self.compressed = False
+        # whether the member negotiated fragmented datagrams (see fragments.py)
+        self.fragmented = False
+
+class Room:
+    __slots__ = ("name", "id", "host", "password", "members", "addresses", "json_addresses", "binary_addresses",
+                 "compressed_json_addresses", "compressed_binary_addresses", "reliable_members", "fragment_addresses",
+                 "allowance", "allowance_at")
+
+    def __init__(self, name, host, room_id=0, password=None):
+        self.name = name
+        self.id = room_id
+        self.host = host
+        # scrypt hash record of the room's password (see passwords.py), None for an open room
+        self.password = password
+        # token -> Member
+        self.members = {}
+        # recipient addresses, rebuilt by RoomRegistry when members change
+        self.addresses = ()
+        self.json_addresses = ()
+        self.binary_addresses = ()
+        # the same for members that negotiated compressed deliveries
+        self.compressed_json_addresses = ()
+        self.compressed_binary_addresses = ()
+        # members with reliable delivery, which get their datagrams one by one with a sequence number
+        self.reliable_members = ()
+        # addresses of members that take large deliveries in fragments
+        self.fragment_addresses = frozenset()
+        # token bucket of the room's messages, see ratelimit.py; starts full
+        self.allowance = float("inf")
+        self.allowance_at = 0.0
+
+class RoomRegistry:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rooms = {}
+        self._members = {}
+        # (ip, port) -> token
+        self._endpoints = {}
+        # seconds without activity before a member expires; None never expires members
+        self.idle_timeout = None
+        # token -> idle deadline, checked against last_seen when it fires
+        self._expiry = TimerWheel(now=time.monotonic())
+        # called with a record tuple for every applied change, see persistence.StateStore
+        self.journal = None
+        # token -> (room_id, member_id, expires) or None, see tokens.TokenSigner.decode
+        self.decode_token = None
+        # (room_id, member_id) -> token, see tokens.TokenSigner.issue; used by open_room/admit
+        self.issue_token = None
+        # directory.RoomDirectory kept up to date with the rooms and their member counts
+        self.directory = None
+        # id -> Room or Member (None once gone); index 0 is never used
+        self._room_table = [None]
+        self._member_table = [None]
+
+    def __contains__(self, room_name):
+        return room_name in self._rooms
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def allocate_room_id(self):
+        # Returns a room id that has not been used yet.
+        with self._lock:
+            self._room_table.append(None)
+            return len(self._room_table) - 1
+
+    def allocate_member_id(self):
+        # Returns a member id that has not been used yet.
+        with self._lock:
+            self._member_table.append(None)
+            return len(self._member_table) - 1
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._members.clear()
+            self._endpoints.clear()
+            self._expiry.clear()
+            self._room_table = [None]
+            self._member_table = [None]
+            if self.directory is not None:
+                self.directory.clear()
+
+    def get_room(self, room_name):
+        return self._rooms.get(room_name)
+
+    def get_member(self, token):
+        return self._members.get(token)
+
+    # Lock-free id lookups of the UDP data plane; ids come from clients, so they are range checked.
+
+    def member_by_id(self, member_id):
+        table = self._member_table
+        return table[member_id] if 0 < member_id < len(table) else None
+
+    def room_by_id(self, room_id):
+        table = self._room_table
+        return table[room_id] if 0 < room_id < len(table) else None
+
+    def room_names(self):
+        return list(self._rooms)
+
+    def is_member(self, room_name, token):
+        room = self._rooms.get(room_name)
+        return room is not None and token in room.members
+
+    def recipients(self, room_name):
+        # Returns the precomputed recipient addresses of a room (empty if it does not exist).
+        room = self._rooms.get(room_name)
+        return room.addresses if room is not None else ()
+
+    def member_at(self, address):
+        # The member whose datagrams come from address, or None. Lock-free like recipients().
+        return self._members.get(self._endpoints.get(address))
+
+    def touch(self, token, now=None):
+        # Records activity of a member. Lock-free: the expiry timer is only checked when it fires.
+        member = self._members.get(token)
+        if member is not None:
+            member.last_seen = time.monotonic() if now is None else now
+        return member
+
+    def set_idle_timeout(self, seconds):
+        # Enables (seconds > 0) or disables idle expiry for current and future members.
+        with self._lock:
+            self.idle_timeout = seconds if seconds and seconds > 0 else None
+            self._expiry.clear()
+            if self.idle_timeout is not None:
+                for member in self._members.values():
+                    self._expiry.schedule(member.token, member.last_seen + self.idle_timeout)
+
+    def expired(self, now=None):
+        # Returns the members idle for longer than idle_timeout. They stay registered;
+        # the caller removes them with leave() so their rooms are notified.
+        now = time.monotonic() if now is None else now
+        if self.idle_timeout is None or not self._expiry.due(now):
+            return []
+        with self._lock:
+            expired = []
+            for token in self._expiry.advance(now):
+                member = self._members.get(token)
+                if member is None:
+                    continue
+                deadline = member.last_seen + self.idle_timeout
+                if deadline > now:
+                    self._expiry.schedule(token, deadline)
+                else:
+                    expired.append(member)
+            return expired
+
+    def update_endpoint(self, token, address, binary=False):
+        # Records the UDP source address and wire format of a member. Called for every valid
+        # datagram, so the common case (nothing changed) is answered without taking the lock.
+        member = self._members.get(token)
+        if member is None or (member.address == address and member.binary == binary):
+            return False
+        with self._lock:
+            member = self._members.get(token)
+            if member is None:
+                return False
+            previous_owner = self._members.get(self._endpoints.get(address))
+            if previous_owner is not None and previous_owner is not member:
+                # the endpoint was reused by another client; the old member cannot receive on it
+                previous_owner.address = None
+                self._rebuild(self._rooms[previous_owner.room_name])
+            if member.address is not None:
+                self._endpoints.pop(member.address, None)
+            member.address = address
+            member.binary = binary
+            self._endpoints[address] = token
+            self._rebuild(self._rooms[member.room_name])
+            return True
+
+    def set_delivery(self, token, link=None, compressed=False, fragmented=False):
+        # Switches a member to reliable delivery over link (see reliable.py), compressed
+        # deliveries (see compression.py) and fragmented datagrams (see fragments.py), as given.
+        with self._lock:
+            member = self._members.get(token)
+            if member is None:
+                return False
+            if link is not None:
+                member.link = link
+            member.compressed = member.compressed or compressed
+            member.fragmented = member.fragmented or fragmented
+            self._rebuild(self._rooms[member.room_name])
+            return True
+
+    def create_room(self, room_name, token, username, ip, password=None):
+        # Creates a room with the given token as host. Returns False if the room already exists.
+        # password is the hash record of the room's password, checked by the server on joins.
+        with self._lock:
+            if room_name in self._rooms:
+                return False
+            room = Room(room_name, token, self._room_id(token), password)
+            self._rooms[room_name] = room
+            self._room_table[room.id] = room
+            self._add_member(room, token, username, ip)
+            if self.journal is not None:
+                record = ("create", room_name, token, username, ip)
+                self.journal(record + (password,) if password is not None else record)
+            return True
+
+    def open_room(self, room_name, username, ip, password=None):
+        # create_room() with a token issued for fresh ids. The ids are allocated only once the
+        # room is known not to exist, so refused requests do not grow the id tables.
+        # Returns the host token, or None if the room already exists.
+        with self._lock:
+            if room_name in self._rooms:
+                return None
+            token = self.issue_token(self.allocate_room_id(), self.allocate_member_id())
+            self.create_room(room_name, token, username, ip, password)
+            return token
+
+    def admit(self, room_name, username, ip):
+        # join_room() with a token issued for a fresh member id, allocated only once the room
+        # is known to exist. Returns the member token, or None if the room does not exist.
+        with self._lock:
+            room = self._rooms.get(room_name)
+            if room is None:
+                return None
+            token = self.issue_token(room.id, self.allocate_member_id())
+            self.join_room(room_name, token, username, ip)
+            return token
+
+    def join_room(self, room_name, token, username, ip):
+        # Adds a member to an existing room. Returns False if the room does not exist.
+        with self._lock:
+            room = self._rooms.get(room_name)
+            if room is None:
+                return False
+            if self.decode_token is not None:
+                claims = self.decode_token(token)
+                # a token issued for an earlier room of the same name
+                if claims is not None and claims[0] != room.id:
+                    return False
+            self._add_member(room, token, username, ip)
+            if self.journal is not None:
+                self.journal(("join", room_name, token, username, ip))
+            return True
+
+    def leave(self, room_name, token):
+        # Removes a member from a room. When the host leaves the room is closed.
+        # Returns (was_host, room) where the room's recipients are the members left to notify,
+        # or None if the token was not a member of the room.
+        with self._lock:
+            room = self._rooms.get(room_name)
+            if room is None or token not in room.members:
+                return None
+            self._forget(room.members.pop(token))
+            self._rebuild(room)
+            if self.journal is not None:
+                self.journal(("leave", room_name, token))
+            if token == room.host:
+                del self._rooms[room_name]
+                self._room_table[room.id] = None
+                for member in room.members.values():
+                    self._forget(member)
+                if self.directory is not None:
+                    self.directory.remove(room_name)
+                return True, room
+            if self.directory is not None:
+                self.directory.update(room_name, len(room.members))
+            return False, room
+
+    def export(self, while_locked=None):
+        # Returns [(room_name, host, [(token, username, ip), ...], password)] for every room.
+        # while_locked() runs before the lock is released, so nothing changes in between.
+        with self._lock:
+            rooms = [
+                (room.name, room.host, [(member.token, member.username, member.ip) for member in room.members.values()],
+                 room.password)
+                for room in self._rooms.values()
+            ]
+            if while_locked is not None:
+                while_locked()
+            return rooms
+
+    def restore_room(self, room_name, host, members, password=None):
+        # Recreates a room from a snapshot in one step: the recipients are rebuilt once,
+        # not once per member, and nothing is journaled. Replaces a room of the same name.
+        with self._lock:
+            previous = self._rooms.get(room_name)
+            if previous is not None:
+                for member in previous.members.values():
+                    self._forget(member)
+                self._room_table[previous.id] = None
+            room = Room(room_name, host, self._room_id(host), password)
+            self._rooms[room_name] = room
+            self._room_table[room.id] = room
+            now = time.monotonic()
+            for token, username, ip in members:
+                _, member_id, expires = self._claims(token, room.id)
+                member = Member(token, username, ip, room_name, member_id, room.id, expires)
+                member.last_seen = now
+                room.members[token] = member
+                self._members[token] = member
+                self._member_table[member_id] = member
+                if self.idle_timeout is not None:
+                    self._expiry.schedule(token, now + self.idle_timeout)
+            self._rebuild(room)
+            if self.directory is not None:
+                self.directory.update(room_name, len(room.members))
+
+    # The id helpers run with the lock held. Ids a token does not carry are allocated.
+
+    @staticmethod
+    def _reserve(table, index):
+        # Grows an id table so index is a valid slot; later allocations come after it.
+        if index >= len(table):
+            table.extend([None] * (index + 1 - len(table)))
+
+    def _room_id(self, host):
+        claims = self.decode_token(host) if self.decode_token is not None else None
+        if claims is None:
+            self._room_table.append(None)
+            return len(self._room_table) - 1
+        self._reserve(self._room_table, claims[0])
+        return claims[0]
+
+    def _claims(self, token, room_id):
+        # (room_id, member_id, expires) of a member's token
+        claims = self.decode_token(token) if self.decode_token is not None else None
+        if claims is None:
+            self._member_table.append(None)
+            return room_id, len(self._member_table) - 1, float("inf")
+        self._reserve(self._room_table, claims[0])
+        self._reserve(self._member_table, claims[1])
+        return claims
+
+    def _add_member(self, room, token, username, ip):
+        previous = self._members.get(token)
+        _, member_id, expires = self._claims(token, room.id)
+        member = Member(token, username, ip, room.name, member_id, room.id, expires)
+        if previous is not None:
+            if previous.room_name == room.name:
+                # rejoining with the same token keeps the learned endpoint and its options
+                member.address = previous.address
+                member.link = previous.link
+                member.compressed = previous.compressed
+                member.fragmented = previous.fragmented
+            if self._member_table[previous.id] is previous:
+                self._member_table[previous.id] = None
+        room.members[token] = member
+        self._members[token] = member
+        self._member_table[member.id] = member
+        if self.idle_timeout is not None:
+            self._expiry.schedule(token, member.last_seen + self.idle_timeout)
+        self._rebuild(room)
+        if self.directory is not None:
+            self.directory.update(room.name, len(room.members))
+
+    def _forget(self, member):
+        self._members.pop(member.token, None)
+        if self._member_table[member.id] is member:
+            self._member_table[member.id] = None
+        self._expiry.cancel(member.token)
+        if member.address is not None and self._endpoints.get(member.address) == member.token:
+            del self._endpoints[member.address]
+
+    def _rebuild(self, room):
+        # [json, binary, compressed json, compressed binary] addresses
+        groups = ([], [], [], [])
+        reliable_members = []
+        for member in room.members.values():
+            if member.address is None:
+                continue
+            if member.link is not None:
+                reliable_members.append(member)
+            else:
+                groups[member.binary + 2 * member.compressed].append(member.address)
+        room.json_addresses, room.binary_addresses, room.compressed_json_addresses, room.compressed_binary_addresses = \
+            (tuple(group) for group in groups)
+        room.reliable_members = tuple(reliable_members)
+        room.fragment_addresses = frozenset(member.address for member in room.members.values()
+                                            if member.fragmented and member.address is not None)
+        room.addresses = tuple(address for group in groups for address in group) \
+            + tuple(member.address for member in reliable_members)
@@ -0,0 +1,262 @@
+"""
+Optional reliable delivery of chat datagrams.
+
+Chat over UDP is fire and forget: a datagram lost on the way to or from the server is
+gone. A client that sends "reliable": true with create_room/join_room (and is confirmed with
+"reliable": true) gets at-least-once delivery with duplicate suppression, which makes it
+effectively exactly once, in both directions, while datagrams still travel one by one
+without TCP's head-of-line blocking:
+
+- Every reliable datagram carries a per-sender sequence number (protocol.encode_reliable).
+  The server numbers the deliveries to each member, the client numbers its messages.
+- The receiver answers every reliable datagram with an ack of its whole receive state
+  (protocol.encode_ack): the highest sequence number up to which everything arrived, plus a
+  32-bit bitmap of what arrived beyond it, so one ack also repairs lost earlier acks.
+- The sender keeps unacked datagrams in a SendWindow and resends each one once its
+  retransmission timeout passes, doubling the timeout on every retry (up to MAX_RTO); the
+  timeout follows a smoothed round trip estimate (RFC 6298, samples only from datagrams
+  sent once). After MAX_RETRIES a datagram is given up.
+- The ReceiveWindow drops datagrams it has seen, so retransmits are never delivered twice.
+  Deliveries are not reordered.
+
+Memory is bounded on both sides. A SendWindow holds at most `capacity` datagrams (the oldest
+is given up when it is full); the server's windows hold the payload each broadcast encoded
+once, so a room's windows share their bytes. A ReceiveWindow is two integers: everything
+more than MAX_GAP sequence numbers behind the newest datagram counts as received.
+
+On the server a member's Link (both windows) lives on its registry Member, and the
+Retransmitter tracks the members with unacked deliveries; the engines call its tick()
+every RETRANSMIT_INTERVAL. Retransmits, given up datagrams and suppressed duplicates are
+counted as reliable_retransmits, reliable_gave_up and reliable_duplicates. A member that
+negotiated fragmentation gets large reliable datagrams, retransmits included, in fragments
+(see fragments.py); every retransmit resends all of them.
+
+Classes:
+    SendWindow: Numbers outgoing datagrams and keeps them until they are acked.
+    ReceiveWindow: Suppresses duplicates and builds acks.
+    Link: Both windows of one peer.
+    Retransmitter: Server-side set of the members with unacked deliveries.
+Functions:
+    send(sock, member, datagram, now): Sends a delivery to a reliable member.
+Global Variables:
+    WINDOW_SIZE (int): Default SendWindow capacity.
+    INITIAL_RTO, MIN_RTO, MAX_RTO (float): Retransmission timeout bounds in seconds.
+    MAX_RETRIES (int): Retransmits before a datagram is given up.
+    MAX_GAP (int): How far behind the newest sequence number a ReceiveWindow remembers.
+    RETRANSMIT_INTERVAL (float): Seconds between two Retransmitter ticks.
+    RETRANSMITS (Retransmitter): The server's retransmitter.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import fragments
+import protocol
+from metrics import STATS
+
+log = logging.getLogger("chat.reliable")
+
+WINDOW_SIZE = 256
+INITIAL_RTO = 0.2
+MIN_RTO = 0.05
+MAX_RTO = 2.0
+MAX_RETRIES = 8
+MAX_GAP = 1024
+RETRANSMIT_INTERVAL = 0.02
+SEQUENCE_MASK = 0xFFFFFFFF
+BITMAP_BITS = 32
+
+class SendWindow:
+
+    def __init__(self, capacity=WINDOW_SIZE):
+        self.capacity = capacity
+        self.next_seq = 1
+        # seq -> [datagram, sent_at, retries, due], oldest first
+        self.unacked = collections.OrderedDict()
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+        self.retransmits = 0
+        self.gave_up = 0
+        # the threaded engine sends, acks and retransmits from different threads
+        self._lock = threading.Lock()
+
+    def push(self, datagram, now):
+        # Returns the sequence number of a datagram about to be sent for the first time.
+        with self._lock:
+            if len(self.unacked) >= self.capacity:
+                self.unacked.popitem(last=False)
+                self._give_up()
+            seq = self.next_seq
+            self.next_seq = (seq + 1) & SEQUENCE_MASK or 1
+            self.unacked[seq] = [datagram, now, 0, now + self.rto]
+            return seq
+
+    def ack(self, cumulative, bitmap, now):
+        # Forgets the datagrams an ack confirms. Returns how many it confirmed.
+        acked = 0
+        unacked = self.unacked
+        with self._lock:
+            while unacked:
+                seq = next(iter(unacked))
+                if seq > cumulative:
+                    break
+                self._sample(unacked.pop(seq), now)
+                acked += 1
+            offset = 0
+            while bitmap:
+                if bitmap & 1:
+                    entry = unacked.pop(cumulative + 2 + offset, None)
+                    if entry is not None:
+                        self._sample(entry, now)
+                        acked += 1
+                bitmap >>= 1
+                offset += 1
+        return acked
+
+    def _sample(self, entry, now):
+        # Karn's rule: a retransmitted datagram's ack could belong to any of its copies
+        if entry[2]:
+            return
+        sample = now - entry[1]
+        if self.srtt is None:
+            self.srtt, self.rttvar = sample, sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def due(self, now):
+        # Returns [(seq, datagram)] to send again now, giving up on exhausted ones.
+        resend = []
+        with self._lock:
+            for seq, entry in list(self.unacked.items()):
+                if entry[3] > now:
+                    continue
+                if entry[2] >= MAX_RETRIES:
+                    del self.unacked[seq]
+                    self._give_up()
+                    continue
+                entry[1] = now
+                entry[2] += 1
+                entry[3] = now + min(MAX_RTO, self.rto * (2 ** entry[2]))
+                resend.append((seq, entry[0]))
+            self.retransmits += len(resend)
+        return resend
+
+    def _give_up(self):
+        self.gave_up += 1
+        if STATS.enabled:
+            STATS.inc("reliable_gave_up")
+
+class ReceiveWindow:
+
+    def __init__(self):
+        # every sequence number up to cumulative has arrived
+        self.cumulative = 0
+        # bit i: cumulative + 1 + i has arrived (bit 0 is never set)
+        self.above = 0
+        self.duplicates = 0
+
+    def received(self, seq):
+        # Records a sequence number; False if it was seen before.
+        offset = seq - self.cumulative - 1
+        if offset < 0 or self.above >> offset & 1:
+            self.duplicates += 1
+            if STATS.enabled:
+                STATS.inc("reliable_duplicates")
+            return False
+        if offset >= MAX_GAP:
+            # far ahead: whatever is older than MAX_GAP behind it is not coming any more
+            skip = offset - MAX_GAP + 1
+            self.cumulative += skip
+            self.above >>= skip
+            offset -= skip
+        self.above |= 1 << offset
+        while self.above & 1:
+            self.above >>= 1
+            self.cumulative += 1
+        return True
+
+    def ack(self):
+        # The ack datagram for the current state.
+        return protocol.encode_ack(self.cumulative & SEQUENCE_MASK, (self.above >> 1) & ((1 << BITMAP_BITS) - 1))
+
+class Link:
+
+    def __init__(self, capacity=WINDOW_SIZE):
+        self.send = SendWindow(capacity)
+        self.receive = ReceiveWindow()
+
+def send(sock, member, datagram, now):
+    # Numbers a delivery to a reliable member, sends it and keeps it for retransmission.
+    # A member without fragmentation is skipped for a delivery it could not receive.
+    if not member.fragmented and len(datagram) + protocol.RELIABLE_HEADER.size > fragments.MAX_DATAGRAM_SIZE:
+        if STATS.enabled:
+            STATS.inc("oversize_dropped")
+        return
+    seq = member.link.send.push(datagram, now)
+    _sendto(sock, member, protocol.encode_reliable(seq, datagram))
+    RETRANSMITS.watch(member)
+
+def _sendto(sock, member, data):
+    if member.fragmented:
+        fragments.sendto(sock, data, member.address)
+    else:
+        sock.sendto(data, member.address)
+
+class Retransmitter:
+
+    def __init__(self):
+        # members with unacked deliveries
+        self.members = set()
+        self._lock = threading.Lock()
+
+    def watch(self, member):
+        if member not in self.members:
+            with self._lock:
+                self.members.add(member)
+
+    def clear(self):
+        with self._lock:
+            self.members.clear()
+
+    def tick(self, sock, now=None):
+        # Resends every delivery whose timeout passed. Returns the number resent.
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            members = list(self.members)
+        resent = 0
+        done = []
+        for member in members:
+            link = member.link
+            if link is None or member.address is None:
+                done.append(member)
+                continue
+            for seq, datagram in link.send.due(now):
+                _sendto(sock, member, protocol.encode_reliable(seq, datagram))
+                resent += 1
+            if not link.send.unacked:
+                done.append(member)
+        if done:
+            with self._lock:
+                for member in done:
+                    # a delivery may have been added since the snapshot above
+                    if member.link is None or member.address is None or not member.link.send.unacked:
+                        self.members.discard(member)
+        if resent and STATS.enabled:
+            STATS.inc("reliable_retransmits", resent)
+        return resent
+
+    def run(self, sock, interval=RETRANSMIT_INTERVAL):
+        # Retransmit loop of the threaded engine.
+        while True:
+            time.sleep(interval)
+            try:
+                self.tick(sock)
+            except Exception as e:
+                log.warning("Error retransmitting: %s", e)
+
+RETRANSMITS = Retransmitter()
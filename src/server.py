@@ -1,153 +1,816 @@
 """
 This module implements a simple online chat messenger system server using TCP and UDP protocols.
 Functions:
+    negotiate_protocol(request, response):
+        Confirms the UDP wire format, compression, reliable delivery and fragmentation
+        requested by a client.
+    password_future(request, address):
+        Starts the password hashing or check a create_room/join_room request needs.
+    process_tcp_request(request, address, session, kdf):
+        apply_tcp_request(), recording the request when the traffic is captured.
+    apply_tcp_request(request, address, session, kdf):
+        Applies a create_room/join_room/list_rooms/search_rooms/top_rooms/leave/heartbeat request
+        and returns the response.
+    handle_control_request(request, address, session, kdf):
+        Answers one request of a persistent control session.
+    serve_control_session(client_socket, address, initial):
+        Serves a length-prefixed control session (see control.py) until the client disconnects.
     handle_tcp_connection(client_socket, address):
-        Handles TCP connections. Receives requests from clients to create or join chat rooms.
-    udp_handler(server_socket):
+        Handles TCP connections: one-shot JSON requests or persistent control sessions.
+    leave_room(sender, room_name, token, username, timed_out):
+        Removes a member and notifies the room over UDP and control sessions.
+    reap_idle_members(sender):
+        Removes the members whose idle timeout expired, closing rooms whose host timed out.
+    reaper(sender, interval):
+        Calls reap_idle_members() every interval seconds (threaded engine).
+    process_udp_packet(server_socket, data, address):
+        Handles a single UDP datagram and distributes messages to all clients in the room.
+    process_ack(data, address):
+        Applies an ack of reliable deliveries to the sender's window.
+    process_compact_packet(server_socket, data, address):
+        Handles a compact datagram, which names its member by id.
+    apply_datagram(server_socket, member, operation, username, message, now, seq):
+        Applies an authenticated datagram of a member (message, heartbeat, leave), acking
+        and deduplicating reliable ones.
+    handle_udp_packet(server_socket, data, address):
+        process_udp_packet() plus metrics (see metrics.py) when they are enabled.
+    dispatch_datagram(sender, data, address):
+        Hands a datagram to handle_udp_packet(), or to the federation in a cluster.
+    udp_handler(server_socket, sender):
         Handles UDP connections. Receives messages from clients and distributes them to all clients in the room.
-    main():
-        Configures and starts the TCP and UDP servers, and handles incoming connections.
+    tune_udp_socket(sock):
+        Applies UDP_RCVBUF and UDP_SNDBUF to a UDP socket.
+    run_threaded(host, tcp_port, udp_port, senders, queue_size, drop_policy):
+        Runs the thread-per-connection engine, optionally with the staged UDP pipeline
+        and outbound coalescing.
+    announce_room(room_name):
+        Publishes the member count of a room to the other cluster nodes.
+    open_federation(node_id, nodes, broker_address):
+        Joins a cluster; rooms owned by other nodes are served through them.
+    open_state_store(directory, snapshot_interval):
+        Restores the registry from a state directory and keeps journaling into it.
+    open_capture(path):
+        Starts recording the incoming traffic to a trace file (see capture.py).
+    main(argv):
+        Parses options and starts the selected engine (thread or asyncio), or the
+        multi-process workers of workers.py when --workers is given.
 Global Variables:
     TCP_PORT (int): The port number for TCP connections.
     UDP_PORT (int): The port number for UDP connections.
     BUFFER_SIZE (int): The buffer size for receiving data.
-    rooms (dict): A dictionary to manage chat rooms and their members.
-    tokens (dict): A dictionary to manage user tokens and their associated information.
+    TCP_BACKLOG (int): The listen backlog of the TCP socket.
+    IDLE_TIMEOUT (float): Seconds without packets or heartbeats before a member is removed.
+    REAP_INTERVAL (float): Seconds between two reaps of idle members.
+    UDP_RCVBUF, UDP_SNDBUF (int): SO_RCVBUF/SO_SNDBUF of the UDP socket, 0 for the OS default.
+    QUEUE_SIZE (int): Capacity of each queue of the staged UDP pipeline.
+    COALESCE_WINDOW (float): Seconds datagrams to one recipient are held for batching, 0 disables.
+    WIRE_PROTOCOLS (tuple): The UDP wire formats a client can negotiate.
+    COMPACT_DATAGRAMS (bool): Whether binary clients get ids for compact datagrams.
+    RELIABLE_DELIVERY (bool): Whether clients may negotiate reliable delivery (see reliable.py).
+    FRAGMENTATION (bool): Whether clients may negotiate fragmented datagrams (see fragments.py).
+    ENGINES (tuple): The selectable I/O engines.
+    DEFAULT_ENGINE (str): The engine used when --engine is not given (env CHAT_ENGINE).
+    registry (RoomRegistry): Manages chat rooms, their members and the tokens issued to them.
+    history (MessageHistory): Recent messages of every room, sent along with join_room responses.
+    limiter (RateLimiter): Token buckets limiting the messages of each member and room.
+    signer (TokenSigner): Issues the signed member tokens and verifies them (see tokens.py).
+    hasher (PasswordHasher): Hashes and checks room passwords on a bounded pool (see passwords.py).
+    directory (RoomDirectory): Sorted index of the rooms for listing and search (see directory.py).
+    reassembly (Reassembler): Fragments of client datagrams waiting for the rest (see fragments.py).
+    udp_transport: The UDP socket or transport of the running engine.
+    state_store (StateStore): Journal and snapshots of the registry, None without --state-dir.
+    federation (Federation): This node of a cluster, None unless --cluster is given.
+    capture (TraceWriter): Trace of the incoming traffic (see capture.py), None without --capture.
+    ROOM_OPERATIONS (tuple): TCP operations a cluster node forwards to the room's owner.
 """
 
+import argparse
+import atexit
+import logging
+import os
+import signal
 import socket
+import sys
 import threading
+import time
 import json
 
+import compression
+import control
+import fragments
+import protocol
+from capture import TraceWriter
+from directory import DEFAULT_LIMIT, TOP_SIZE, RoomDirectory
+from fanout import broadcast_message, broadcast_system, set_batched_send
+from metrics import STATS, configure_logging, start_reporting
+from history import DEFAULT_CAPACITY, DEFAULT_MAX_BYTES, MessageHistory
+from passwords import DEFAULT_WORKERS, MAX_PENDING, Busy, PasswordHasher
+from persistence import StateStore
+from ratelimit import (
+    DEFAULT_ROOM_BURST, DEFAULT_ROOM_RATE, DEFAULT_TOKEN_BURST, DEFAULT_TOKEN_RATE, RateLimiter
+)
+from registry import RoomRegistry
+from reliable import RETRANSMITS, Link
+from tokens import TOKEN_TTL, TokenSigner, load_key
+
 # server settings
 TCP_PORT = 5001
 UDP_PORT = 6001
 BUFFER_SIZE = 4096
+# pending connection queue; room setup storms (e.g. bench/loadgen.py) overflow a small one
+TCP_BACKLOG = 128
+# clients send a heartbeat every few seconds (see client.HEARTBEAT_INTERVAL); a member
+# silent for this long is considered gone
+IDLE_TIMEOUT = 30.0
+REAP_INTERVAL = 1.0
+# kernel buffers of the UDP socket (--rcvbuf/--sndbuf); 0 keeps the OS default
+UDP_RCVBUF = 0
+UDP_SNDBUF = 0
+# capacity of the ingress and egress queues of the staged pipeline (see pipeline.py)
+QUEUE_SIZE = 4096
+# outbound coalescing window in seconds (--coalesce-window, see coalesce.py); 0 disables
+COALESCE_WINDOW = 0.0
+
+# operations a cluster node forwards to the owner of the room
+ROOM_OPERATIONS = ("create_room", "join_room", "leave")
+
+# UDP wire formats a client can negotiate in its TCP request
+WIRE_PROTOCOLS = ("json", "binary")
+# compact datagrams name the member by id only, so they are not offered where datagrams are
+# routed by room name (workers.py, federation.py)
+COMPACT_DATAGRAMS = True
+# reliable delivery keeps per-member windows in this process, so it is not offered where
+# datagrams may be handled by another process (workers.py, federation.py) either
+RELIABLE_DELIVERY = True
+# a datagram's fragments are only reassembled in the process that receives them, and they do
+# not carry the room name the datagrams are routed by (workers.py, federation.py)
+FRAGMENTATION = True
+
+# I/O engines selectable with --engine
+ENGINES = ("thread", "asyncio")
+DEFAULT_ENGINE = os.environ.get("CHAT_ENGINE", "thread")
+
+log = logging.getLogger("chat.server")
 
 # room and token management
-rooms = {}
-tokens = {}
+registry = RoomRegistry()
+# recent messages of every room, sent to members when they join
+history = MessageHistory()
+# per-member and per-room message rate limits
+limiter = RateLimiter()
+# signed member tokens; the registry reads room and member ids back from them
+signer = TokenSigner()
+registry.decode_token = signer.decode
+registry.issue_token = signer.issue
+# room passwords, hashed off the accept loop and the event loop
+hasher = PasswordHasher()
+# rooms by name for list_rooms/search_rooms, kept up to date by the registry
+directory = RoomDirectory()
+registry.directory = directory
+# client datagrams sent in fragments, per source address, until the last one arrives
+reassembly = fragments.Reassembler()
+
+# UDP socket (or asyncio transport) of the running engine, used to notify rooms of
+# leaves requested over TCP
+udp_transport = None
+
+# this node of a cluster (see federation.py), set by open_federation()
+federation = None
+
+# trace of the incoming requests and datagrams (see capture.py), set by open_capture()
+capture = None
+
+# journal and snapshots of the registry (see persistence.py), set by open_state_store()
+state_store = None
+
+def negotiate_protocol(request, response):
+    # Confirms the binary UDP wire format, compressed deliveries, reliable delivery and
+    # fragmented datagrams to clients that ask for them. Clients that do not ask keep using
+    # JSON and get the unchanged response.
+    options = {}
+    if request.get("compression") == compression.NAME and compression.THRESHOLD > 0:
+        options["compressed"] = True
+    if request.get("reliable") is True and RELIABLE_DELIVERY:
+        options["link"] = Link()
+    if request.get("fragments") is True and FRAGMENTATION:
+        options["fragmented"] = True
+    if options and registry.set_delivery(response["token"], **options):
+        if "compressed" in options:
+            response["compression"] = compression.NAME
+        if "link" in options:
+            response["reliable"] = True
+        if "fragmented" in options:
+            response["fragment_size"] = fragments.FRAGMENT_SIZE
+    if request.get("protocol") in WIRE_PROTOCOLS:
+        response["protocol"] = request["protocol"]
+        member = registry.get_member(response["token"])
+        if request["protocol"] == "binary" and COMPACT_DATAGRAMS and member is not None:
+            # lets the client send compact datagrams (protocol.encode_compact)
+            response["room_id"] = member.room_id
+            response["member_id"] = member.id
+
+def password_future(request, address):
+    # Starts the scrypt work of a create_room (hashing the new room's password) or join_room
+    # (checking it against the room's) on the hasher pool. Returns a concurrent.futures.Future,
+    # or None if the request needs none.
+    password = request.get("password")
+    if not password or not isinstance(password, str):
+        return None
+    operation = request.get("operation")
+    if operation == "create_room" and request.get("room_name") not in registry:
+        return hasher.hash(password)
+    if operation == "join_room":
+        room = registry.get_room(request.get("room_name"))
+        if room is not None and room.password is not None:
+            return hasher.verify(room.password, password, address[0])
+    return None
+
+def process_tcp_request(request, address, session=None, kdf=None):
+    response = apply_tcp_request(request, address, session, kdf)
+    if capture is not None:
+        capture.request(request, response, address)
+    return response
+
+def apply_tcp_request(request, address, session=None, kdf=None):
+    # Applies a control request to the room state and returns the response dict.
+    # Shared by the threaded and asyncio engines. session is the control session
+    # (see control.py) the request came from, or None for a one-shot connection.
+    # kdf is the password_future() of the request if the caller already started it (the
+    # asyncio engine awaits it first); otherwise it is started here and waited for.
+    operation = request.get("operation")
+    response = {}
+
+    if federation is not None and operation in ROOM_OPERATIONS:
+        room_name = request.get("room_name")
+        if isinstance(room_name, str) and not federation.is_local(room_name):
+            return federation.forward_request(request, address)
+
+    password = request.get("password")
+    if password is not None and not isinstance(password, str):
+        return {"status": "error", "message": "Malformed password."}
+
+    if operation == "create_room":
+        room_name = request["room_name"]
+        username = request["username"]
+        if room_name in registry:
+            return {"status":  "error", "message":  "Room already exists."}
+        record = None
+        if password:
+            kdf = kdf or password_future(request, address)
+            # None if the room was created since the check above
+            if kdf is None:
+                return {"status":  "error", "message":  "Room already exists."}
+            try:
+                record = kdf.result()
+            except Busy:
+                return {"status": "error", "message": "Server busy, try again."}
+        token = registry.open_room(room_name, username, address[0], record)
+
+        if token is not None:
+            response = {"status": "success", "token": token}
+            negotiate_protocol(request, response)
+            if session is not None:
+                control.SESSIONS.bind(token, session)
+            announce_room(room_name)
+        else:
+            response = {"status":  "error", "message":  "Room already exists."}
+
+    elif operation == "join_room":
+        room_name = request["room_name"]
+        username = request["username"]
+        room = registry.get_room(room_name)
+        if room is not None and room.password is not None:
+            kdf = kdf or password_future(request, address)
+            try:
+                if kdf is None or not kdf.result():
+                    return {"status": "error", "message": "Wrong password."}
+            except Busy:
+                return {"status": "error", "message": "Server busy, try again."}
+        token = registry.admit(room_name, username, address[0]) if room is not None else None
+
+        if token is not None:
+            response = {"status": "success", "token": token}
+            negotiate_protocol(request, response)
+            if history.enabled:
+                # the whole backlog in this one response; "history" may limit the count
+                limit = request.get("history")
+                messages = history.recent(room_name, limit if isinstance(limit, int) else None)
+                packed = compression.compress_history(messages) if "compression" in response else None
+                if packed is None:
+                    response["history"] = messages
+                else:
+                    response["history_zlib"] = packed
+            if session is not None:
+                control.SESSIONS.bind(token, session)
+            room = registry.get_room(room_name)
+            if room is not None:
+                event = {"event": "member_joined", "room_name": room_name, "username": username}
+                control.SESSIONS.push(tuple(room.members), event, exclude=session)
+            announce_room(room_name)
+        else:
+            response = {"status": "error", "message": "Room not found."}
+
+    elif operation in ("list_rooms", "search_rooms"):
+        # one page of the rooms (whose name starts with "prefix"), ordered by name; a response
+        # with "next_cursor" has more, which the same request with that "cursor" returns
+        prefix = request["prefix"] if operation == "search_rooms" else ""
+        cursor = request.get("cursor")
+        limit = request.get("limit")
+        if not isinstance(prefix, str) or not isinstance(cursor, (str, type(None))):
+            return {"status": "error", "message": "Malformed request."}
+        rooms, next_cursor = directory.page(prefix, cursor, limit if isinstance(limit, int) else DEFAULT_LIMIT)
+        response = {"status": "success", "rooms": [{"room_name": name, "members": count} for name, count in rooms]}
+        if next_cursor is not None:
+            response["next_cursor"] = next_cursor
+
+    elif operation == "top_rooms":
+        # the rooms with the most members, from a view refreshed at most every directory.TOP_TTL
+        limit = request.get("limit")
+        rooms = directory.top(limit if isinstance(limit, int) else TOP_SIZE)
+        response = {"status": "success", "rooms": [{"room_name": name, "members": count} for name, count in rooms]}
+
+    elif operation == "leave":
+        room_name = request["room_name"]
+        token = request["token"]
+        member = registry.get_member(token)
+        if member is not None and member.room_name == room_name:
+            leave_room(udp_transport, room_name, token, member.username)
+            response = {"status": "success"}
+        else:
+            response = {"status": "error", "message": "Not a member of the room."}
+
+    elif operation == "heartbeat":
+        # keeps the session's members (or the given token) from expiring
+        tokens = set(session.tokens) if session is not None else set()
+        if request.get("token"):
+            tokens.add(request["token"])
+        for token in tokens:
+            registry.touch(token)
+        response = {"status": "success"}
+
+    else:
+        response = {"status": "error", "message": "Unknown operation."}
+
+    return response
+
+def handle_control_request(request, address, session, kdf=None):
+    # Answers one framed request of a control session, echoing its id.
+    try:
+        response = process_tcp_request(request, address, session, kdf)
+    except (KeyError, TypeError, AttributeError):
+        response = {"status": "error", "message": "Malformed request."}
+    if "id" in request:
+        response["id"] = request["id"]
+    return response
+
+def serve_control_session(client_socket, address, initial):
+    # Serves a persistent control session until the client disconnects.
+    # Requests are answered in order, so clients may pipeline them.
+    session = control.QueuedSession(client_socket, address)
+    reader = control.FrameReader(client_socket, initial)
+    try:
+        while True:
+            request = reader.read_frame()
+            if request is None:
+                break
+            session.send(handle_control_request(request, address, session))
+    finally:
+        control.SESSIONS.forget(session)
 
 def handle_tcp_connection(client_socket, address):
-    # Handles tcp connections. Receives requests from clients and creates or joins chat rooms.
+    # Handles tcp connections. A connection either carries one JSON request (create or join a
+    # chat room) or, if it starts with a frame header, a persistent control session.
     try:
         # receive data from client
-        data = client_socket.recv(BUFFER_SIZE).decode('utf-8')
-        request = json.loads(data)
-        operation = request.get("operation")
-        response = {}
-        
-        if operation == "create_room":
-            room_name = request["room_name"]
-            username = request["username"]
-            token = f"{room_name}-{username}-{address[0]}"
-
-            if room_name not in rooms:
-                rooms[room_name] = {"host": token, "members": [token]}
-                tokens[token] = {"username": username, "ip": address[0]}
-                response = {"status": "success", "token": token}
-            else:
-                response = {"status":  "error", "message":  "Room already exists."}
-        
-        elif operation == "join_room":
-            room_name = request["room_name"]
-            username = request["username"]
-            token = f"{room_name}-{username}-{address[0]}"
-
-            if room_name in rooms:
-                rooms[room_name]["members"].append(token)
-                tokens[token] = {"username": username, "ip": address[0]}
-                response = {"status": "success", "token": token}
-            else:
-                response = {"status": "error", "message": "Room not found."}
-        
-        # send response to client
-        client_socket.send(json.dumps(response).encode('utf-8'))
+        data = client_socket.recv(BUFFER_SIZE)
+        if control.is_legacy_request(data):
+            request = control.read_legacy_request(client_socket, data, BUFFER_SIZE)
+            response = process_tcp_request(request, address)
+
+            # send response to client
+            client_socket.sendall(json.dumps(response).encode('utf-8'))
+        elif data:
+            serve_control_session(client_socket, address, data)
     except Exception as e:
-        print(f"Error handling TCP connection: {e}")
+        log.warning("Error handling TCP connection: %s", e)
     finally:
         client_socket.close()
 
-def udp_handler(server_socket):
+def announce_room(room_name):
+    # Publishes the member count of a room owned here to the other cluster nodes.
+    if federation is not None:
+        room = registry.get_room(room_name)
+        federation.announce(room_name, len(room.members) if room is not None else 0)
+
+def leave_room(sender, room_name, token, username, timed_out=False):
+    # Removes a member and tells the rest of the room, over UDP and over control sessions.
+    # Returns the number of datagrams sent, or None if the token was not in the room.
+    result = registry.leave(room_name, token)
+    if result is None:
+        return None
+    was_host, room = result
+    control.SESSIONS.unbind(token)
+    if was_host:
+        history.drop_room(room_name)
+        text = f"{username} has {'timed out' if timed_out else 'left the room'}.closing the room."
+        event = {"event": "room_closed", "room_name": room_name, "username": username}
+    else:
+        text = f"{username} has {'timed out' if timed_out else 'left the room'}."
+        event = {"event": "member_left", "room_name": room_name, "username": username}
+    if timed_out:
+        event["reason"] = "timeout"
+    sent = broadcast_system(sender, room, text) if sender is not None else 0
+    announce_room(room_name)
+    member_tokens = tuple(room.members)
+    control.SESSIONS.push(member_tokens, event)
+    if was_host:
+        for member_token in member_tokens:
+            control.SESSIONS.unbind(member_token)
+    return sent
+
+def reap_idle_members(sender):
+    # Removes every member whose idle timeout expired. Returns the number removed.
+    expired = registry.expired()
+    for member in expired:
+        log.info("%s timed out in %s", member.username, member.room_name)
+        leave_room(sender, member.room_name, member.token, member.username, timed_out=True)
+    if expired and STATS.enabled:
+        STATS.inc("members_timed_out", len(expired))
+    return len(expired)
+
+def reaper(sender, interval=REAP_INTERVAL):
+    while True:
+        time.sleep(interval)
+        try:
+            reap_idle_members(sender)
+        except Exception as e:
+            log.warning("Error reaping idle members: %s", e)
+
+def process_udp_packet(server_socket, data, address):
+    # Handles a single UDP datagram. server_socket only needs a sendto(data, address) method,
+    # so both a socket and an asyncio DatagramTransport can be passed.
+    # JSON, binary and compact (see protocol.py) datagrams are accepted on the same port.
+    # Returns (operation, room_name, sent) where sent is the number of datagrams sent,
+    # or None if the packet was rejected.
+    if protocol.is_fragment(data):
+        if not FRAGMENTATION:
+            return None, None, None
+        data = reassembly.add(address, data, time.monotonic())
+        if data is None:
+            return "fragment", None, 0
+    if protocol.is_ack(data):
+        return process_ack(data, address)
+    seq = None
+    if protocol.is_reliable(data):
+        seq, data = protocol.decode_reliable(data)
+        data = bytes(data)
+    if protocol.is_compact(data):
+        return process_compact_packet(server_socket, data, address, seq)
+    binary = protocol.is_binary(data)
+    if binary:
+        op, room_name, token, message = protocol.decode_request(data)
+        operation = protocol.OPERATION_NAMES.get(op)
+        username = None
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Received binary UDP data from %s: %s in %s", address, operation, room_name)
+    else:
+        request = json.loads(data.decode('utf-8'))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Received UDP data from %s: %s", address, data.decode('utf-8'))
+        token = request.get("token")
+        room_name = request.get("room_name")
+        operation = request.get("operation")
+        username = request.get("username")
+        message = request.get("message")
+
+    if token is None:
+        log.info("Invalid request: No token provided.")
+        return operation, room_name, None
+    # Check room and token: tokens are only in the registry as issued by this server
+    member = registry.get_member(token)
+    if member is None or member.room_name != room_name:
+        return operation, room_name, None
+
+    now = time.monotonic()
+    if member.address != address or member.binary != binary:
+        # The token claims a new endpoint: check its signature and expiry, then learn where
+        # this client actually receives (its ephemeral port, possibly behind NAT) and in which
+        # format. Clients send a "connect" packet right after joining, which only does this.
+        if signer.verify(token) is None:
+            log.info("Invalid request: Token rejected for %s.", address)
+            return operation, room_name, None
+        registry.update_endpoint(token, address, binary)
+    elif member.expires < time.time():
+        return operation, room_name, None
+    return apply_datagram(server_socket, member, operation, username, message, now, seq)
+
+def process_ack(data, address):
+    # An ack is trusted by its source address, like the deliveries it confirms were addressed.
+    member = registry.member_at(address)
+    if member is None or member.link is None:
+        return "ack", None, None
+    cumulative, bitmap = protocol.decode_ack(data)
+    member.link.send.ack(cumulative, bitmap, time.monotonic())
+    return "ack", member.room_name, 0
+
+def process_compact_packet(server_socket, data, address, seq=None):
+    # Handles a compact datagram: the member is found by id, without hashing any string.
+    op, member_id, tag, message = protocol.decode_compact(data)
+    operation = protocol.OPERATION_NAMES.get(op)
+    member = registry.member_by_id(member_id)
+    if member is None or member.tag != tag:
+        return operation, None, None
+
+    now = time.monotonic()
+    if member.expires < time.time():
+        return operation, member.room_name, None
+    if member.address != address or not member.binary:
+        registry.update_endpoint(member.token, address, True)
+    return apply_datagram(server_socket, member, operation, None, message, now, seq)
+
+def apply_datagram(server_socket, member, operation, username, message, now, seq=None):
+    # The part of the UDP handler shared by all wire formats, once the member is authenticated.
+    # seq is the sequence number of a reliable datagram, None otherwise.
+    room_name = member.room_name
+    # any datagram, heartbeats included, keeps the member alive
+    member.last_seen = now
+    link = member.link
+    if seq is not None and link is not None:
+        # ack every copy, the first ack may have been lost; apply only the first one
+        fresh = link.receive.received(seq)
+        server_socket.sendto(link.receive.ack(), member.address)
+        if not fresh:
+            return operation, room_name, 0
+    if username is None:
+        username = member.username
+
+    sent = 0
+    if operation == "message":
+        room = registry.room_by_id(member.room_id)
+        if room is not None:
+            if limiter.enabled:
+                limited = limiter.allow(member, room, now)
+                if limited is not None:
+                    if STATS.enabled:
+                        STATS.inc(f"rate_limited.{limited}")
+                    return operation, room_name, 0
+            # Each wire format is serialized once and reused for every member
+            sent = broadcast_message(server_socket, room, username, message)
+            history.append(room_name, username, message or "")
+    elif operation == "leave":
+        sent = leave_room(server_socket, room_name, member.token, username) or 0
+    return operation, room_name, sent
+
+def handle_udp_packet(server_socket, data, address):
+    # Handles a single UDP datagram, recording metrics when they are enabled.
+    if capture is not None:
+        capture.datagram(data, address)
+    if not STATS.enabled:
+        process_udp_packet(server_socket, data, address)
+        return
+
+    started = time.perf_counter_ns()
+    try:
+        operation, room_name, sent = process_udp_packet(server_socket, data, address)
+    except ValueError:
+        # json.JSONDecodeError and UnicodeDecodeError are ValueErrors, as are protocol errors
+        STATS.inc("decode_errors")
+        raise
+    STATS.inc(f"packets_in.{operation}")
+    if sent is None:
+        STATS.inc("unknown_tokens")
+    else:
+        STATS.inc(f"packets_out.{operation}", sent)
+        if operation == "message" and sent:
+            STATS.observe("fanout_size", sent)
+            STATS.room_message(room_name)
+    STATS.observe("handler_latency_us", (time.perf_counter_ns() - started) // 1000)
+
+def dispatch_datagram(sender, data, address):
+    if federation is None:
+        handle_udp_packet(sender, data, address)
+    else:
+        # the federation fans out through its own sender, see run_threaded()
+        federation.handle_datagram(data, address)
+
+def udp_handler(server_socket, sender=None):
     # Handles UDP connections. Receives messages from clients and distributes them to all clients in the room.
+    # Responses go out through sender (e.g. a coalesce.Coalescer) if given, else server_socket.
+    sender = server_socket if sender is None else sender
     while True:
         try:
             # receive udp data
             data, address = server_socket.recvfrom(BUFFER_SIZE)
-            print(f"Received UDP data from {address}: {data.decode('utf-8')}")
-            request = json.loads(data.decode('utf-8'))
-            token = request.get("token")
-            room_name = request.get("room_name")
-            operation = request.get("operation")
-
-            if token is None:
-                print("Invalid request: No token provided.")
-                continue
-            # Check room and token
-            if room_name in rooms and token in rooms[room_name]["members"]:
-                if operation == "message":
-                    username = request.get("username")
-                    message_text = request.get("message")
-                    for member_token in rooms[room_name]["members"]:
-                        target = tokens.get(member_token)
-                        if target:
-                            target_ip = target["ip"]
-                            response = {
-                                "status": "success",
-                                "sender": username,
-                                "message": message_text
-                            }
-                            server_socket.sendto(json.dumps(response).encode('utf-8'), (target_ip, UDP_PORT))
-                elif operation == "leave":
-                    username = request.get("username")
-                    if token in rooms[room_name]["members"]:
-                        rooms[room_name]["members"].remove(token)
-                        if token == rooms[room_name]["host"]: 
-                            for member_token in rooms[room_name]["members"]:
-                                target = tokens.get(member_token)
-                                if target:
-                                    target_ip = target["ip"]
-                                    response = {
-                                        "status": "success",
-                                        "system_message": f"{username} has left the room.closing the room."
-                                    }
-                                    server_socket.sendto(json.dumps(response).encode('utf-8'), (target_ip, UDP_PORT))
-                            del rooms[room_name]
-                        else: 
-                            for member_token in rooms[room_name]["members"]:
-                                target = tokens.get(member_token)
-                                if target:
-                                    target_ip = target["ip"]
-                                    response = {
-                                        "status": "success",
-                                        "system_message": f"{username} has left the room."
-                                    }
-                                    server_socket.sendto(json.dumps(response).encode('utf-8'), (target_ip, UDP_PORT))
+            dispatch_datagram(sender, data, address)
         except Exception as e:
-            print(f"Error handling UDP handler: {e}")
+            log.warning("Error handling UDP handler: %s", e)
             # Stop loop if a specific error occurs
             if str(e) == "Stop loop":
                 break
 
-def main():
+def parse_args(argv=None):
+    # Parses command line options for the server.
+    parser = argparse.ArgumentParser(description="Online Chat Messenger server")
+    parser.add_argument("--host", default="0.0.0.0", help="address to bind")
+    parser.add_argument("--tcp-port", type=int, default=TCP_PORT, help="TCP port for room requests")
+    parser.add_argument("--udp-port", type=int, default=UDP_PORT, help="UDP port for chat messages")
+    parser.add_argument("--engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="I/O engine: 'thread' (thread per TCP connection) or 'asyncio'")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="fork this many UDP worker processes sharing UDP_PORT with SO_REUSEPORT (Linux)")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="DEBUG logs every packet")
+    parser.add_argument("--stats-port", type=int, default=0,
+                        help="serve metrics as JSON on http://127.0.0.1:PORT/stats")
+    parser.add_argument("--stats-interval", type=float, default=0,
+                        help="log a metrics snapshot every this many seconds")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="remove members silent for this many seconds (0 disables)")
+    parser.add_argument("--cluster",
+                        help="comma separated node ids of a cluster this server is part of (thread engine)")
+    parser.add_argument("--node-id", help="id of this node in --cluster")
+    parser.add_argument("--broker", default="127.0.0.1:7001",
+                        help="address of the loopback broker (python federation.py) in cluster mode")
+    parser.add_argument("--state-dir",
+                        help="persist rooms and tokens in this directory and restore them on start")
+    parser.add_argument("--snapshot-interval", type=float, default=60.0,
+                        help="seconds between snapshots of the state directory")
+    parser.add_argument("--token-ttl", type=float, default=TOKEN_TTL,
+                        help="seconds a member token stays valid")
+    parser.add_argument("--kdf-workers", type=int, default=DEFAULT_WORKERS,
+                        help="threads hashing room passwords (each scrypt hash takes 16 MiB)")
+    parser.add_argument("--kdf-queue", type=int, default=MAX_PENDING,
+                        help="password hashes queued or running before creates/joins are refused as busy")
+    parser.add_argument("--token-rate", type=float, default=DEFAULT_TOKEN_RATE,
+                        help="messages per second a member may send (0 disables)")
+    parser.add_argument("--token-burst", type=float, default=DEFAULT_TOKEN_BURST,
+                        help="messages a member may send in a burst")
+    parser.add_argument("--room-rate", type=float, default=DEFAULT_ROOM_RATE,
+                        help="messages per second a room may receive (0 disables)")
+    parser.add_argument("--room-burst", type=float, default=DEFAULT_ROOM_BURST,
+                        help="messages a room may receive in a burst")
+    parser.add_argument("--history-size", type=int, default=DEFAULT_CAPACITY,
+                        help="messages kept per room and sent to joining members (0 disables)")
+    parser.add_argument("--history-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="memory cap for the history of all rooms")
+    parser.add_argument("--compress-threshold", type=int, default=compression.THRESHOLD,
+                        help="compress deliveries of at least this many bytes for clients that negotiate it (0 disables)")
+    parser.add_argument("--batched-send", action="store_true",
+                        help="send each broadcast with a single sendmmsg call where available")
+    parser.add_argument("--senders", type=int, default=0,
+                        help="run the UDP path as receive/route/send stages with this many sender threads (thread engine)")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,
+                        help="capacity of each queue between the pipeline stages")
+    parser.add_argument("--drop-policy", choices=("drop_newest", "drop_oldest"), default="drop_newest",
+                        help="datagrams discarded when the pipeline's ingress queue is full")
+    parser.add_argument("--coalesce-window", type=float, default=0,
+                        help="hold datagrams to the same member up to this many milliseconds and send them as one (0 disables)")
+    parser.add_argument("--rcvbuf", type=int, default=0,
+                        help="SO_RCVBUF of the UDP socket in bytes (0 keeps the OS default)")
+    parser.add_argument("--sndbuf", type=int, default=0,
+                        help="SO_SNDBUF of the UDP socket in bytes (0 keeps the OS default)")
+    parser.add_argument("--capture",
+                        help="record every incoming request and datagram to this trace file (see capture.py)")
+    args = parser.parse_args(argv)
+    if args.cluster and (args.workers or args.engine != "thread" or args.node_id not in args.cluster.split(",")):
+        parser.error("--cluster needs the thread engine, no --workers and a --node-id from the cluster")
+    if args.senders and (args.workers or args.engine != "thread"):
+        parser.error("--senders needs the thread engine and no --workers")
+    if args.coalesce_window and args.workers:
+        parser.error("--coalesce-window is not supported with --workers")
+    if args.capture and args.workers:
+        parser.error("--capture is not supported with --workers")
+    if args.kdf_workers < 1 or args.kdf_queue < 1:
+        parser.error("--kdf-workers and --kdf-queue must be at least 1")
+    return args
+
+def tune_udp_socket(sock):
+    # The kernel may cap the sizes (net.core.rmem_max/wmem_max); the granted size is logged.
+    for option, size, name in ((socket.SO_RCVBUF, UDP_RCVBUF, "SO_RCVBUF"), (socket.SO_SNDBUF, UDP_SNDBUF, "SO_SNDBUF")):
+        if size:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+            log.info("%s of the UDP socket is %d bytes", name, sock.getsockopt(socket.SOL_SOCKET, option))
+
+def run_threaded(host="0.0.0.0", tcp_port=TCP_PORT, udp_port=UDP_PORT, senders=0, queue_size=QUEUE_SIZE,
+                 drop_policy="drop_newest"):
     # Configure TCP socket
     tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    tcp_socket.bind(("0.0.0.0", TCP_PORT))
-    tcp_socket.listen(5)
+    # lets a restarted server bind while connections of the previous one are in TIME_WAIT
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp_socket.bind((host, tcp_port))
+    tcp_socket.listen(TCP_BACKLOG)
 
     # Configure UDP socket
+    global udp_transport
     udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    udp_socket.bind(("0.0.0.0", UDP_PORT))
+    tune_udp_socket(udp_socket)
+    udp_socket.bind((host, udp_port))
+    sender = udp_socket
+    if senders > 0:
+        # fan-outs are queued to the sender threads instead of being sent by the handler
+        from pipeline import Pipeline
+        pipeline = Pipeline(udp_socket, dispatch_datagram, senders, queue_size, drop_policy, buffer_size=BUFFER_SIZE)
+        sender = pipeline.sender
+    if COALESCE_WINDOW > 0:
+        from coalesce import Coalescer
+        coalescer = Coalescer(sender, COALESCE_WINDOW, BUFFER_SIZE)
+        threading.Thread(target=coalescer.run, daemon=True).start()
+        sender = coalescer
+    # in a cluster, fan-outs go through the federation's sender, which relays remote members
+    udp_transport = federation.attach(sender) if federation is not None else sender
 
-    print(f"Server is running on TCP:{TCP_PORT} and UDP:{UDP_PORT}")
+    log.info("Server is running on TCP:%d and UDP:%d", tcp_port, udp_port)
 
     # Start UDP handler in a separate thread
-    threading.Thread(target=udp_handler, args=(udp_socket,), daemon=True).start()
+    if senders > 0:
+        pipeline.route_sender = sender
+        pipeline.start()
+    else:
+        threading.Thread(target=udp_handler, args=(udp_socket, sender), daemon=True).start()
+    threading.Thread(target=reaper, args=(udp_transport,), daemon=True).start()
+    if RELIABLE_DELIVERY:
+        threading.Thread(target=RETRANSMITS.run, args=(udp_transport,), daemon=True).start()
 
     # Wait for TCP connection
     while True:
         client_socket, address = tcp_socket.accept()
         threading.Thread(target=handle_tcp_connection, args=(client_socket, address), daemon=True).start()
 
+def open_federation(node_id, nodes, broker_address):
+    # Imported lazily: federation imports workers, which imports this module
+    global federation, COMPACT_DATAGRAMS, RELIABLE_DELIVERY, FRAGMENTATION
+    import federation as federation_module
+    COMPACT_DATAGRAMS = False
+    RELIABLE_DELIVERY = False
+    FRAGMENTATION = False
+    host, port = broker_address.rsplit(":", 1)
+    broker = federation_module.LoopbackBroker(host, int(port))
+    federation = federation_module.Federation(node_id, nodes, broker, process_tcp_request, handle_udp_packet)
+    # rooms announced by the other nodes are listed and searched along with the local ones
+    federation.directory = directory
+    return federation
+
+def open_state_store(directory, snapshot_interval=60.0):
+    global state_store
+    # restored tokens stay valid only if they are checked with the key they were signed with
+    os.makedirs(directory, exist_ok=True)
+    signer.key = load_key(os.path.join(directory, "token.key"))
+    state_store = StateStore(directory, registry, snapshot_interval=snapshot_interval)
+    state_store.recover()
+    state_store.start()
+    atexit.register(state_store.close)
+    # a plain SIGTERM would skip atexit and lose the last batch of the journal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    return state_store
+
+def open_capture(path):
+    global capture
+    capture = TraceWriter(path)
+    atexit.register(capture.close)
+    # a plain SIGTERM would skip atexit and lose the buffered end of the trace
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("Capturing the incoming traffic to %s", path)
+    return capture
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(args.log_level)
+    if args.batched_send and not set_batched_send(True):
+        log.warning("sendmmsg is not available on this platform; sending one datagram per member.")
+    history.configure(args.history_size, args.history_bytes)
+    registry.set_idle_timeout(args.idle_timeout)
+    limiter.configure(args.token_rate, args.token_burst, args.room_rate, args.room_burst)
+    signer.ttl = args.token_ttl
+    hasher.configure(args.kdf_workers, args.kdf_queue)
+    compression.THRESHOLD = args.compress_threshold
+    global UDP_RCVBUF, UDP_SNDBUF, COALESCE_WINDOW
+    UDP_RCVBUF, UDP_SNDBUF = args.rcvbuf, args.sndbuf
+    COALESCE_WINDOW = args.coalesce_window / 1000.0
+
+    if args.workers > 0:
+        import workers
+        # every worker reports its own metrics, see workers.py
+        workers.run_workers(args.workers, args.host, args.tcp_port, args.udp_port,
+                            args.stats_port, args.stats_interval, args.state_dir, args.snapshot_interval)
+        return
+    if args.state_dir:
+        open_state_store(args.state_dir, args.snapshot_interval)
+    if args.capture:
+        open_capture(args.capture)
+    if args.cluster:
+        open_federation(args.node_id, args.cluster.split(","), args.broker)
+    if args.stats_port or args.stats_interval:
+        start_reporting(args.stats_port, args.stats_interval)
+
+    if args.engine == "asyncio":
+        # Imported lazily so the threaded engine does not pay for asyncio setup
+        import aio_server
+        aio_server.run(args.host, args.tcp_port, args.udp_port)
+    else:
+        run_threaded(args.host, args.tcp_port, args.udp_port, args.senders, args.queue_size, args.drop_policy)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Run through the importable module: aio_server and workers import `server`, and a
+    # script runs as __main__, which would give them a second, unconfigured registry.
+    import server
+    server.main()
@@ -0,0 +1,139 @@
+"""
+Tests for the asyncio client library.
+Runs ChatClient sessions against the asyncio engine on ephemeral localhost ports: messages
+arrive through the async iterator and callbacks, room events through the control session,
+many sessions share one event loop, reliable sessions recover a lost delivery or leave, and
+messages larger than the datagram buffer travel in fragments.
+"""
+
+import unittest
+import sys
+import os
+import asyncio
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from aio_client import ChatClient
+from aio_server import start
+from server import registry, history
+
+class TestChatClient(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        registry.clear()
+        history.clear()
+        self.tcp_server, self.udp_transport = await start("127.0.0.1", 0, 0)
+        self.tcp_port = self.tcp_server.sockets[0].getsockname()[1]
+        self.udp_port = self.udp_transport.get_extra_info("sockname")[1]
+        self.clients = []
+
+    async def asyncTearDown(self):
+        for chat in self.clients:
+            await chat.close()
+        self.tcp_server.close()
+        await self.tcp_server.wait_closed()
+        self.udp_transport.close()
+        registry.clear()
+        history.clear()
+
+    def client(self, **options):
+        chat = ChatClient("127.0.0.1", self.tcp_port, self.udp_port, **options)
+        self.clients.append(chat)
+        return chat
+
+    async def wait_for(self, condition, timeout=5.0):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition():
+            self.assertLess(asyncio.get_running_loop().time(), deadline)
+            await asyncio.sleep(0.01)
+
+    async def test_messages_and_events(self):
+        events = []
+        host = self.client(on_event=events.append)
+        self.assertEqual((await host.create_room("room", "host"))["status"], "success")
+        guest = self.client(wire_protocol="json")
+        self.assertEqual((await guest.join_room("room", "guest"))["status"], "success")
+        await self.wait_for(lambda: len(registry.get_room("room").addresses) == 2)
+
+        guest.send("hello")
+        delivery = await asyncio.wait_for(host.__anext__(), 5)
+        self.assertEqual((delivery["sender"], delivery["message"]), ("guest", "hello"))
+        self.assertEqual(events[0]["event"], "member_joined")
+
+        rooms = await guest.search_rooms("ro")
+        self.assertEqual(rooms["rooms"], [{"room_name": "room", "members": 2}])
+
+        await guest.leave()
+        self.assertEqual(await asyncio.wait_for(host.__anext__(), 5),
+                         {"status": "success", "system_message": "guest has left the room."})
+        await host.close()
+        self.assertEqual([delivery async for delivery in host], [])
+
+    async def test_many_sessions_share_one_loop(self):
+        received = []
+        host = self.client(control_session=False, on_message=received.append)
+        await host.create_room("crowd", "host")
+        guests = [self.client(control_session=False, on_message=received.append) for _ in range(100)]
+        responses = await asyncio.gather(*(guest.join_room("crowd", f"guest-{index}") for index, guest in enumerate(guests)))
+        self.assertTrue(all(response["status"] == "success" for response in responses))
+        await self.wait_for(lambda: len(registry.get_room("crowd").addresses) == 101)
+
+        host.send("welcome")
+        await self.wait_for(lambda: len(received) == 101)
+        self.assertTrue(all(delivery["message"] == "welcome" for delivery in received))
+
+    async def test_reliable_sessions_recover_lost_datagrams(self):
+        received = []
+        host = self.client(reliable=True, on_message=received.append)
+        self.assertTrue((await host.create_room("room", "host"))["reliable"])
+        guest = self.client(reliable=True, wire_protocol="binary")
+        await guest.join_room("room", "guest")
+        await self.wait_for(lambda: len(registry.get_room("room").reliable_members) == 2)
+
+        # the host loses the first delivery; the server resends it after its timeout
+        endpoint = host.transport.get_protocol()
+        receive, lost = endpoint.datagram_received, []
+        endpoint.datagram_received = lambda data, address: lost.append(data) if not lost else receive(data, address)
+        for index in range(3):
+            guest.send(f"message {index}")
+        await self.wait_for(lambda: len(received) == 3)
+        self.assertEqual(sorted(delivery["message"] for delivery in received), ["message 0", "message 1", "message 2"])
+        await self.wait_for(lambda: not guest.link.send.unacked and not registry.get_member(host.token).link.send.unacked)
+        self.assertEqual(len(lost), 1)
+
+    async def test_lost_leave_is_retransmitted_before_closing(self):
+        host = self.client(reliable=True)
+        await host.create_room("room", "host")
+        guest = self.client(reliable=True)
+        await guest.join_room("room", "guest")
+        await self.wait_for(lambda: len(registry.get_room("room").reliable_members) == 2)
+
+        # the first leave datagram is lost
+        transport = guest.transport
+        send, lost = transport.sendto, []
+        transport.sendto = lambda data, *address: lost.append(data) if not lost else send(data, *address)
+        await guest.leave()
+        self.assertEqual(len(lost), 1)
+        self.assertTrue(guest.closed)
+        self.assertEqual([member.username for member in registry.get_room("room").members.values()], ["host"])
+
+    async def test_large_messages_travel_in_fragments(self):
+        received = []
+        host = self.client(reliable=True, on_message=received.append)
+        self.assertEqual((await host.create_room("room", "host"))["fragment_size"], 1200)
+        guest = self.client(wire_protocol="json", compression=False)
+        await guest.join_room("room", "guest")
+        await self.wait_for(lambda: len(registry.get_room("room").fragment_addresses) == 2)
+
+        # random text does not compress below the 4096 byte datagram buffer
+        message = os.urandom(10000).hex()
+        self.assertGreater(guest.send(message), 20000)
+        await self.wait_for(lambda: received)
+        self.assertEqual(received[0]["message"], message)
+        # the guest gets its own message back, reassembled as well
+        delivery = await asyncio.wait_for(guest.__anext__(), 5)
+        self.assertEqual(delivery["message"], message)
+        await self.wait_for(lambda: not registry.get_member(host.token).link.send.unacked)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Tests for the asyncio engine of the chat server.
+The endpoints are bound to ephemeral ports on localhost and driven with real
+sockets, so the same room state as the threaded engine is exercised end to end.
+"""
+
+import unittest
+import sys
+import os
+import json
+import asyncio
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from aio_server import start
+from server import registry
+
+class TestAsyncioEngine(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        registry.clear()
+        self.tcp_server, self.udp_transport = await start("127.0.0.1", 0, 0)
+        self.tcp_port = self.tcp_server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.tcp_server.close()
+        await self.tcp_server.wait_closed()
+        self.udp_transport.close()
+        registry.clear()
+
+    async def request(self, request_data):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.tcp_port)
+        writer.write(json.dumps(request_data).encode('utf-8'))
+        await writer.drain()
+        data = await reader.read()
+        writer.close()
+        return json.loads(data.decode('utf-8'))
+
+    async def test_create_and_join_room(self):
+        response = await self.request({"operation": "create_room", "room_name": "test_room", "username": "host_user"})
+        self.assertEqual(response["status"], "success")
+        self.assertEqual(registry.get_room("test_room").host, response["token"])
+
+        response = await self.request({"operation": "join_room", "room_name": "test_room", "username": "new_user"})
+        self.assertEqual(response["status"], "success")
+        self.assertTrue(registry.is_member("test_room", response["token"]))
+        self.assertEqual(len(registry.get_room("test_room").members), 2)
+
+    async def test_password_is_checked_off_the_loop(self):
+        created = await self.request({"operation": "create_room", "room_name": "locked", "username": "host_user",
+                                      "password": "secret"})
+        self.assertEqual(created["status"], "success")
+        refused = await self.request({"operation": "join_room", "room_name": "locked", "username": "guest",
+                                      "password": "guess"})
+        self.assertEqual(refused, {"status": "error", "message": "Wrong password."})
+        joined = await self.request({"operation": "join_room", "room_name": "locked", "username": "guest",
+                                     "password": "secret"})
+        self.assertEqual(joined["status"], "success")
+
+    async def test_udp_leave_closes_room(self):
+        created = await self.request({"operation": "create_room", "room_name": "test_room", "username": "host_user"})
+        leave_data = {
+            "operation": "leave",
+            "token": created["token"],
+            "room_name": "test_room",
+            "username": "host_user"
+        }
+        udp_port = self.udp_transport.get_extra_info("sockname")[1]
+        loop = asyncio.get_running_loop()
+        client, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=("127.0.0.1", udp_port))
+        with patch('builtins.print'):
+            client.sendto(json.dumps(leave_data).encode('utf-8'))
+            for _ in range(50):
+                if "test_room" not in registry:
+                    break
+                await asyncio.sleep(0.01)
+        client.close()
+
+        self.assertNotIn("test_room", registry)
@@ -0,0 +1,108 @@
+"""
+Tests for traffic capture.
+Checks that trace records read back as written and that the server records answered TCP
+requests with the token it issued and every datagram it handles, and that a replay
+(bench/replay.py) maps the recorded tokens of TCP requests to the ones it issues.
+"""
+
+import unittest
+import sys
+import os
+import json
+import tempfile
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'bench')))
+
+import replay
+import server
+from capture import KIND_DATAGRAM, KIND_REQUEST, TraceWriter, read_trace
+from server import handle_tcp_connection, udp_handler, registry, history
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "traffic.trace")
+
+    def tearDown(self):
+        server.capture = None
+        registry.clear()
+        history.clear()
+        self.directory.cleanup()
+
+    def test_records_read_back_in_order(self):
+        writer = TraceWriter(self.path)
+        writer.request({"operation": "list_rooms"}, {"status": "success", "rooms": []}, ('127.0.0.1', 40000))
+        writer.datagram(b"\xc1\x01payload", ('::1', 12345))
+        writer.close()
+        records = list(read_trace(self.path))
+        self.assertEqual([(kind, address) for kind, _, address, _ in records],
+                         [(KIND_REQUEST, ('127.0.0.1', 40000)), (KIND_DATAGRAM, ('::1', 12345))])
+        self.assertEqual(json.loads(records[0][3]), {"request": {"operation": "list_rooms"}, "token": None})
+        self.assertEqual(records[1][3], b"\xc1\x01payload")
+        self.assertLessEqual(records[0][1], records[1][1])
+
+    def test_truncated_trace_is_rejected(self):
+        writer = TraceWriter(self.path)
+        writer.datagram(b"x" * 100, ('127.0.0.1', 12345))
+        writer.close()
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        with self.assertRaises(ValueError):
+            list(read_trace(self.path))
+        with open(self.path, "wb") as f:
+            f.write(b"not a trace")
+        with self.assertRaises(ValueError):
+            list(read_trace(self.path))
+
+    def test_server_records_requests_and_datagrams(self):
+        server.capture = TraceWriter(self.path)
+        mock_socket = MagicMock()
+        mock_socket.recv.return_value = json.dumps({"operation": "create_room", "room_name": "test_room",
+                                                    "username": "host_user"}).encode('utf-8')
+        handle_tcp_connection(mock_socket, ('127.0.0.1', 40000))
+        token = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))["token"]
+        connect = json.dumps({"operation": "connect", "token": token, "room_name": "test_room",
+                              "username": "host_user"}).encode('utf-8')
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = [(connect, ('127.0.0.1', 12345)), (b"garbage", ('127.0.0.1', 12346)),
+                                            Exception("Stop loop")]
+        with patch('builtins.print'):
+            udp_handler(mock_socket)
+        server.capture.close()
+
+        records = list(read_trace(self.path))
+        self.assertEqual([kind for kind, _, _, _ in records], [KIND_REQUEST, KIND_DATAGRAM, KIND_DATAGRAM])
+        self.assertEqual(json.loads(records[0][3])["token"], token)
+        self.assertEqual([data for _, _, _, data in records[1:]], [connect, b"garbage"])
+
+    def request(self, request, address=('127.0.0.1', 40000)):
+        mock_socket = MagicMock()
+        mock_socket.recv.return_value = json.dumps(request).encode('utf-8')
+        handle_tcp_connection(mock_socket, address)
+        return json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))
+
+    def test_replayed_leave_uses_the_issued_token(self):
+        server.capture = TraceWriter(self.path)
+        host = self.request({"operation": "create_room", "room_name": "test_room", "username": "host_user"})
+        guest = self.request({"operation": "join_room", "room_name": "test_room", "username": "guest_user"})
+        self.assertEqual(self.request({"operation": "leave", "room_name": "test_room", "token": guest["token"]})["status"],
+                         "success")
+        server.capture.close()
+        server.capture = None
+        registry.clear()
+
+        # another room first, so the replay issues other ids and therefore other tokens
+        self.request({"operation": "create_room", "room_name": "other_room", "username": "someone"})
+        counts = replay.replay(list(read_trace(self.path)), 0)
+        self.assertEqual((counts["requests"], counts["errors"]), (3, 0))
+        room = registry.get_room("test_room")
+        self.assertNotIn(host["token"], room.members)
+        self.assertEqual([member.username for member in room.members.values()], ["host_user"])
+
+if __name__ == '__main__':
+    unittest.main()
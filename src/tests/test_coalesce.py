@@ -0,0 +1,63 @@
+"""
+Tests for outbound coalescing.
+Checks that datagrams for the same recipient are sent as one batch that the client
+unpacks, that batches stay within the size limit, and that a lone datagram is sent as is.
+"""
+
+import unittest
+import sys
+import os
+import json
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from client import decode_responses
+from coalesce import Coalescer
+from protocol import encode_message, is_batch
+
+class TestCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.mock_socket = MagicMock()
+        self.timers = []
+        self.coalescer = Coalescer(self.mock_socket, 0.005, 4096, lambda delay, callback: self.timers.append(callback))
+
+    def test_datagrams_to_one_recipient_are_batched(self):
+        address = ("127.0.0.1", 40000)
+        self.coalescer.sendto(json.dumps({"status": "success", "sender": "a", "message": "one"}).encode('utf-8'), address)
+        self.coalescer.sendto(encode_message("b", b"two"), address)
+        self.coalescer.sendto(b"lonely", ("127.0.0.1", 40001))
+
+        # one flush is armed for the whole window
+        self.assertEqual(len(self.timers), 1)
+        self.mock_socket.sendto.assert_not_called()
+        self.timers[0]()
+
+        sent = {call[0][1]: call[0][0] for call in self.mock_socket.sendto.call_args_list}
+        self.assertTrue(is_batch(sent[address]))
+        self.assertEqual(decode_responses(sent[address]),
+                         [{"status": "success", "sender": "a", "message": "one"},
+                          {"status": "success", "sender": "b", "message": "two"}])
+        self.assertEqual(sent[("127.0.0.1", 40001)], b"lonely")
+
+    def test_batches_stay_within_the_size_limit(self):
+        address = ("127.0.0.1", 40000)
+        message = encode_message("a", b"x" * 1000)
+        for _ in range(9):
+            self.coalescer.sendto(message, address)
+        for callback in self.timers:
+            callback()
+
+        sizes = [len(call[0][0]) for call in self.mock_socket.sendto.call_args_list]
+        self.assertTrue(all(size <= 4096 for size in sizes), sizes)
+        messages = sum(len(decode_responses(call[0][0])) for call in self.mock_socket.sendto.call_args_list)
+        self.assertEqual(messages, 9)
+
+    def test_oversized_datagram_is_sent_immediately(self):
+        self.coalescer.sendto(b"x" * 4096, ("127.0.0.1", 40000))
+        self.mock_socket.sendto.assert_called_once_with(b"x" * 4096, ("127.0.0.1", 40000))
+        self.assertEqual(self.timers, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Tests for compressed deliveries.
+Round-trips deliveries and join histories, checks the size threshold and that the preset
+dictionary beats plain zlib on chat text, and rejects corrupt or oversized data.
+"""
+
+import unittest
+import sys
+import os
+import json
+import zlib
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import compression
+from protocol import encode_message
+
+class TestCompression(unittest.TestCase):
+
+    def delivery(self, text):
+        return json.dumps({"status": "success", "sender": "host_user", "message": text}).encode('utf-8')
+
+    def test_round_trip(self):
+        for datagram in (self.delivery("hi everyone, how are you doing today? " * 20),
+                         encode_message("host_user", "thank you so much for your help! ".encode('utf-8') * 20)):
+            wrapped = compression.wrap(datagram)
+            self.assertTrue(compression.is_compressed(wrapped))
+            self.assertLess(len(wrapped), len(datagram))
+            self.assertEqual(compression.unwrap(wrapped), datagram)
+
+    def test_small_or_incompressible_deliveries_are_left_alone(self):
+        small = self.delivery("hi")
+        self.assertIs(compression.wrap(small), small)
+        noise = encode_message("host_user", os.urandom(600))
+        self.assertIs(compression.wrap(noise), noise)
+        self.assertFalse(compression.is_compressed(noise))
+
+    def test_dictionary_helps_single_messages(self):
+        datagram = self.delivery("sorry, I was away from my keyboard. did anyone see the message I sent about the meeting "
+                                 "this morning? let me know what you think about it when you are ready.")
+        self.assertLess(len(compression.compress(datagram)), len(zlib.compress(datagram, compression.LEVEL)) * 0.8)
+
+    def test_corrupt_or_oversized_data_is_rejected(self):
+        wrapped = compression.wrap(self.delivery("good morning everyone! " * 30))
+        with self.assertRaises(ValueError):
+            compression.unwrap(wrapped[:-4])
+        with self.assertRaises(ValueError):
+            compression.unwrap(wrapped[:2] + b"\xff" * 20)
+        with self.assertRaises(ValueError):
+            compression.decompress(compression.compress(b"\0" * 100000), max_size=1000)
+
+    def test_history_round_trip(self):
+        messages = [{"sender": f"user{index}", "message": "see you all tomorrow!", "timestamp": 1700000000.0 + index}
+                    for index in range(50)]
+        packed = compression.compress_history(messages)
+        self.assertLess(len(packed), len(json.dumps(messages)) / 3)
+        self.assertEqual(compression.decompress_history(packed), messages)
+        self.assertIsNone(compression.compress_history(messages[:1]))
+        with self.assertRaises(ValueError):
+            compression.decompress_history("not base64!")
+
+    def test_dictionary_is_part_of_the_name(self):
+        self.assertEqual(compression.NAME, f"zlib-{zlib.adler32(compression.DICTIONARY):08x}")
+        self.assertEqual(compression.DICTIONARY, compression.train_dictionary(compression._CHAT_SAMPLES)
+                         + "".join(compression._SKELETONS).encode('utf-8'))
+
+if __name__ == '__main__':
+    unittest.main()
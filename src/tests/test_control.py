@@ -0,0 +1,138 @@
+"""
+Tests for the persistent control sessions.
+Checks the framing, then runs pipelined sessions against the threaded TCP handler
+over a socketpair and checks responses, ids and pushed room events.
+"""
+
+import unittest
+import sys
+import os
+import json
+import socket
+import threading
+import logging
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from control import FrameReader, QueuedSession, SESSIONS, encode_frame, is_legacy_request, read_legacy_request
+from server import handle_tcp_connection, registry
+
+class TestFraming(unittest.TestCase):
+
+    def test_round_trip_with_split_reads(self):
+        client_socket, server_socket = socket.socketpair()
+        frames = encode_frame({"operation": "heartbeat", "id": 1}) + encode_frame({"operation": "list_rooms", "id": 2})
+        # deliver the bytes in awkward pieces
+        for index in range(0, len(frames), 3):
+            client_socket.sendall(frames[index:index + 3])
+        client_socket.close()
+
+        reader = FrameReader(server_socket)
+        self.assertEqual(reader.read_frame(), {"operation": "heartbeat", "id": 1})
+        self.assertEqual(reader.read_frame(), {"operation": "list_rooms", "id": 2})
+        self.assertIsNone(reader.read_frame())
+        server_socket.close()
+
+    def test_oversized_frame_is_rejected(self):
+        client_socket, server_socket = socket.socketpair()
+        client_socket.sendall(b"\x01\x00\x00\x00")
+        with self.assertRaises(ValueError):
+            FrameReader(server_socket).read_frame()
+        client_socket.close()
+        server_socket.close()
+
+    def test_legacy_detection(self):
+        self.assertTrue(is_legacy_request(b'{"operation": "create_room"}'))
+        self.assertFalse(is_legacy_request(encode_frame({"operation": "heartbeat"})))
+
+    def test_legacy_request_spanning_reads(self):
+        client_socket, server_socket = socket.socketpair()
+        client_socket.sendall(b'"room_name": "room1"}')
+        request = read_legacy_request(server_socket, b'{"operation": "join_room", ')
+        self.assertEqual(request, {"operation": "join_room", "room_name": "room1"})
+        client_socket.close()
+        server_socket.close()
+
+class TestControlSession(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        SESSIONS.clear()
+        logging.getLogger("chat").disabled = True
+        self.connections = []
+
+    def tearDown(self):
+        for client_socket, thread in self.connections:
+            client_socket.close()
+            thread.join(timeout=2)
+        registry.clear()
+        SESSIONS.clear()
+        logging.getLogger("chat").disabled = False
+
+    def open_session(self, ip):
+        client_socket, server_socket = socket.socketpair()
+        thread = threading.Thread(target=handle_tcp_connection, args=(server_socket, (ip, 40000)))
+        thread.start()
+        self.connections.append((client_socket, thread))
+        return client_socket, FrameReader(client_socket)
+
+    def test_pipelined_requests_are_answered_in_order(self):
+        client_socket, reader = self.open_session("127.0.0.1")
+        client_socket.sendall(
+            encode_frame({"id": 1, "operation": "create_room", "room_name": "room1", "username": "host"})
+            + encode_frame({"id": 2, "operation": "list_rooms"})
+            + encode_frame({"id": 3, "operation": "heartbeat"})
+            + encode_frame({"id": 4, "operation": "bogus"})
+        )
+
+        created = reader.read_frame()
+        self.assertEqual(created["id"], 1)
+        self.assertEqual(created["status"], "success")
+        self.assertEqual(registry.get_member(created["token"]).username, "host")
+        self.assertEqual(reader.read_frame(), {"id": 2, "status": "success", "rooms": [{"room_name": "room1", "members": 1}]})
+        self.assertEqual(reader.read_frame(), {"id": 3, "status": "success"})
+        self.assertEqual(reader.read_frame()["status"], "error")
+
+    def test_members_receive_join_and_leave_events(self):
+        host_socket, host_reader = self.open_session("127.0.0.1")
+        host_socket.sendall(encode_frame({"id": 1, "operation": "create_room", "room_name": "room1", "username": "host"}))
+        self.assertEqual(host_reader.read_frame()["status"], "success")
+
+        guest_socket, guest_reader = self.open_session("127.0.0.2")
+        guest_socket.sendall(encode_frame({"id": 1, "operation": "join_room", "room_name": "room1", "username": "guest"}))
+        joined = guest_reader.read_frame()
+        self.assertEqual(joined["status"], "success")
+        self.assertEqual(host_reader.read_frame(), {"event": "member_joined", "room_name": "room1", "username": "guest"})
+
+        guest_socket.sendall(encode_frame({"id": 2, "operation": "leave", "room_name": "room1", "token": joined["token"]}))
+        self.assertEqual(guest_reader.read_frame(), {"id": 2, "status": "success"})
+        self.assertEqual(host_reader.read_frame(), {"event": "member_left", "room_name": "room1", "username": "guest"})
+        self.assertFalse(registry.is_member("room1", joined["token"]))
+
+    def test_client_that_stops_reading_is_dropped_without_blocking(self):
+        client_socket, server_socket = socket.socketpair()
+        client_socket.setblocking(False)
+        session = QueuedSession(server_socket, ("127.0.0.1", 40000), outbox_size=4)
+        SESSIONS.bind("token", session)
+        # the client never reads, so the socket buffers and then the outbox fill up
+        event = {"event": "member_joined", "room_name": "room1", "username": "x" * 65536}
+        for _ in range(64):
+            SESSIONS.push(["token"], event)
+            if session.closed:
+                break
+        self.assertTrue(session.closed)
+        # the socket was shut down, so the session's reader sees the end of the stream
+        self.assertEqual(server_socket.recv(4096), b"")
+        client_socket.close()
+        server_socket.close()
+
+    def test_legacy_request_still_served(self):
+        client_socket, server_socket = socket.socketpair()
+        client_socket.sendall(json.dumps({"operation": "create_room", "room_name": "room1", "username": "host"}).encode('utf-8'))
+        handle_tcp_connection(server_socket, ("127.0.0.1", 40000))
+        response = json.loads(client_socket.recv(4096).decode('utf-8'))
+        self.assertEqual(response["status"], "success")
+        client_socket.close()
+
+if __name__ == '__main__':
+    unittest.main()
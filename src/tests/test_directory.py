@@ -0,0 +1,88 @@
+"""
+Tests for the room directory.
+Pages through the sorted index with cursors, searches by prefix ignoring case, checks
+that the top rooms view is cached, and that the registry and the list_rooms/search_rooms/
+top_rooms requests keep and read the directory.
+"""
+
+import unittest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from directory import RoomDirectory
+from server import process_tcp_request, registry, history
+
+class TestRoomDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = RoomDirectory()
+        for index in range(25):
+            self.directory.update(f"room-{index:02d}", index)
+
+    def test_pages_follow_the_cursor(self):
+        rooms, cursor = self.directory.page(limit=10)
+        self.assertEqual([name for name, _ in rooms], [f"room-{index:02d}" for index in range(10)])
+        self.assertEqual(cursor, "room-09")
+        # rooms created and closed between two pages do not shift the next page
+        self.directory.update("room-00a", 1)
+        self.directory.remove("room-10")
+        rooms, cursor = self.directory.page(cursor=cursor, limit=10)
+        self.assertEqual(rooms[0], ("room-11", 11))
+        rooms, cursor = self.directory.page(cursor=cursor, limit=10)
+        self.assertEqual(len(rooms), 4)
+        self.assertIsNone(cursor)
+
+    def test_prefix_search_ignores_case(self):
+        self.directory.update("Chat-Lobby", 3)
+        self.directory.update("chat-dev", 2)
+        self.directory.update("chatter", 1)
+        rooms, cursor = self.directory.page("CHAT-")
+        self.assertEqual(rooms, [("chat-dev", 2), ("Chat-Lobby", 3)])
+        self.assertIsNone(cursor)
+        self.assertEqual(self.directory.page("room-2", limit=3), ([("room-20", 20), ("room-21", 21), ("room-22", 22)], "room-22"))
+        self.assertEqual(self.directory.page("nothing"), ([], None))
+
+    def test_top_view_is_cached(self):
+        self.assertEqual(self.directory.top(3, now=100.0), [("room-24", 24), ("room-23", 23), ("room-22", 22)])
+        self.directory.update("busy", 99)
+        self.assertEqual(self.directory.top(1, now=100.5), [("room-24", 24)])
+        self.assertEqual(self.directory.top(1, now=101.0), [("busy", 99)])
+
+class TestDirectoryRequests(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+
+    def tearDown(self):
+        registry.clear()
+        history.clear()
+
+    def request(self, **fields):
+        return process_tcp_request(fields, ("127.0.0.1", 40000))
+
+    def test_registry_keeps_the_directory(self):
+        for name in ("lobby", "Lounge", "dev"):
+            self.request(operation="create_room", room_name=name, username="host")
+        guest = self.request(operation="join_room", room_name="lobby", username="guest")
+
+        self.assertEqual(self.request(operation="search_rooms", prefix="lo"),
+                         {"status": "success", "rooms": [{"room_name": "lobby", "members": 2},
+                                                         {"room_name": "Lounge", "members": 1}]})
+        self.assertEqual(self.request(operation="top_rooms", limit=1)["rooms"], [{"room_name": "lobby", "members": 2}])
+
+        first = self.request(operation="list_rooms", limit=2)
+        self.assertEqual([room["room_name"] for room in first["rooms"]], ["dev", "lobby"])
+        second = self.request(operation="list_rooms", limit=2, cursor=first["next_cursor"])
+        self.assertEqual(second, {"status": "success", "rooms": [{"room_name": "Lounge", "members": 1}]})
+
+        self.request(operation="leave", room_name="lobby", token=guest["token"])
+        self.assertEqual(self.request(operation="search_rooms", prefix="lob")["rooms"], [{"room_name": "lobby", "members": 1}])
+        host = registry.get_room("dev").host
+        self.request(operation="leave", room_name="dev", token=host)
+        self.assertEqual(self.request(operation="search_rooms", prefix="d")["rooms"], [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Tests for the broadcast fan-out helpers.
+Checks that a payload is sent as the very same bytes object to every recipient, that a
+broadcast is compressed once for all members that negotiated compression, and that the
+batched sendmmsg path delivers to real sockets on loopback.
+"""
+
+import unittest
+import sys
+import os
+import socket
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fanout import encode, send_to_all, set_batched_send, sendmmsg_available, broadcast_message
+from registry import RoomRegistry
+from client import decode_responses
+
+class TestFanout(unittest.TestCase):
+
+    def tearDown(self):
+        set_batched_send(False)
+
+    def test_same_bytes_sent_to_every_member(self):
+        mock_socket = MagicMock()
+        data = encode({"status": "success", "sender": "host_user", "message": "Hello"})
+        addresses = [("127.0.0.1", 6001), ("127.0.0.2", 6001), ("127.0.0.3", 6001)]
+
+        self.assertEqual(send_to_all(mock_socket, data, addresses), 3)
+
+        calls = mock_socket.sendto.call_args_list
+        self.assertEqual([call[0][1] for call in calls], addresses)
+        for call in calls:
+            self.assertIs(call[0][0], data)
+
+    def test_broadcast_is_compressed_once(self):
+        registry = RoomRegistry()
+        registry.create_room("room", "host", "host_user", "127.0.0.1")
+        registry.update_endpoint("host", ("127.0.0.1", 7000))
+        for index in range(3):
+            token = f"member{index}"
+            registry.join_room("room", token, f"user{index}", "127.0.0.1")
+            registry.update_endpoint(token, ("127.0.0.1", 7001 + index))
+            registry.set_delivery(token, compressed=True)
+
+        mock_socket = MagicMock()
+        message = "thanks, I will take a look at the document later today. " * 10
+        self.assertEqual(broadcast_message(mock_socket, registry.get_room("room"), "host_user", message), 4)
+
+        sent = {call[0][1]: call[0][0] for call in mock_socket.sendto.call_args_list}
+        plain = sent.pop(("127.0.0.1", 7000))
+        compressed = list(sent.values())
+        self.assertTrue(all(data is compressed[0] for data in compressed))
+        self.assertLess(len(compressed[0]) * 4, len(plain))
+        self.assertEqual(decode_responses(compressed[0]), decode_responses(plain))
+
+        # short messages are not worth it and go out unchanged
+        mock_socket.reset_mock()
+        broadcast_message(mock_socket, registry.get_room("room"), "host_user", "hi")
+        self.assertEqual(len({call[0][0] for call in mock_socket.sendto.call_args_list}), 1)
+
+    @unittest.skipUnless(sendmmsg_available(), "sendmmsg is not available")
+    def test_batched_send_delivers_to_all(self):
+        receivers = []
+        for _ in range(3):
+            receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver.bind(("127.0.0.1", 0))
+            receiver.settimeout(1)
+            receivers.append(receiver)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.assertTrue(set_batched_send(True))
+            addresses = [receiver.getsockname() for receiver in receivers]
+            send_to_all(sender, b"payload", addresses)
+            for receiver in receivers:
+                self.assertEqual(receiver.recvfrom(64)[0], b"payload")
+        finally:
+            sender.close()
+            for receiver in receivers:
+                receiver.close()
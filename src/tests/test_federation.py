@@ -0,0 +1,119 @@
+"""
+Tests for cross-node federation.
+Checks the consistent hash ring, then connects the server (as node "a") and a second node
+"b" through a LocalBroker: requests and datagrams arriving at "b" for rooms owned by "a"
+are served by "a", and deliveries to "b"'s clients are sent from "b"'s socket.
+"""
+
+import unittest
+import sys
+import os
+import json
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import server
+from federation import Federation, HashRing, LocalBroker, RelaySender
+from server import process_tcp_request, handle_udp_packet, registry, history
+
+class TestHashRing(unittest.TestCase):
+
+    def test_rooms_spread_and_stay_put(self):
+        ring = HashRing(["a", "b", "c"])
+        owners = {f"room-{index}": ring.owner(f"room-{index}") for index in range(3000)}
+        counts = [list(owners.values()).count(node) for node in ("a", "b", "c")]
+        self.assertTrue(all(count > 600 for count in counts), counts)
+
+        # adding a node only moves rooms to the new node
+        grown = HashRing(["a", "b", "c", "d"])
+        for room_name, owner in owners.items():
+            self.assertIn(grown.owner(room_name), (owner, "d"))
+
+class TestRelaySender(unittest.TestCase):
+
+    def test_routes_are_bounded(self):
+        sock = MagicMock()
+        publish = MagicMock()
+        sender = RelaySender(sock, "a", publish, max_routes=2)
+        sender.route(("127.0.0.1", 1), "b")
+        sender.route(("127.0.0.1", 2), "b")
+        sender.route(("127.0.0.1", 1), "c")
+        sender.route(("127.0.0.1", 3), "b")
+        # the least recently heard from client was evicted and is sent to directly
+        self.assertEqual(list(sender.routes), [("127.0.0.1", 1), ("127.0.0.1", 3)])
+        sender.sendto(b"data", ("127.0.0.1", 2))
+        sock.sendto.assert_called_once_with(b"data", ("127.0.0.1", 2))
+        sender.sendto(b"data", ("127.0.0.1", 1))
+        self.assertEqual(publish.call_args[0][0], "node.c")
+        sender.unroute(("127.0.0.1", 1))
+        self.assertEqual(list(sender.routes), [("127.0.0.1", 3)])
+
+class TestFederation(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+        broker = LocalBroker()
+        self.node_a = Federation("a", ["a", "b"], broker, process_tcp_request, handle_udp_packet)
+        self.socket_a = MagicMock()
+        server.federation = self.node_a
+        server.udp_transport = self.node_a.attach(self.socket_a)
+
+        self.node_b = Federation("b", ["a", "b"], broker, MagicMock(), MagicMock())
+        self.socket_b = MagicMock()
+        self.node_b.attach(self.socket_b)
+
+        self.room_name = next(name for name in (f"room-{index}" for index in range(100))
+                              if self.node_a.owner(name) == "a")
+
+    def tearDown(self):
+        server.federation = None
+        server.udp_transport = None
+        registry.clear()
+        history.clear()
+
+    def test_request_and_datagrams_through_a_remote_node(self):
+        created = process_tcp_request({"operation": "create_room", "room_name": self.room_name, "username": "host"},
+                                      ("10.0.0.1", 40000))
+        self.assertEqual(created["status"], "success")
+
+        # a client of node b joins; node b forwards the request to the owner
+        joined = self.node_b.forward_request({"operation": "join_room", "room_name": self.room_name, "username": "guest"},
+                                             ("10.0.0.2", 40000))
+        self.assertEqual(joined["status"], "success")
+        self.assertTrue(registry.is_member(self.room_name, joined["token"]))
+        self.assertEqual(self.node_b.remote_rooms[self.room_name], ("a", 2))
+
+        # both clients register their endpoints with the node they talk to
+        host_address, guest_address = ("10.0.0.1", 50000), ("10.0.0.2", 50000)
+        self.node_a.handle_datagram(json.dumps({"operation": "connect", "token": created["token"],
+                                                "room_name": self.room_name, "username": "host"}).encode('utf-8'),
+                                    host_address)
+        self.node_b.handle_datagram(json.dumps({"operation": "connect", "token": joined["token"],
+                                                "room_name": self.room_name, "username": "guest"}).encode('utf-8'),
+                                    guest_address)
+
+        self.node_b.handle_datagram(json.dumps({"operation": "message", "token": joined["token"],
+                                                "room_name": self.room_name, "username": "guest",
+                                                "message": "hello"}).encode('utf-8'),
+                                    guest_address)
+
+        expected = {"status": "success", "sender": "guest", "message": "hello"}
+        self.assertEqual([call[0][1] for call in self.socket_a.sendto.call_args_list], [host_address])
+        self.assertEqual(json.loads(self.socket_a.sendto.call_args[0][0].decode('utf-8')), expected)
+        self.assertEqual([call[0][1] for call in self.socket_b.sendto.call_args_list], [guest_address])
+        self.assertEqual(json.loads(self.socket_b.sendto.call_args[0][0].decode('utf-8')), expected)
+        self.node_b.process_datagram.assert_not_called()
+
+    def test_closed_room_is_withdrawn_from_the_directory(self):
+        created = process_tcp_request({"operation": "create_room", "room_name": self.room_name, "username": "host"},
+                                      ("10.0.0.1", 40000))
+        self.assertIn(self.room_name, self.node_b.remote_rooms)
+
+        process_tcp_request({"operation": "leave", "room_name": self.room_name, "token": created["token"]},
+                            ("10.0.0.1", 40000))
+        self.assertNotIn(self.room_name, self.node_b.remote_rooms)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Tests for fragmentation and reassembly.
+Checks that split datagrams reassemble in any order, that duplicates, mismatched and oversize
+messages are handled, that incomplete messages expire and are evicted within the bounds, and
+the server side: fragmented requests, fragmented deliveries and the members left unfragmented.
+"""
+
+import unittest
+import sys
+import os
+import json
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fragments import FRAGMENT_SIZE, Reassembler, split
+from protocol import decode_fragment, encode_fragment, is_fragment
+from metrics import STATS
+from server import handle_tcp_connection, udp_handler, registry, history, reassembly
+
+class TestReassembler(unittest.TestCase):
+
+    def test_split_datagram_reassembles_in_any_order(self):
+        data = os.urandom(5000)
+        fragments = split(data)
+        self.assertEqual(len(fragments), 5)
+        self.assertTrue(all(is_fragment(fragment) and len(fragment) <= FRAGMENT_SIZE for fragment in fragments))
+        self.assertEqual([decode_fragment(fragment)[1:3] for fragment in fragments], [(index, 5) for index in range(5)])
+
+        reassembler = Reassembler()
+        results = [reassembler.add("peer", fragment, 0.0) for fragment in reversed(fragments)]
+        self.assertEqual(results[:4], [None] * 4)
+        self.assertEqual(results[4], data)
+        self.assertEqual((len(reassembler), reassembler.buffered), (0, 0))
+
+    def test_small_datagram_is_not_split(self):
+        data = b"x" * FRAGMENT_SIZE
+        self.assertEqual(split(data), [data])
+
+    def test_duplicates_and_mismatched_counts(self):
+        reassembler = Reassembler()
+        first = encode_fragment(7, 0, 2, b"abc")
+        self.assertIsNone(reassembler.add("peer", first, 0.0))
+        self.assertIsNone(reassembler.add("peer", first, 0.0))
+        self.assertEqual(reassembler.buffered, 3)
+        # the same message id from another peer is another message
+        self.assertIsNone(reassembler.add("other", encode_fragment(7, 1, 2, b"xyz"), 0.0))
+        self.assertEqual(reassembler.add("peer", encode_fragment(7, 1, 2, b"def"), 0.0), b"abcdef")
+        # a fragment that disagrees on the count drops the message
+        self.assertIsNone(reassembler.add("other", encode_fragment(7, 0, 3, b"abc"), 0.0))
+        self.assertEqual(len(reassembler), 0)
+        with self.assertRaises(ValueError):
+            reassembler.add("peer", encode_fragment(8, 2, 2, b"abc"), 0.0)
+
+    def test_oversize_message_is_rejected(self):
+        reassembler = Reassembler(max_size=2000)
+        fragments = split(os.urandom(3000))
+        self.assertIsNone(reassembler.add("peer", fragments[0], 0.0))
+        self.assertIsNone(reassembler.add("peer", fragments[1], 0.0))
+        self.assertEqual(len(reassembler), 0)
+        self.assertIsNone(reassembler.add("peer", fragments[2], 0.0))
+
+    def test_implausible_fragment_count_is_rejected_up_front(self):
+        reassembler = Reassembler()
+        self.assertEqual(reassembler.max_fragments, 56)
+        for message_id in range(100):
+            self.assertIsNone(reassembler.add("peer", encode_fragment(message_id, 0, 0xFFFF, b"x"), 0.0))
+        self.assertEqual((len(reassembler), reassembler.buffered), (0, 0))
+        self.assertIsNone(reassembler.add("peer", encode_fragment(1, 0, 56, b"x"), 0.0))
+        self.assertEqual((len(reassembler), reassembler.buffered), (1, 1))
+
+    def test_incomplete_messages_expire(self):
+        reassembler = Reassembler(timeout=5.0)
+        reassembler.add("peer", encode_fragment(1, 0, 2, b"old"), 0.0)
+        reassembler.add("peer", encode_fragment(2, 0, 2, b"new"), 4.0)
+        reassembler.expire(5.0)
+        self.assertEqual(len(reassembler), 1)
+        self.assertIsNone(reassembler.add("peer", encode_fragment(1, 1, 2, b"!"), 5.0))
+        self.assertEqual(reassembler.add("peer", encode_fragment(2, 1, 2, b"!"), 5.0), b"new!")
+
+    def test_oldest_incomplete_message_is_evicted(self):
+        reassembler = Reassembler(max_pending=2, max_bytes=10)
+        for message_id in range(3):
+            reassembler.add("peer", encode_fragment(message_id, 0, 2, b"abc"), 0.0)
+        self.assertEqual(len(reassembler), 2)
+        reassembler.add("peer", encode_fragment(3, 0, 2, b"abcdefgh"), 0.0)
+        self.assertEqual((len(reassembler), reassembler.buffered), (1, 8))
+        self.assertIsNone(reassembler.add("peer", encode_fragment(0, 1, 2, b"!"), 0.0))
+
+class TestFragmentedServer(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+        reassembly.clear()
+
+    def tearDown(self):
+        registry.clear()
+        history.clear()
+        reassembly.clear()
+
+    def join(self, operation, username, port, fragmented):
+        request = {"operation": operation, "room_name": "test_room", "username": username}
+        if fragmented:
+            request["fragments"] = True
+        mock_socket = MagicMock()
+        mock_socket.recv.return_value = json.dumps(request).encode('utf-8')
+        handle_tcp_connection(mock_socket, ('127.0.0.1', port))
+        response = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))
+        connect = json.dumps({"operation": "connect", "token": response["token"],
+                              "room_name": "test_room", "username": username}).encode('utf-8')
+        return response, connect
+
+    def test_fragmented_message_is_reassembled_and_fragmented_again(self):
+        host, host_connect = self.join("create_room", "host_user", 40000, True)
+        guest, guest_connect = self.join("join_room", "guest_user", 40001, False)
+        self.assertEqual(host["fragment_size"], FRAGMENT_SIZE)
+        self.assertNotIn("fragment_size", guest)
+
+        text = "x" * 3000
+        message = json.dumps({"operation": "message", "token": host["token"], "room_name": "test_room",
+                              "username": "host_user", "message": text}).encode('utf-8')
+        datagrams = [(host_connect, ('127.0.0.1', 12345)), (guest_connect, ('127.0.0.1', 12346))]
+        datagrams += [(fragment, ('127.0.0.1', 12345)) for fragment in split(message)]
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = datagrams + [Exception("Stop loop")]
+        with patch('builtins.print'):
+            udp_handler(mock_socket)
+        sent = [(call[0][0], call[0][1]) for call in mock_socket.sendto.call_args_list]
+
+        to_host = [data for data, address in sent if address == ('127.0.0.1', 12345)]
+        self.assertEqual(len(to_host), 3)
+        reassembler = Reassembler()
+        delivered = [reassembler.add("server", data, 0.0) for data in to_host]
+        self.assertEqual(json.loads(delivered[-1])["message"], text)
+        # the guest did not negotiate fragmentation and gets the delivery whole
+        to_guest = [json.loads(data)["message"] for data, address in sent if address == ('127.0.0.1', 12346)]
+        self.assertEqual(to_guest, [text])
+        self.assertEqual(len(reassembly), 0)
+
+    def test_oversize_delivery_skips_members_without_fragments(self):
+        host, host_connect = self.join("create_room", "host_user", 40000, True)
+        guest, guest_connect = self.join("join_room", "guest_user", 40001, True)
+        legacy, legacy_connect = self.join("join_room", "legacy_user", 40002, False)
+
+        text = "x" * 20000
+        message = json.dumps({"operation": "message", "token": host["token"], "room_name": "test_room",
+                              "username": "host_user", "message": text}).encode('utf-8')
+        datagrams = [(host_connect, ('127.0.0.1', 12345)), (guest_connect, ('127.0.0.1', 12346)),
+                     (legacy_connect, ('127.0.0.1', 12347))]
+        datagrams += [(fragment, ('127.0.0.1', 12345)) for fragment in split(message)]
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = datagrams + [Exception("Stop loop")]
+        STATS.reset()
+        STATS.enabled = True
+        try:
+            with patch('builtins.print'):
+                udp_handler(mock_socket)
+        finally:
+            STATS.enabled = False
+        sent = [(call[0][0], call[0][1]) for call in mock_socket.sendto.call_args_list]
+
+        for address in (('127.0.0.1', 12345), ('127.0.0.1', 12346)):
+            reassembler = Reassembler()
+            delivered = [reassembler.add("server", data, 0.0) for data, to in sent if to == address]
+            self.assertEqual(json.loads(delivered[-1])["message"], text)
+        # the member without fragmentation could not receive it and is skipped, not sent a
+        # datagram the kernel refuses or a receiver truncates
+        self.assertFalse([data for data, to in sent if to == ('127.0.0.1', 12347) and len(data) > 4096])
+        self.assertEqual(STATS.counters.get("oversize_dropped"), 1)
+        self.assertEqual(history.recent("test_room")[-1]["message"], text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Tests for the per-room message history.
+Checks ring buffer wrap-around, the global memory cap evicting the oldest messages
+across rooms, and that broadcast messages are recorded by the UDP handler.
+"""
+
+import unittest
+import sys
+import os
+import json
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from history import ENTRY_OVERHEAD, MessageHistory
+from server import udp_handler, registry, history, signer
+
+def messages(entries):
+    return [entry["message"] for entry in entries]
+
+class TestMessageHistory(unittest.TestCase):
+
+    def test_ring_keeps_the_newest_messages(self):
+        store = MessageHistory(capacity=3)
+        for index in range(5):
+            store.append("room", "user", f"m{index}")
+
+        self.assertEqual(messages(store.recent("room")), ["m2", "m3", "m4"])
+        self.assertEqual(messages(store.recent("room", 2)), ["m3", "m4"])
+        self.assertEqual(store.total_bytes, 3 * (ENTRY_OVERHEAD + len("user") + 2))
+
+    def test_memory_cap_evicts_oldest_across_rooms(self):
+        entry_size = ENTRY_OVERHEAD + len("user") + 2
+        store = MessageHistory(capacity=10, max_bytes=3 * entry_size)
+        store.append("quiet", "user", "q0")
+        store.append("busy", "user", "b0")
+        store.append("busy", "user", "b1")
+        store.append("busy", "user", "b2")
+
+        self.assertEqual(messages(store.recent("quiet")), [])
+        self.assertEqual(messages(store.recent("busy")), ["b0", "b1", "b2"])
+
+        store.append("quiet", "user", "q1")
+        self.assertEqual(messages(store.recent("quiet")), ["q1"])
+        self.assertEqual(messages(store.recent("busy")), ["b1", "b2"])
+        self.assertLessEqual(store.total_bytes, store.max_bytes)
+
+    def test_drop_room_releases_its_memory(self):
+        store = MessageHistory(capacity=4)
+        store.append("room", "user", "hello")
+        store.drop_room("room")
+
+        self.assertEqual(store.recent("room"), [])
+        self.assertEqual(store.total_bytes, 0)
+
+    def test_disabled_history_keeps_nothing(self):
+        store = MessageHistory(capacity=0)
+        store.append("room", "user", "hello")
+        self.assertFalse(store.enabled)
+        self.assertEqual(store.recent("room"), [])
+
+class TestHistoryRecording(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+
+    def tearDown(self):
+        registry.clear()
+        history.clear()
+
+    def run_handler(self, packet):
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = [
+            (json.dumps(packet).encode('utf-8'), ("127.0.0.1", 40000)),
+            Exception("Stop loop"),
+        ]
+        udp_handler(mock_socket)
+
+    def test_udp_messages_are_recorded_and_closed_rooms_dropped(self):
+        host_token = signer.issue(100, 1)
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+
+        self.run_handler({"operation": "message", "token": host_token, "room_name": "test_room",
+                          "username": "host_user", "message": "hi"})
+        self.assertEqual(messages(history.recent("test_room")), ["hi"])
+
+        self.run_handler({"operation": "leave", "token": host_token, "room_name": "test_room",
+                          "username": "host_user"})
+        self.assertEqual(history.recent("test_room"), [])
+        self.assertEqual(history.total_bytes, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+Tests for the metrics and logging helpers.
+Runs the UDP handler with metrics enabled and checks the recorded counters,
+and checks that repeated log records are rate limited.
+"""
+
+import unittest
+import sys
+import os
+import json
+import logging
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics import STATS, RateLimitFilter, Histogram
+from server import udp_handler, registry, signer
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        STATS.reset()
+        STATS.enabled = True
+        logging.getLogger("chat").disabled = True
+
+    def tearDown(self):
+        registry.clear()
+        STATS.reset()
+        STATS.enabled = False
+        logging.getLogger("chat").disabled = False
+
+    def test_udp_handler_counters(self):
+        host_token = signer.issue(100, 1)
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+
+        message_data = {
+            "operation": "message",
+            "token": host_token,
+            "room_name": "test_room",
+            "username": "host_user",
+            "message": "Hello"
+        }
+        intruder_data = dict(message_data, token="forged")
+
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = [
+            (json.dumps(message_data).encode('utf-8'), ('127.0.0.1', 12345)),
+            (json.dumps(intruder_data).encode('utf-8'), ('127.0.0.9', 12345)),
+            (b"not json", ('127.0.0.9', 12345)),
+            Exception("Stop loop")
+        ]
+        udp_handler(mock_socket)
+
+        snapshot = STATS.snapshot()
+        self.assertEqual(snapshot["counters"]["packets_in.message"], 2)
+        self.assertEqual(snapshot["counters"]["packets_out.message"], 1)
+        self.assertEqual(snapshot["counters"]["unknown_tokens"], 1)
+        self.assertEqual(snapshot["counters"]["decode_errors"], 1)
+        self.assertEqual(snapshot["histograms"]["fanout_size"]["count"], 1)
+        self.assertEqual(snapshot["histograms"]["handler_latency_us"]["count"], 2)
+        self.assertIn("test_room", snapshot["room_message_rate"])
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for value in [1, 2, 3, 100]:
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(0.5), 4)
+        self.assertEqual(histogram.percentile(1.0), 128)
+
+    def test_rate_limit_filter(self):
+        limiter = RateLimitFilter(burst=2, interval=60)
+        records = [logging.LogRecord("chat.server", logging.WARNING, __file__, 1, "Error: %s", ("x",), None)
+                   for _ in range(5)]
+        self.assertEqual([limiter.filter(record) for record in records], [True, True, False, False, False])
@@ -0,0 +1,121 @@
+"""
+Tests for password-protected rooms.
+Checks the scrypt hash records, the bounds and verification cache of the PasswordHasher,
+and that create_room/join_room store and check room passwords. The hashers use a tiny
+scrypt cost so the tests stay fast.
+"""
+
+import unittest
+import sys
+import os
+import threading
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics import STATS
+from passwords import Busy, PasswordHasher, check_password, hash_password
+from server import process_tcp_request, registry, history, hasher
+
+class TestPasswordHashing(unittest.TestCase):
+
+    def test_round_trip(self):
+        record = hash_password("secret", n=16)
+        self.assertTrue(record.startswith("scrypt$16$8$1$"))
+        self.assertTrue(check_password("secret", record))
+        self.assertFalse(check_password("Secret", record))
+        self.assertNotEqual(hash_password("secret", n=16), record)
+        self.assertFalse(check_password("secret", "plain"))
+
+class TestPasswordHasher(unittest.TestCase):
+
+    def setUp(self):
+        STATS.reset()
+        STATS.enabled = True
+
+    def tearDown(self):
+        STATS.reset()
+        STATS.enabled = False
+
+    def test_verification_is_cached_per_client(self):
+        password_hasher = PasswordHasher(n=16)
+        record = password_hasher.hash("secret").result()
+        self.assertTrue(password_hasher.verify(record, "secret", "10.0.0.1").result())
+
+        cached = password_hasher.verify(record, "secret", "10.0.0.1")
+        self.assertTrue(cached.done() and cached.result())
+        self.assertEqual(STATS.counters["kdf_cache_hits"], 1)
+        # another client, and a wrong password, pay for the KDF
+        self.assertFalse(password_hasher.verify(record, "wrong", "10.0.0.1").result())
+        self.assertTrue(password_hasher.verify(record, "secret", "10.0.0.2").result())
+        self.assertEqual(STATS.counters["kdf_cache_hits"], 1)
+
+    def test_full_queue_is_refused(self):
+        password_hasher = PasswordHasher(workers=1, max_pending=1, n=16)
+        release = threading.Event()
+        # a failed assertion must not leave the pool thread blocked
+        self.addCleanup(release.set)
+        blocked = password_hasher._submit(release.wait)
+        with self.assertRaises(Busy):
+            password_hasher.hash("secret").result()
+        self.assertEqual(STATS.counters["kdf_rejected"], 1)
+        release.set()
+        blocked.result()
+
+class TestPasswordProtectedRooms(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+        hasher.clear()
+        self.params = patch.object(hasher, "params", (16, 8, 1))
+        self.params.start()
+
+    def tearDown(self):
+        self.params.stop()
+        registry.clear()
+        history.clear()
+        hasher.clear()
+
+    def join(self, password=None):
+        request = {"operation": "join_room", "room_name": "locked", "username": "guest"}
+        if password is not None:
+            request["password"] = password
+        return process_tcp_request(request, ("127.0.0.1", 40001))
+
+    def test_join_needs_the_password(self):
+        created = process_tcp_request({"operation": "create_room", "room_name": "locked", "username": "host",
+                                       "password": "secret"}, ("127.0.0.1", 40000))
+        self.assertEqual(created["status"], "success")
+        self.assertTrue(registry.get_room("locked").password.startswith("scrypt$16$"))
+
+        self.assertEqual(self.join(), {"status": "error", "message": "Wrong password."})
+        self.assertEqual(self.join("guess"), {"status": "error", "message": "Wrong password."})
+        self.assertEqual(self.join(["secret"])["message"], "Malformed password.")
+        self.assertEqual(self.join("secret")["status"], "success")
+        self.assertEqual(len(registry.get_room("locked").members), 2)
+
+    def test_rooms_without_password_stay_open(self):
+        process_tcp_request({"operation": "create_room", "room_name": "locked", "username": "host"}, ("127.0.0.1", 40000))
+        self.assertIsNone(registry.get_room("locked").password)
+        self.assertEqual(self.join("anything")["status"], "success")
+
+    def test_room_created_while_checking_is_reported(self):
+        # another client creates the room between the existence check and password_future()
+        def created_meanwhile(request, address):
+            registry.create_room("locked", "other", "someone", "127.0.0.2")
+            return None
+
+        with patch("server.password_future", side_effect=created_meanwhile):
+            response = process_tcp_request({"operation": "create_room", "room_name": "locked", "username": "host",
+                                            "password": "secret"}, ("127.0.0.1", 40000))
+        self.assertEqual(response, {"status": "error", "message": "Room already exists."})
+
+    def test_busy_pool_is_reported(self):
+        process_tcp_request({"operation": "create_room", "room_name": "locked", "username": "host",
+                             "password": "secret"}, ("127.0.0.1", 40000))
+        with patch.object(hasher, "max_pending", 0):
+            self.assertEqual(self.join("secret"), {"status": "error", "message": "Server busy, try again."})
+
+if __name__ == '__main__':
+    unittest.main()
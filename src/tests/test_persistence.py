@@ -0,0 +1,155 @@
+"""
+Tests for the journal and snapshot persistence.
+Restores registries (room passwords included) from journals, snapshots and a torn journal
+tail, and checks that a 5,000 member state is restored quickly.
+"""
+
+import unittest
+import sys
+import os
+import shutil
+import tempfile
+import time
+import threading
+import logging
+from unittest.mock import patch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from persistence import StateStore
+from registry import RoomRegistry
+
+def state_of(registry):
+    return sorted((name, host, sorted(members)) for name, host, members, _ in registry.export())
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        logging.getLogger("chat").disabled = True
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        logging.getLogger("chat").disabled = False
+
+    def open_store(self):
+        registry = RoomRegistry()
+        store = StateStore(self.directory, registry, snapshot_interval=0)
+        store.recover()
+        return registry, store
+
+    def test_journal_is_replayed_after_restart(self):
+        registry, store = self.open_store()
+        registry.create_room("room1", "host1", "host_user", "127.0.0.1")
+        registry.join_room("room1", "member1", "member_user", "127.0.0.2")
+        registry.create_room("room2", "host2", "other_host", "127.0.0.3")
+        registry.join_room("room2", "member2", "other_member", "127.0.0.4")
+        registry.leave("room2", "host2")
+        store.close()
+
+        restored, restored_store = self.open_store()
+        self.assertEqual(state_of(restored), [("room1", "host1", [("host1", "host_user", "127.0.0.1"),
+                                                                  ("member1", "member_user", "127.0.0.2")])])
+        self.assertIsNone(restored.get_member("member2"))
+        self.assertEqual(restored.get_member("member1").username, "member_user")
+        restored_store.close()
+
+    def test_snapshot_compacts_the_journals(self):
+        registry, store = self.open_store()
+        registry.create_room("room1", "host1", "host_user", "127.0.0.1")
+        store.snapshot()
+        registry.join_room("room1", "member1", "member_user", "127.0.0.2")
+        store.close()
+
+        journals = [name for name in os.listdir(self.directory) if name.startswith("journal-")]
+        self.assertEqual(len(journals), 1)
+
+        restored, restored_store = self.open_store()
+        self.assertEqual(state_of(restored), state_of(registry))
+        restored_store.close()
+
+    def test_records_do_not_wait_for_fsync(self):
+        registry, store = self.open_store()
+        registry.create_room("room1", "host1", "host_user", "127.0.0.1")
+        syncing = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_fsync(fd):
+            syncing.set()
+            release.wait(5)
+
+        with patch("persistence.os.fsync", slow_fsync):
+            flusher = threading.Thread(target=store.flush)
+            flusher.start()
+            self.assertTrue(syncing.wait(5))
+            # the flusher is inside fsync; the registry must still take records
+            started = time.perf_counter()
+            registry.join_room("room1", "member1", "member_user", "127.0.0.2")
+            self.assertLess(time.perf_counter() - started, 1.0)
+            release.set()
+            flusher.join(5)
+        store.close()
+
+        restored, restored_store = self.open_store()
+        self.assertEqual(state_of(restored), state_of(registry))
+        restored_store.close()
+
+    def test_rotation_leaves_the_disk_to_the_flusher(self):
+        registry, store = self.open_store()
+        registry.create_room("room1", "host1", "host_user", "127.0.0.1")
+        with patch("builtins.open", side_effect=AssertionError("disk touched under the registry lock")), \
+                patch("persistence.os.fsync", side_effect=AssertionError("disk touched under the registry lock")):
+            registry.export(while_locked=store._rotate)
+        registry.join_room("room1", "member1", "member_user", "127.0.0.2")
+        store.close()
+
+        restored, restored_store = self.open_store()
+        self.assertEqual(state_of(restored), state_of(registry))
+        restored_store.close()
+
+    def test_room_passwords_are_kept(self):
+        registry, store = self.open_store()
+        registry.create_room("snapshotted", "host1", "host_user", "127.0.0.1", "scrypt$1$1$1$00$00")
+        store.snapshot()
+        registry.create_room("journaled", "host2", "host_user", "127.0.0.1", "scrypt$2$1$1$00$00")
+        store.close()
+
+        restored, restored_store = self.open_store()
+        self.assertEqual(restored.get_room("snapshotted").password, "scrypt$1$1$1$00$00")
+        self.assertEqual(restored.get_room("journaled").password, "scrypt$2$1$1$00$00")
+        restored_store.close()
+
+    def test_torn_journal_tail_is_ignored(self):
+        registry, store = self.open_store()
+        registry.create_room("room1", "host1", "host_user", "127.0.0.1")
+        store.close()
+        journal = max(name for name in os.listdir(self.directory) if name.startswith("journal-"))
+        with open(os.path.join(self.directory, journal), "a") as f:
+            f.write('["join","room1","mem')
+
+        restored, restored_store = self.open_store()
+        self.assertEqual(state_of(restored), state_of(registry))
+        restored_store.close()
+
+    def test_restores_5000_members_quickly(self):
+        registry, store = self.open_store()
+        for room_index in range(500):
+            room_name = f"room-{room_index}"
+            registry.create_room(room_name, f"{room_name}-host", "host", "10.0.0.1")
+            for member_index in range(1, 10):
+                registry.join_room(room_name, f"{room_name}-{member_index}", f"user-{member_index}", "10.0.0.2")
+        store.snapshot()
+        store.close()
+
+        started = time.perf_counter()
+        restored, restored_store = self.open_store()
+        elapsed = time.perf_counter() - started
+        restored_store.close()
+
+        self.assertEqual(len(restored), 500)
+        self.assertEqual(sum(len(room[2]) for room in restored.export()), 5000)
+        self.assertLess(elapsed, 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests for the staged UDP pipeline.
+Checks the full-queue policies of BoundedQueue, that the fan-out hands a QueueSender one
+queue item per broadcast, and that datagrams flow through the receive, route and send
+stages to the socket.
+"""
+
+import unittest
+import sys
+import os
+import json
+import threading
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fanout import send_to_all
+from metrics import STATS
+from pipeline import BoundedQueue, Pipeline, QueueSender
+from server import handle_udp_packet, registry, history
+
+class TestBoundedQueue(unittest.TestCase):
+
+    def setUp(self):
+        STATS.reset()
+        STATS.enabled = True
+
+    def tearDown(self):
+        STATS.reset()
+        STATS.enabled = False
+
+    def test_drop_newest(self):
+        bounded = BoundedQueue("test", 2, "drop_newest")
+        self.assertEqual([bounded.put(item) for item in (1, 2, 3)], [True, True, False])
+        self.assertEqual([bounded.get(), bounded.get()], [1, 2])
+        self.assertEqual(bounded.dropped, 1)
+        self.assertEqual(STATS.counters["queue_dropped.test"], 1)
+
+    def test_drop_oldest(self):
+        bounded = BoundedQueue("test", 2, "drop_oldest")
+        for item in (1, 2, 3):
+            bounded.put(item)
+        self.assertEqual(bounded.depth(), 2)
+        self.assertEqual([bounded.get(), bounded.get()], [2, 3])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            BoundedQueue("test", 2, "drop_everything")
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+
+    def tearDown(self):
+        registry.clear()
+        history.clear()
+
+    def test_broadcast_is_one_queue_item(self):
+        egress = BoundedQueue("egress", 10)
+        addresses = (("127.0.0.1", 40000), ("127.0.0.1", 40001))
+        self.assertEqual(send_to_all(QueueSender(egress), b"data", addresses), 2)
+        self.assertEqual(egress.get(), (b"data", addresses))
+        self.assertEqual(egress.depth(), 0)
+
+    def test_datagrams_flow_through_the_stages(self):
+        registry.create_room("test_room", "host_token", "host_user", "127.0.0.1")
+        registry.join_room("test_room", "guest_token", "guest_user", "127.0.0.1")
+        registry.update_endpoint("host_token", ("127.0.0.1", 40000))
+        registry.update_endpoint("guest_token", ("127.0.0.1", 40001))
+        packet = json.dumps({"operation": "message", "token": "guest_token", "room_name": "test_room",
+                             "username": "guest_user", "message": "hello"}).encode('utf-8')
+
+        delivered = threading.Event()
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = [(packet, ("127.0.0.1", 40001)), OSError("closed")]
+        mock_socket.sendto.side_effect = lambda data, address: delivered.set() if mock_socket.sendto.call_count == 2 else None
+
+        pipeline = Pipeline(mock_socket, handle_udp_packet, senders=2, queue_size=8).start()
+        self.assertTrue(delivered.wait(5))
+        for thread in pipeline.threads:
+            thread.join(5)
+
+        self.assertEqual(sorted(call[0][1] for call in mock_socket.sendto.call_args_list),
+                         [("127.0.0.1", 40000), ("127.0.0.1", 40001)])
+        self.assertEqual(json.loads(mock_socket.sendto.call_args[0][0].decode('utf-8')),
+                         {"status": "success", "sender": "guest_user", "message": "hello"})
+        self.assertTrue(all(not thread.is_alive() for thread in pipeline.threads))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Tests for the binary wire protocol.
+Round-trips client requests and server deliveries and checks that
+malformed packets are rejected.
+"""
+
+import unittest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from protocol import (
+    OP_MESSAGE, is_binary, fits, encode_request, decode_request,
+    encode_message, encode_system, decode_delivery, is_batch, encode_batch, decode_batch,
+    is_reliable, encode_reliable, decode_reliable, is_ack, encode_ack, decode_ack
+)
+
+class TestProtocol(unittest.TestCase):
+
+    def test_request_round_trip(self):
+        data = encode_request(OP_MESSAGE, "test_room", "test_room-user-127.0.0.1", "こんにちは".encode('utf-8'))
+
+        self.assertTrue(is_binary(data))
+        op, room_name, token, payload = decode_request(data)
+        self.assertEqual((op, room_name, token), (OP_MESSAGE, "test_room", "test_room-user-127.0.0.1"))
+        self.assertIsInstance(payload, memoryview)
+        self.assertEqual(bytes(payload).decode('utf-8'), "こんにちは")
+
+    def test_delivery_round_trip(self):
+        self.assertEqual(decode_delivery(encode_message("host_user", b"Hello")),
+                         {"status": "success", "sender": "host_user", "message": "Hello"})
+        self.assertEqual(decode_delivery(encode_system("host_user has left the room.")),
+                         {"status": "success", "system_message": "host_user has left the room."})
+
+    def test_json_is_not_binary(self):
+        self.assertFalse(is_binary(b'{"operation": "message"}'))
+        self.assertFalse(is_binary(b""))
+
+    def test_truncated_request_rejected(self):
+        data = encode_request(OP_MESSAGE, "test_room", "token")
+        with self.assertRaises(ValueError):
+            decode_request(data[:8])
+
+    def test_names_too_long(self):
+        self.assertFalse(fits("r" * 256, "token"))
+        with self.assertRaises(ValueError):
+            encode_request(OP_MESSAGE, "r" * 256, "token")
+
+    def test_batch_round_trip(self):
+        datagrams = [encode_message("host_user", b"Hello"), b'{"status": "success"}']
+        data = encode_batch(datagrams)
+
+        self.assertTrue(is_batch(data))
+        self.assertFalse(is_batch(datagrams[0]))
+        self.assertEqual([bytes(datagram) for datagram in decode_batch(data)], datagrams)
+        with self.assertRaises(ValueError):
+            decode_batch(data[:-1])
+
+    def test_reliable_round_trip(self):
+        delivery = encode_message("host_user", b"Hello")
+        data = encode_reliable(7, delivery)
+
+        self.assertTrue(is_reliable(data))
+        self.assertFalse(is_reliable(delivery))
+        seq, inner = decode_reliable(data)
+        self.assertEqual((seq, bytes(inner)), (7, delivery))
+
+        ack = encode_ack(41, 0b101)
+        self.assertTrue(is_ack(ack))
+        self.assertFalse(is_ack(data))
+        self.assertEqual(decode_ack(ack), (41, 0b101))
@@ -0,0 +1,79 @@
+"""
+Tests for the token bucket rate limiting.
+Checks burst, refill and the per-room limit on registry records, and that the UDP
+handler drops over-limit messages without broadcasting them.
+"""
+
+import unittest
+import sys
+import os
+import json
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics import STATS
+from ratelimit import RateLimiter
+from registry import Member, Room
+from server import udp_handler, registry, history, limiter
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_burst_then_refill(self):
+        rate_limiter = RateLimiter(token_rate=2, token_burst=3, room_rate=0)
+        member, room = Member("token", "user", "127.0.0.1", "room"), Room("room", "token")
+
+        self.assertEqual([rate_limiter.allow(member, room, 100.0) for _ in range(4)], [None, None, None, "token"])
+        # half a second refills one message at 2 messages/s
+        self.assertIsNone(rate_limiter.allow(member, room, 100.5))
+        self.assertEqual(rate_limiter.allow(member, room, 100.5), "token")
+        self.assertEqual(rate_limiter.dropped, {"token": 2, "room": 0})
+
+    def test_room_limit_is_shared_by_members(self):
+        rate_limiter = RateLimiter(token_rate=10, token_burst=10, room_rate=1, room_burst=2)
+        room = Room("room", "first")
+        first, second = Member("first", "a", "127.0.0.1", "room"), Member("second", "b", "127.0.0.1", "room")
+
+        self.assertIsNone(rate_limiter.allow(first, room, 50.0))
+        self.assertIsNone(rate_limiter.allow(second, room, 50.0))
+        self.assertEqual(rate_limiter.allow(second, room, 50.0), "room")
+        # a message dropped by the room limit does not use up the member's allowance
+        self.assertEqual(second.allowance, 9.0)
+
+    def test_disabled_limits(self):
+        rate_limiter = RateLimiter(token_rate=0, room_rate=0)
+        self.assertFalse(rate_limiter.enabled)
+
+class TestRateLimitedHandler(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+        STATS.reset()
+        STATS.enabled = True
+        limiter.configure(token_rate=1, token_burst=2, room_rate=0)
+
+    def tearDown(self):
+        registry.clear()
+        history.clear()
+        STATS.reset()
+        STATS.enabled = False
+        limiter.configure()
+
+    def test_over_limit_messages_are_dropped(self):
+        registry.create_room("test_room", "host_token", "host_user", "127.0.0.1")
+        registry.update_endpoint("host_token", ("127.0.0.1", 40000))
+        packet = json.dumps({"operation": "message", "token": "host_token", "room_name": "test_room",
+                             "username": "host_user", "message": "spam"}).encode('utf-8')
+
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = [(packet, ("127.0.0.1", 40000))] * 5 + [Exception("Stop loop")]
+        udp_handler(mock_socket)
+
+        self.assertEqual(mock_socket.sendto.call_count, 2)
+        self.assertEqual(STATS.counters["rate_limited.token"], 3)
+        self.assertEqual(STATS.counters["packets_in.message"], 5)
+        self.assertEqual(STATS.histograms["fanout_size"].count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
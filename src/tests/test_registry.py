@@ -0,0 +1,91 @@
+"""
+Tests for the room registry.
+Verifies membership bookkeeping, the precomputed recipient addresses and
+cleanup of member records when a room is closed.
+"""
+
+import unittest
+import sys
+import os
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from registry import RoomRegistry
+
+class TestRoomRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = RoomRegistry()
+        self.registry.create_room("test_room", "host", "host_user", "127.0.0.1")
+        self.registry.join_room("test_room", "member", "member_user", "127.0.0.2")
+        self.registry.update_endpoint("host", ("127.0.0.1", 6001))
+        self.registry.update_endpoint("member", ("127.0.0.2", 6001))
+
+    def test_recipients_follow_membership(self):
+        self.assertEqual(self.registry.recipients("test_room"), (("127.0.0.1", 6001), ("127.0.0.2", 6001)))
+
+        was_host, room = self.registry.leave("test_room", "member")
+        self.assertFalse(was_host)
+        self.assertEqual(room.addresses, (("127.0.0.1", 6001),))
+        self.assertEqual(self.registry.recipients("test_room"), (("127.0.0.1", 6001),))
+        self.assertIsNone(self.registry.get_member("member"))
+
+    def test_join_unknown_room_fails(self):
+        self.assertFalse(self.registry.join_room("missing", "token", "user", "127.0.0.3"))
+        self.assertIsNone(self.registry.get_member("token"))
+
+    def test_host_leave_closes_room(self):
+        was_host, room = self.registry.leave("test_room", "host")
+
+        self.assertTrue(was_host)
+        self.assertEqual(room.addresses, (("127.0.0.2", 6001),))
+        self.assertNotIn("test_room", self.registry)
+        self.assertIsNone(self.registry.get_member("member"))
+        self.assertIsNone(self.registry.leave("test_room", "member"))
+
+    def test_endpoint_reused_by_another_member(self):
+        self.registry.join_room("test_room", "late", "late_user", "127.0.0.2")
+
+        self.assertEqual(len(self.registry.recipients("test_room")), 2)
+        self.assertTrue(self.registry.update_endpoint("late", ("127.0.0.2", 6001)))
+
+        self.assertIsNone(self.registry.get_member("member").address)
+        self.assertEqual(self.registry.recipients("test_room"), (("127.0.0.1", 6001), ("127.0.0.2", 6001)))
+        self.assertFalse(self.registry.update_endpoint("late", ("127.0.0.2", 6001)))
+
+    def test_members_and_rooms_by_id(self):
+        room = self.registry.get_room("test_room")
+        member = self.registry.get_member("member")
+        self.assertIs(self.registry.room_by_id(room.id), room)
+        self.assertIs(self.registry.member_by_id(member.id), member)
+        self.assertEqual(member.room_id, room.id)
+        self.assertIsNone(self.registry.member_by_id(0))
+        self.assertIsNone(self.registry.member_by_id(10 ** 6))
+
+        # ids are not reused once their member or room is gone
+        self.registry.leave("test_room", "host")
+        self.assertIsNone(self.registry.member_by_id(member.id))
+        self.assertIsNone(self.registry.room_by_id(room.id))
+        self.assertGreater(self.registry.allocate_member_id(), member.id)
+
+    def test_recipients_split_by_wire_format(self):
+        self.assertTrue(self.registry.update_endpoint("member", ("127.0.0.2", 6001), binary=True))
+
+        room = self.registry.get_room("test_room")
+        self.assertEqual(room.json_addresses, (("127.0.0.1", 6001),))
+        self.assertEqual(room.binary_addresses, (("127.0.0.2", 6001),))
+
+    def test_idle_members_expire_unless_touched(self):
+        now = time.monotonic()
+        host = self.registry.get_member("host")
+        member = self.registry.get_member("member")
+        host.last_seen = member.last_seen = now
+        self.registry.set_idle_timeout(10)
+
+        self.registry.touch("host", now + 8)
+        self.assertEqual(self.registry.expired(now + 11), [member])
+        # expired members stay until leave() removes them
+        self.assertTrue(self.registry.is_member("test_room", "member"))
+        self.assertEqual(self.registry.expired(now + 12), [])
+        self.assertEqual(self.registry.expired(now + 19), [host])
@@ -0,0 +1,175 @@
+"""
+Tests for reliable delivery.
+Checks the send and receive windows (ack bitmaps, retransmission backoff, duplicate
+suppression, bounded memory) and the server side: negotiation, sequenced fan-out, acks of
+client datagrams, dropped duplicates and retransmits of unacked deliveries.
+"""
+
+import unittest
+import sys
+import os
+import json
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import reliable
+from reliable import SendWindow, ReceiveWindow, RETRANSMITS
+from server import handle_tcp_connection, udp_handler, registry, history
+from protocol import encode_reliable, decode_reliable, is_reliable, is_ack, encode_ack, decode_ack
+
+class TestWindows(unittest.TestCase):
+
+    def test_ack_bitmap_confirms_out_of_order_datagrams(self):
+        window = SendWindow()
+        for index in range(1, 6):
+            self.assertEqual(window.push(f"datagram {index}".encode(), 0.0), index)
+
+        # 1 and 2 arrived in order, then 4 (bit 0 stands for 4, the first one after the gap)
+        self.assertEqual(window.ack(2, 0b1, 0.1), 3)
+        self.assertEqual(list(window.unacked), [3, 5])
+        # a late duplicate ack changes nothing
+        self.assertEqual(window.ack(2, 0b1, 0.2), 0)
+        self.assertEqual(window.ack(5, 0, 0.3), 2)
+        self.assertFalse(window.unacked)
+
+    def test_retransmits_back_off_and_give_up(self):
+        window = SendWindow()
+        window.push(b"lost", 0.0)
+        self.assertEqual(window.due(0.0), [])
+
+        now, resends = 0.0, []
+        while window.unacked:
+            now += 0.01
+            resends.extend(now for _ in window.due(now))
+        self.assertEqual(len(resends), reliable.MAX_RETRIES)
+        self.assertEqual(window.gave_up, 1)
+        gaps = [round(later - earlier, 6) for earlier, later in zip(resends, resends[1:])]
+        self.assertEqual(gaps, sorted(gaps))
+        self.assertLessEqual(max(gaps), reliable.MAX_RTO + 0.01)
+
+    def test_round_trip_estimate_ignores_retransmitted_datagrams(self):
+        window = SendWindow()
+        window.push(b"first", 0.0)
+        window.ack(1, 0, 0.03)
+        self.assertAlmostEqual(window.srtt, 0.03)
+        window.push(b"second", 1.0)
+        window.due(5.0)
+        window.ack(2, 0, 5.01)
+        self.assertAlmostEqual(window.srtt, 0.03)
+
+    def test_full_window_drops_the_oldest(self):
+        window = SendWindow(capacity=2)
+        for index in range(3):
+            window.push(b"x", 0.0)
+        self.assertEqual(list(window.unacked), [2, 3])
+        self.assertEqual(window.gave_up, 1)
+
+    def test_receive_window_suppresses_duplicates(self):
+        window = ReceiveWindow()
+        self.assertEqual([window.received(seq) for seq in (1, 3, 3, 4, 1, 2, 2)],
+                         [True, True, False, True, False, True, False])
+        self.assertEqual(window.duplicates, 3)
+        self.assertEqual(decode_ack(window.ack()), (4, 0))
+
+    def test_receive_window_ack_carries_the_gaps(self):
+        window = ReceiveWindow()
+        for seq in (1, 2, 4, 6):
+            window.received(seq)
+        # everything up to 2, then 4 (bit 0) and 6 (bit 2)
+        self.assertEqual(decode_ack(window.ack()), (2, 0b101))
+
+    def test_receive_window_forgets_far_behind(self):
+        window = ReceiveWindow()
+        window.received(1)
+        self.assertTrue(window.received(reliable.MAX_GAP + 10))
+        self.assertGreater(window.cumulative, 1)
+        self.assertFalse(window.received(2))
+
+class TestReliableServer(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+        RETRANSMITS.clear()
+
+    def tearDown(self):
+        registry.clear()
+        history.clear()
+        RETRANSMITS.clear()
+
+    def join(self, operation, username, port, reliable_delivery):
+        request = {"operation": operation, "room_name": "test_room", "username": username}
+        if reliable_delivery:
+            request["reliable"] = True
+        mock_socket = MagicMock()
+        mock_socket.recv.return_value = json.dumps(request).encode('utf-8')
+        handle_tcp_connection(mock_socket, ('127.0.0.1', port))
+        response = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))
+        connect = json.dumps({"operation": "connect", "token": response["token"],
+                              "room_name": "test_room", "username": username}).encode('utf-8')
+        return response, connect
+
+    def serve(self, datagrams):
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = datagrams + [Exception("Stop loop")]
+        with patch('builtins.print'):
+            udp_handler(mock_socket)
+        return [(call[0][0], call[0][1]) for call in mock_socket.sendto.call_args_list]
+
+    def test_reliable_member_gets_sequenced_deliveries_and_acks(self):
+        host, host_connect = self.join("create_room", "host_user", 40000, True)
+        guest, guest_connect = self.join("join_room", "guest_user", 40001, False)
+        self.assertTrue(host["reliable"])
+        self.assertNotIn("reliable", guest)
+
+        message = json.dumps({"operation": "message", "token": guest["token"], "room_name": "test_room",
+                              "username": "guest_user", "message": "Hello!"}).encode('utf-8')
+        own = encode_reliable(1, json.dumps({"operation": "message", "token": host["token"], "room_name": "test_room",
+                                             "username": "host_user", "message": "Hi!"}).encode('utf-8'))
+        sent = self.serve([
+            (host_connect, ('127.0.0.1', 12345)),
+            (guest_connect, ('127.0.0.1', 12346)),
+            (message, ('127.0.0.1', 12346)),
+            (own, ('127.0.0.1', 12345)),
+            # the ack got lost and the client resent it
+            (own, ('127.0.0.1', 12345)),
+        ])
+
+        to_host = [data for data, address in sent if address == ('127.0.0.1', 12345)]
+        deliveries = [decode_reliable(data) for data in to_host if is_reliable(data)]
+        self.assertEqual([(seq, json.loads(bytes(data))["message"]) for seq, data in deliveries],
+                         [(1, "Hello!"), (2, "Hi!")])
+        # every copy of the host's message is acked, but it is broadcast once
+        self.assertEqual([decode_ack(data) for data in to_host if is_ack(data)], [(1, 0), (1, 0)])
+        to_guest = [json.loads(data)["message"] for data, address in sent if address == ('127.0.0.1', 12346)]
+        self.assertEqual(to_guest, ["Hello!", "Hi!"])
+
+    def test_unacked_deliveries_are_retransmitted(self):
+        host, host_connect = self.join("create_room", "host_user", 40000, True)
+        guest, guest_connect = self.join("join_room", "guest_user", 40001, False)
+        message = json.dumps({"operation": "message", "token": guest["token"], "room_name": "test_room",
+                              "username": "guest_user", "message": "Hello!"}).encode('utf-8')
+        self.serve([
+            (host_connect, ('127.0.0.1', 12345)),
+            (guest_connect, ('127.0.0.1', 12346)),
+            (message, ('127.0.0.1', 12346)),
+            (message, ('127.0.0.1', 12346)),
+        ])
+        member = registry.get_member(host["token"])
+        due = max(entry[3] for entry in member.link.send.unacked.values())
+
+        mock_socket = MagicMock()
+        self.assertEqual(RETRANSMITS.tick(mock_socket, due), 2)
+        self.assertEqual([decode_reliable(call[0][0])[0] for call in mock_socket.sendto.call_args_list], [1, 2])
+
+        # the client got the second copy only; its ack leaves the first one unacked
+        self.serve([(encode_ack(0, 0b1), ('127.0.0.1', 12345))])
+        self.assertEqual(list(member.link.send.unacked), [1])
+        self.serve([(encode_ack(2, 0), ('127.0.0.1', 12345))])
+        self.assertFalse(member.link.send.unacked)
+        self.assertEqual(RETRANSMITS.tick(mock_socket, due + 60), 0)
+        self.assertFalse(RETRANSMITS.members)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,7 @@ client connections and requests.
 Test cases:
 - test_create_room_success: Verifies that a room can be created successfully
 - test_create_room_already_exists: Verifies rejection when creating a room that already exists
-Note: The tests clear the rooms and tokens dictionaries before and after each test
+Note: The tests clear the room registry before and after each test
 to ensure a clean testing environment.
 """
 
@@ -18,20 +18,22 @@ import os
 import json
 from unittest.mock import patch, MagicMock
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../src')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from ..server import handle_tcp_connection, udp_handler, rooms, tokens, UDP_PORT
+from server import handle_tcp_connection, udp_handler, registry, history, reap_idle_members, signer
+from protocol import OP_MESSAGE, encode_request, encode_compact, decode_delivery, token_tag
+import compression
 
 class TestChatServer(unittest.TestCase):
     
-    # Clear the rooms and tokens dictionaries before each test
+    # Clear the room registry before each test
     def setUp(self):
-        rooms.clear()
-        tokens.clear()
+        registry.clear()
+        history.clear()
     
     def tearDown(self):
-        rooms.clear()
-        tokens.clear()
+        registry.clear()
+        history.clear()
     
     # Test case for creating a room successfully
     # This test simulates a client creating a room and verifies that the room is created
@@ -51,33 +53,37 @@ class TestChatServer(unittest.TestCase):
 
         handle_tcp_connection(mock_socket, client_address)
 
-        expected_token = f"test_room-test_user-{client_address[0]}"
+        expected_token = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))["token"]
 
         # Check that the room was created successfully
-        self.assertIn("test_room", rooms)
+        self.assertIn("test_room", registry)
 
         # Check that the room has the expected host and members
-        self.assertEqual(rooms["test_room"]["host"], expected_token)
+        self.assertEqual(registry.get_room("test_room").host, expected_token)
 
         # Check that the room has the expected members
-        self.assertIn(expected_token, rooms["test_room"]["members"])
+        self.assertTrue(registry.is_member("test_room", expected_token))
 
-        # Check that the tokens dictionary has the expected token
-        self.assertIn(expected_token, tokens)
-        self.assertEqual(tokens[expected_token]["username"], "test_user")
-        self.assertEqual(tokens[expected_token]["ip"], client_address[0])
+        # Check that the registry has the expected token
+        member = registry.get_member(expected_token)
+        self.assertIsNotNone(member)
+        self.assertEqual(member.username, "test_user")
+        self.assertEqual(member.ip, client_address[0])
+
+        # The token is signed and carries the room and member ids
+        room = registry.get_room("test_room")
+        self.assertEqual(signer.verify(expected_token), (room.id, member.id))
 
         expected_response = {
             "status": "success",
             "token": expected_token
         }
 
-        mock_socket.send.assert_called_with(json.dumps(expected_response).encode('utf-8'))
+        mock_socket.sendall.assert_called_with(json.dumps(expected_response).encode('utf-8'))
 
     def test_create_room_already_exists(self):
-        test_token = "test_room-existing_user-127.0.0.1"
-        rooms["test_room"] = {"host": test_token, "members": [test_token]}
-        tokens[test_token] = {"username": "existing_user", "ip": "127.0.0.1"}
+        test_token = signer.issue(100, 5)
+        registry.create_room("test_room", test_token, "existing_user", "127.0.0.1")
 
         mock_socket = MagicMock()
         client_address = ('192.168.1.10', 54321)
@@ -97,15 +103,14 @@ class TestChatServer(unittest.TestCase):
             "message": "Room already exists."
         }
 
-        mock_socket.send.assert_called_with(json.dumps(expected_response).encode('utf-8'))
+        mock_socket.sendall.assert_called_with(json.dumps(expected_response).encode('utf-8'))
 
-        self.assertEqual(len(rooms["test_room"]["members"]), 1)
-        self.assertIn(test_token, rooms["test_room"]["members"])
+        self.assertEqual(len(registry.get_room("test_room").members), 1)
+        self.assertTrue(registry.is_member("test_room", test_token))
     
     def test_join_room_success(self):
-        host_token = "test_room-host_user-127.0.0.1"
-        rooms["test_room"] = {"host": host_token, "members": [host_token]}
-        tokens[host_token] = {"username": "host_user", "ip": "127.0.0.1"}
+        host_token = signer.issue(100, 1)
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
 
         mock_socket = MagicMock()
         client_address = ('192.168.1.20', 54321)
@@ -120,19 +125,73 @@ class TestChatServer(unittest.TestCase):
 
         handle_tcp_connection(mock_socket, client_address)
 
-        expected_token = f"test_room-new_user-{client_address[0]}"
+        expected_token = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))["token"]
 
-        self.assertIn(expected_token, rooms["test_room"]["members"])
+        self.assertTrue(registry.is_member("test_room", expected_token))
 
-        self.assertEqual(tokens[expected_token]["username"], "new_user")
-        self.assertEqual(tokens[expected_token]["ip"], client_address[0])
+        member = registry.get_member(expected_token)
+        self.assertEqual(member.username, "new_user")
+        self.assertEqual(member.ip, client_address[0])
+        self.assertEqual(signer.verify(expected_token), (registry.get_room("test_room").id, member.id))
 
         expected_response = {
             "status": "success",
-            "token": expected_token
+            "token": expected_token,
+            "history": []
         }
-        mock_socket.send.assert_called_with(json.dumps(expected_response).encode('utf-8'))
+        mock_socket.sendall.assert_called_with(json.dumps(expected_response).encode('utf-8'))
+
+    def test_join_room_receives_recent_history(self):
+        registry.create_room("test_room", "test_room-host_user-127.0.0.1", "host_user", "127.0.0.1")
+        history.append("test_room", "host_user", "first")
+        history.append("test_room", "host_user", b"second")
+
+        mock_socket = MagicMock()
+        request_data = {"operation": "join_room", "room_name": "test_room", "username": "new_user"}
+        mock_socket.recv.return_value = json.dumps(request_data).encode('utf-8')
+
+        handle_tcp_connection(mock_socket, ('192.168.1.20', 54321))
+
+        response = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))
+        self.assertEqual([(entry["sender"], entry["message"]) for entry in response["history"]],
+                         [("host_user", "first"), ("host_user", "second")])
     
+    def test_join_room_negotiates_compressed_history(self):
+        registry.create_room("test_room", "test_room-host_user-127.0.0.1", "host_user", "127.0.0.1")
+        for index in range(20):
+            history.append("test_room", "host_user", f"message number {index} for everyone in the room")
+
+        mock_socket = MagicMock()
+        request_data = {"operation": "join_room", "room_name": "test_room", "username": "new_user",
+                        "compression": compression.NAME}
+        mock_socket.recv.return_value = json.dumps(request_data).encode('utf-8')
+
+        handle_tcp_connection(mock_socket, ('192.168.1.20', 54321))
+
+        response = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))
+        self.assertEqual(response["compression"], compression.NAME)
+        self.assertNotIn("history", response)
+        self.assertEqual([entry["message"] for entry in compression.decompress_history(response["history_zlib"])],
+                         [f"message number {index} for everyone in the room" for index in range(20)])
+        self.assertTrue(registry.get_member(response["token"]).compressed)
+
+    def test_join_room_negotiates_binary_protocol(self):
+        registry.create_room("test_room", "test_room-host_user-127.0.0.1", "host_user", "127.0.0.1")
+
+        mock_socket = MagicMock()
+        request_data = {
+            "operation": "join_room",
+            "room_name": "test_room",
+            "username": "new_user",
+            "protocol": "binary"
+        }
+        mock_socket.recv.return_value = json.dumps(request_data).encode('utf-8')
+
+        handle_tcp_connection(mock_socket, ('192.168.1.20', 54321))
+
+        response = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))
+        self.assertEqual(response["protocol"], "binary")
+
     def test_join_room_not_found(self):
         mock_socket = MagicMock()
         client_address = ('192.168.1.20', 54321)
@@ -151,20 +210,22 @@ class TestChatServer(unittest.TestCase):
             "status": "error",
             "message": "Room not found."
         }
-        mock_socket.send.assert_called_with(json.dumps(expected_response).encode('utf-8'))
+        mock_socket.sendall.assert_called_with(json.dumps(expected_response).encode('utf-8'))
 
-        self.assertNotIn("non_existent_room", rooms)
+        self.assertNotIn("non_existent_room", registry)
         expected_token = f"non_existent_room-lost_user-{client_address[0]}"
-        self.assertNotIn(expected_token, tokens)
+        self.assertIsNone(registry.get_member(expected_token))
     
     def test_message_handling(self):
         # Set up a test room and two users in advance
-        host_token = "test_room-host_user-127.0.0.1"
-        client_token = "test_room-client_user-127.0.0.2"
+        host_token = signer.issue(100, 1)
+        client_token = signer.issue(100, 2)
 
-        rooms["test_room"] = {"host": host_token, "members": [host_token, client_token]}
-        tokens[host_token] = {"username": "host_user", "ip": "127.0.0.1"}
-        tokens[client_token] = {"username": "client_user", "ip": "127.0.0.2"}
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+        registry.join_room("test_room", client_token, "client_user", "127.0.0.2")
+        # The client has already registered its UDP endpoint; the host's is learned from this packet
+        client_address = ('127.0.0.2', 23456)
+        registry.update_endpoint(client_token, client_address)
 
         # Create a mock UDP socket
         mock_socket = MagicMock()
@@ -205,28 +266,60 @@ class TestChatServer(unittest.TestCase):
 
         # Check transmission to each member
         calls = mock_socket.sendto.call_args_list
-        for member_token, call in zip([host_token, client_token], calls):
-            member_ip = tokens[member_token]["ip"]
+        for member_address, call in zip([sender_address, client_address], calls):
             # Confirmation of sent data
             sent_data = json.loads(call[0][0].decode('utf-8'))
             self.assertEqual(sent_data, expected_response)
-            # Confirm destination address
-            self.assertEqual(call[0][1][0], member_ip)
-            self.assertEqual(call[0][1][1], UDP_PORT)
+            # Confirm destination address is the endpoint the member sends from
+            self.assertEqual(call[0][1], member_address)
+    
+    def test_message_skips_members_without_endpoint(self):
+        host_token = signer.issue(100, 1)
+        client_token = signer.issue(100, 2)
+
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+        registry.join_room("test_room", client_token, "client_user", "127.0.0.1")
+
+        mock_socket = MagicMock()
+        message_data = {
+            "operation": "message",
+            "token": host_token,
+            "room_name": "test_room",
+            "username": "host_user",
+            "message": "Hello?"
+        }
+        connect_data = {
+            "operation": "connect",
+            "token": client_token,
+            "room_name": "test_room",
+            "username": "client_user"
+        }
+
+        # The client has not registered yet, then registers from the same IP on another port
+        mock_socket.recvfrom.side_effect = [
+            (json.dumps(message_data).encode('utf-8'), ('127.0.0.1', 12345)),
+            (json.dumps(connect_data).encode('utf-8'), ('127.0.0.1', 23456)),
+            (json.dumps(message_data).encode('utf-8'), ('127.0.0.1', 12345)),
+            Exception("Stop loop")
+        ]
+
+        with patch('builtins.print'):
+            udp_handler(mock_socket)
+
+        destinations = [call[0][1] for call in mock_socket.sendto.call_args_list]
+        self.assertEqual(destinations, [('127.0.0.1', 12345), ('127.0.0.1', 12345), ('127.0.0.1', 23456)])
     
     def test_leave_room_regular_member(self):
         # Set up a test room and users in advance
-        host_token = "test_room-host_user-127.0.0.1"
-        member_token = "test_room-member_user-127.0.0.2"
-        other_token = "test_room-other_user-127.0.0.3"
+        host_token = signer.issue(100, 1)
+        member_token = signer.issue(100, 3)
+        other_token = signer.issue(100, 4)
 
-        rooms["test_room"] = {
-            "host": host_token,
-            "members": [host_token, member_token, other_token]
-        }
-        tokens[host_token] = {"username": "host_user", "ip": "127.0.0.1"}
-        tokens[member_token] = {"username": "member_user", "ip": "127.0.0.2"}
-        tokens[other_token] = {"username": "other_user", "ip": "127.0.0.3"}
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+        registry.join_room("test_room", member_token, "member_user", "127.0.0.2")
+        registry.join_room("test_room", other_token, "other_user", "127.0.0.3")
+        for token, ip in [(host_token, "127.0.0.1"), (member_token, "127.0.0.2"), (other_token, "127.0.0.3")]:
+            registry.update_endpoint(token, (ip, 12345))
 
         # Create a mock socket
         mock_socket = MagicMock()
@@ -255,13 +348,13 @@ class TestChatServer(unittest.TestCase):
                     raise
 
         # Check if the member was removed from the room
-        self.assertNotIn(member_token, rooms["test_room"]["members"])
+        self.assertFalse(registry.is_member("test_room", member_token))
         # Check if host is unchanged
-        self.assertEqual(rooms["test_room"]["host"], host_token)
+        self.assertEqual(registry.get_room("test_room").host, host_token)
         # Check if the room still exists
-        self.assertIn("test_room", rooms)
+        self.assertIn("test_room", registry)
         # Check if the other user is still in the room
-        self.assertIn(other_token, rooms["test_room"]["members"])
+        self.assertTrue(registry.is_member("test_room", other_token))
 
         # Check if the system message was sent to all members
         expected_system_message = {
@@ -273,17 +366,15 @@ class TestChatServer(unittest.TestCase):
 
     def test_leave_room_host(self):
         # Set up a test room and users in advance
-        host_token = "test_room-host_user-127.0.0.1"
-        member_token = "test_room-member_user-127.0.0.2"
-        other_token = "test_room-other_user-127.0.0.3"
+        host_token = signer.issue(100, 1)
+        member_token = signer.issue(100, 3)
+        other_token = signer.issue(100, 4)
 
-        rooms["test_room"] = {
-            "host": host_token,
-            "members": [host_token, member_token, other_token]
-        }
-        tokens[host_token] = {"username": "host_user", "ip": "127.0.0.1"}
-        tokens[member_token] = {"username": "member_user", "ip": "127.0.0.2"}
-        tokens[other_token] = {"username": "other_user", "ip": "127.0.0.3"}
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+        registry.join_room("test_room", member_token, "member_user", "127.0.0.2")
+        registry.join_room("test_room", other_token, "other_user", "127.0.0.3")
+        for token, ip in [(host_token, "127.0.0.1"), (member_token, "127.0.0.2"), (other_token, "127.0.0.3")]:
+            registry.update_endpoint(token, (ip, 12345))
 
         # Create a mock socket
         mock_socket = MagicMock()
@@ -312,7 +403,7 @@ class TestChatServer(unittest.TestCase):
                     raise
     
         # Check if the room was deleted
-        self.assertNotIn("test_room", rooms)
+        self.assertNotIn("test_room", registry)
 
         # Check if the system message was sent to all members
         expected_system_message = {
@@ -325,7 +416,7 @@ class TestChatServer(unittest.TestCase):
 
         # Check Destination
         calls = mock_socket.sendto.call_args_list
-        member_ips = [tokens[member_token]["ip"], tokens[other_token]["ip"]]
+        member_ips = ["127.0.0.2", "127.0.0.3"]
 
         for call in calls:
             sent_data = json.loads(call[0][0].decode('utf-8'))
@@ -338,3 +429,77 @@ class TestChatServer(unittest.TestCase):
             sent_ip = call[0][1][0]
             self.assertIn(sent_ip, member_ips)
 
+    def test_binary_message_reaches_both_formats(self):
+        host_token = signer.issue(100, 1)
+        client_token = signer.issue(100, 2)
+
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+        registry.join_room("test_room", client_token, "client_user", "127.0.0.2")
+        # The client still speaks JSON
+        registry.update_endpoint(client_token, ('127.0.0.2', 23456))
+
+        mock_socket = MagicMock()
+        packet = encode_request(OP_MESSAGE, "test_room", host_token, "Hello, everyone!".encode('utf-8'))
+        mock_socket.recvfrom.side_effect = [
+            (packet, ('127.0.0.1', 12345)),
+            Exception("Stop loop")
+        ]
+
+        with patch('builtins.print'):
+            udp_handler(mock_socket)
+
+        self.assertEqual(mock_socket.sendto.call_count, 2)
+        sent = {call[0][1]: call[0][0] for call in mock_socket.sendto.call_args_list}
+        expected_response = {
+            "status": "success",
+            "sender": "host_user",
+            "message": "Hello, everyone!"
+        }
+        self.assertEqual(json.loads(sent[('127.0.0.2', 23456)].decode('utf-8')), expected_response)
+        self.assertEqual(decode_delivery(sent[('127.0.0.1', 12345)]), expected_response)
+
+    def test_compact_message_is_routed_by_member_id(self):
+        mock_socket = MagicMock()
+        mock_socket.recv.return_value = json.dumps({"operation": "create_room", "room_name": "test_room",
+                                                    "username": "host_user", "protocol": "binary"}).encode('utf-8')
+        handle_tcp_connection(mock_socket, ('127.0.0.1', 40000))
+        response = json.loads(mock_socket.sendall.call_args[0][0].decode('utf-8'))
+        self.assertEqual(response["room_id"], registry.get_room("test_room").id)
+
+        packet = encode_compact(OP_MESSAGE, response["member_id"], token_tag(response["token"]), b"Hello!")
+        forged = encode_compact(OP_MESSAGE, response["member_id"], b"\x00" * 8, b"Forged!")
+        mock_socket = MagicMock()
+        mock_socket.recvfrom.side_effect = [
+            (packet, ('127.0.0.1', 12345)),
+            (forged, ('127.0.0.1', 12345)),
+            Exception("Stop loop")
+        ]
+        with patch('builtins.print'):
+            udp_handler(mock_socket)
+
+        mock_socket.sendto.assert_called_once()
+        self.assertEqual(decode_delivery(mock_socket.sendto.call_args[0][0]),
+                         {"status": "success", "sender": "host_user", "message": "Hello!"})
+        self.assertEqual(mock_socket.sendto.call_args[0][1], ('127.0.0.1', 12345))
+
+    def test_timed_out_host_closes_room(self):
+        host_token = signer.issue(100, 1)
+        client_token = signer.issue(100, 2)
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+        registry.join_room("test_room", client_token, "client_user", "127.0.0.2")
+        registry.update_endpoint(client_token, ('127.0.0.2', 23456))
+        # the host went silent, the client kept sending heartbeats
+        registry.get_member(host_token).last_seen -= 10
+        registry.set_idle_timeout(5)
+        try:
+            mock_socket = MagicMock()
+            with patch('time.monotonic', return_value=registry.get_member(client_token).last_seen + 2):
+                self.assertEqual(reap_idle_members(mock_socket), 1)
+        finally:
+            registry.set_idle_timeout(None)
+
+        self.assertNotIn("test_room", registry)
+        self.assertIsNone(registry.get_member(client_token))
+        notice = json.loads(mock_socket.sendto.call_args[0][0].decode('utf-8'))
+        self.assertEqual(notice["system_message"], "host_user has timed out.closing the room.")
+
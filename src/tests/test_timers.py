@@ -0,0 +1,58 @@
+"""
+Tests for the hierarchical timer wheel.
+Checks expiry on the right tick across levels, cancellation and rescheduling.
+"""
+
+import unittest
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from timers import TimerWheel
+
+class TestTimerWheel(unittest.TestCase):
+
+    def test_timers_expire_on_their_tick(self):
+        wheel = TimerWheel(tick=1.0, slots=4, levels=3)
+        wheel.schedule("soon", 2)
+        wheel.schedule("later", 9)
+        wheel.schedule("far", 40)
+
+        self.assertEqual(wheel.advance(1), [])
+        self.assertEqual(wheel.advance(2), ["soon"])
+        self.assertEqual(wheel.advance(8.5), [])
+        self.assertEqual(wheel.advance(9), ["later"])
+        self.assertEqual(wheel.advance(39), [])
+        self.assertEqual(wheel.advance(41), ["far"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_beyond_top_level_span(self):
+        # 4 slots x 2 levels span 16 ticks
+        wheel = TimerWheel(tick=1.0, slots=4, levels=2)
+        wheel.schedule("distant", 50)
+        self.assertEqual(wheel.advance(49), [])
+        self.assertEqual(wheel.advance(50), ["distant"])
+
+    def test_cancel_and_reschedule(self):
+        wheel = TimerWheel(tick=0.5)
+        wheel.schedule("a", 1)
+        wheel.schedule("b", 1)
+        wheel.cancel("a")
+        wheel.schedule("b", 3)
+
+        self.assertNotIn("a", wheel)
+        self.assertEqual(wheel.advance(2), [])
+        self.assertEqual(wheel.advance(3), ["b"])
+
+    def test_many_timers_expire_in_order(self):
+        wheel = TimerWheel(tick=1.0, slots=8, levels=3)
+        for index in range(300):
+            wheel.schedule(index, index + 1)
+        expired = []
+        for now in range(1, 302):
+            expired += wheel.advance(now)
+        self.assertEqual(expired, list(range(300)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+"""
+Tests for the signed member tokens.
+Round-trips tokens, rejects tampered, expired and foreign ones, checks that the registry
+takes its ids from the tokens and allocates none for refused requests, and that the UDP
+handler only lets a validly signed token claim an endpoint.
+"""
+
+import unittest
+import sys
+import os
+import json
+import shutil
+import tempfile
+from unittest.mock import MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from registry import RoomRegistry
+from server import process_tcp_request, process_udp_packet, registry, history
+from tokens import TokenSigner, load_key
+
+class TestTokenSigner(unittest.TestCase):
+
+    def test_round_trip(self):
+        token_signer = TokenSigner(ttl=60)
+        token = token_signer.issue(7, 42, now=1000)
+        self.assertLessEqual(len(token), 255)
+        self.assertEqual(token_signer.verify(token, now=1059), (7, 42))
+        self.assertEqual(token_signer.decode(token), (7, 42, 1060))
+
+    def test_rejected_tokens(self):
+        token_signer = TokenSigner(ttl=60)
+        token = token_signer.issue(7, 42, now=1000)
+        tampered = token[:4] + ("0" if token[4] != "0" else "1") + token[5:]
+        self.assertIsNone(token_signer.verify(tampered, now=1000))
+        self.assertIsNone(token_signer.verify(token, now=1061))
+        self.assertIsNone(TokenSigner().verify(token, now=1000))
+        self.assertIsNone(token_signer.verify("test_room-user-127.0.0.1"))
+        self.assertIsNone(token_signer.verify(None))
+
+    def test_key_file_is_reused(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "token.key")
+            self.assertEqual(load_key(path), load_key(path))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_registry_takes_ids_from_tokens(self):
+        token_signer = TokenSigner()
+        room_registry = RoomRegistry()
+        room_registry.decode_token = token_signer.decode
+        room_registry.create_room("room", token_signer.issue(5, 6), "host", "127.0.0.1")
+        self.assertEqual(room_registry.get_room("room").id, 5)
+        self.assertTrue(room_registry.join_room("room", token_signer.issue(5, 9), "guest", "127.0.0.1"))
+        # a token of another room with the same name is refused, fresh ids come after the used ones
+        self.assertFalse(room_registry.join_room("room", token_signer.issue(4, 10), "guest", "127.0.0.1"))
+        self.assertEqual((room_registry.allocate_room_id(), room_registry.allocate_member_id()), (6, 10))
+
+    def test_refused_requests_allocate_no_ids(self):
+        token_signer = TokenSigner()
+        room_registry = RoomRegistry()
+        room_registry.decode_token = token_signer.decode
+        room_registry.issue_token = token_signer.issue
+        host = room_registry.open_room("room", "host", "127.0.0.1")
+        self.assertEqual(token_signer.decode(host)[:2], (1, 1))
+        for _ in range(100):
+            self.assertIsNone(room_registry.open_room("room", "other", "127.0.0.1"))
+            self.assertIsNone(room_registry.admit("missing", "guest", "127.0.0.1"))
+        guest = room_registry.admit("room", "guest", "127.0.0.1")
+        self.assertEqual(token_signer.decode(guest)[:2], (1, 2))
+        self.assertEqual(room_registry.get_member(guest).id, 2)
+
+class TestSignedTokensInTheServer(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        history.clear()
+
+    def tearDown(self):
+        registry.clear()
+        history.clear()
+
+    def test_same_name_from_the_same_ip_gets_distinct_tokens(self):
+        address = ("127.0.0.1", 40000)
+        host = process_tcp_request({"operation": "create_room", "room_name": "room", "username": "alice"}, address)
+        guest = process_tcp_request({"operation": "join_room", "room_name": "room", "username": "alice"}, address)
+        self.assertNotEqual(host["token"], guest["token"])
+        self.assertEqual(len(registry.get_room("room").members), 2)
+
+    def test_only_valid_tokens_claim_an_endpoint(self):
+        # a member whose token was not signed by this server (e.g. an old predictable token)
+        registry.create_room("room", "room-alice-127.0.0.1", "alice", "127.0.0.1")
+        packet = json.dumps({"operation": "connect", "token": "room-alice-127.0.0.1", "room_name": "room"}).encode('utf-8')
+        self.assertEqual(process_udp_packet(MagicMock(), packet, ("127.0.0.1", 40000)), ("connect", "room", None))
+        self.assertIsNone(registry.get_member("room-alice-127.0.0.1").address)
+
+        created = process_tcp_request({"operation": "create_room", "room_name": "other", "username": "bob"}, ("127.0.0.1", 40001))
+        packet = json.dumps({"operation": "connect", "token": created["token"], "room_name": "other"}).encode('utf-8')
+        self.assertEqual(process_udp_packet(MagicMock(), packet, ("127.0.0.1", 40001)), ("connect", "other", 0))
+        self.assertEqual(registry.get_member(created["token"]).address, ("127.0.0.1", 40001))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Tests for the multi-process worker mode.
+Two Worker objects are wired together with real Unix socketpairs in one
+process; their UDP sockets are mocked like in test_server.py.
+"""
+
+import unittest
+import sys
+import os
+import json
+import socket
+from unittest.mock import patch, MagicMock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from workers import Worker, _hand_off, shard_of, peek_room_name
+from metrics import STATS
+from server import registry, signer
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        registry.clear()
+        self.pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(2)]
+        peers = [pair[1] for pair in self.pairs]
+        self.workers = [
+            Worker(index, 2, MagicMock(), self.pairs[index][0], peers, None)
+            for index in range(2)
+        ]
+
+    def tearDown(self):
+        registry.clear()
+        for pair in self.pairs:
+            for sock in pair:
+                sock.close()
+
+    def test_shard_is_stable(self):
+        self.assertEqual(shard_of("test_room", 4), shard_of("test_room", 4))
+        self.assertIn(shard_of("test_room", 4), range(4))
+
+    def test_peek_room_name(self):
+        self.assertEqual(peek_room_name(b'{"room_name": "test_room"}'), "test_room")
+
+    def test_datagram_forwarded_to_owner(self):
+        host_token = signer.issue(100, 1)
+        registry.create_room("test_room", host_token, "host_user", "127.0.0.1")
+        owner = self.workers[shard_of("test_room", 2)]
+        other = self.workers[1 - owner.index]
+
+        message_data = {
+            "operation": "message",
+            "token": host_token,
+            "room_name": "test_room",
+            "username": "host_user",
+            "message": "Hello, everyone!"
+        }
+        with patch('builtins.print'):
+            other.handle_datagram(json.dumps(message_data).encode('utf-8'), ('127.0.0.1', 12345))
+            other.udp_socket.sendto.assert_not_called()
+
+            owner.handle_forwarded(owner.forward_socket.recv(8192))
+
+        # The owner learned the client's real endpoint and answered from its own socket
+        owner.udp_socket.sendto.assert_called_once()
+        self.assertEqual(owner.udp_socket.sendto.call_args[0][1], ('127.0.0.1', 12345))
+
+    def test_full_forward_channel_drops_instead_of_blocking(self):
+        owner = shard_of("test_room", 2)
+        other = self.workers[1 - owner]
+        self.pairs[owner][1].setblocking(False)
+        datagram = json.dumps({"operation": "message", "room_name": "test_room", "token": "x" * 58}).encode('utf-8')
+        STATS.reset()
+        STATS.enabled = True
+        try:
+            # nobody reads the owner's channel, so it fills up
+            for _ in range(10000):
+                other.handle_datagram(datagram, ('127.0.0.1', 12345))
+            self.assertGreater(STATS.counters["forward_dropped"], 0)
+        finally:
+            STATS.enabled = False
+            STATS.reset()
+
+    def test_directory_requests_are_refused(self):
+        control_pairs = [(MagicMock(), MagicMock()) for _ in range(2)]
+        for operation in ("list_rooms", "search_rooms", "top_rooms"):
+            client_socket = MagicMock()
+            client_socket.recv.return_value = json.dumps({"operation": operation, "prefix": "r"}).encode('utf-8')
+            with patch("workers.socket.send_fds") as send_fds:
+                _hand_off(client_socket, ("127.0.0.1", 40000), 2, control_pairs)
+            send_fds.assert_not_called()
+            response = json.loads(client_socket.sendall.call_args[0][0].decode('utf-8'))
+            self.assertEqual(response["status"], "error")
+            client_socket.close.assert_called_once()
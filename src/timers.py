@@ -0,0 +1,106 @@
+"""
+Hierarchical timer wheel.
+
+Used to expire idle members without a timer (or thread) per token. Time is counted in
+ticks of `tick` seconds. Level 0 has one slot per tick; each higher level has slots
+`slots` times as wide, so a few levels of 64 slots cover months. A timer is put in the
+lowest level whose span reaches its expiry. When the current tick crosses the boundary of
+a higher-level slot, the timers of that slot are cascaded down to finer levels.
+
+schedule() and cancel() are O(1), and every timer is cascaded at most once per level, so
+expiring a timer costs O(1) amortized. Slots are dicts, so cancelling does not scan.
+
+The wheel itself is not locked; its owner serializes access.
+
+Classes:
+    TimerWheel: Timers keyed by any hashable, expired in batches by advance(now).
+"""
+
+import math
+
+class TimerWheel:
+
+    def __init__(self, tick=1.0, slots=64, levels=4, now=0.0):
+        if slots & (slots - 1):
+            raise ValueError("slots must be a power of two.")
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        # wheels[level][slot] is a dict key -> expiry tick
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        # key -> (level, slot)
+        self._positions = {}
+        self.current = int(now / tick)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def clear(self):
+        for wheel in self._wheels:
+            for slot in wheel:
+                slot.clear()
+        self._positions.clear()
+
+    def schedule(self, key, when):
+        # (Re)schedules key to expire at time `when`, in the same unit as advance(now).
+        self.cancel(key)
+        self._place(key, max(math.ceil(when / self.tick), self.current + 1))
+
+    def cancel(self, key):
+        position = self._positions.pop(key, None)
+        if position is not None:
+            level, slot = position
+            del self._wheels[level][slot][key]
+
+    def _place(self, key, expiry):
+        delta = expiry - self.current
+        level = 0
+        while level < self.levels - 1 and delta >= 1 << (self._bits * (level + 1)):
+            level += 1
+        # beyond the top level's span: park in its farthest slot, placed again on cascade
+        target = min(expiry, self.current + (1 << (self._bits * self.levels)) - 1)
+        slot = (target >> (self._bits * level)) & self._mask
+        self._wheels[level][slot][key] = expiry
+        self._positions[key] = (level, slot)
+
+    def _cascade(self):
+        # Moves the timers of every higher-level slot the current tick has just entered.
+        for level in range(1, self.levels):
+            shift = self._bits * level
+            if self.current & ((1 << shift) - 1):
+                break
+            slot = self._wheels[level][(self.current >> shift) & self._mask]
+            timers = list(slot.items())
+            slot.clear()
+            for key, expiry in timers:
+                del self._positions[key]
+                self._place(key, expiry)
+
+    def due(self, now):
+        # Whether advance(now) would move the wheel.
+        return int(now / self.tick) > self.current
+
+    def advance(self, now):
+        # Moves the wheel to time `now` and returns the keys of the timers that expired.
+        target = int(now / self.tick)
+        expired = []
+        while self.current < target:
+            if not self._positions:
+                # nothing to cascade or expire; jump straight to the target
+                self.current = target
+                break
+            self.current += 1
+            self._cascade()
+            slot = self._wheels[0][self.current & self._mask]
+            if slot:
+                for key, expiry in list(slot.items()):
+                    if expiry <= self.current:
+                        del slot[key]
+                        del self._positions[key]
+                        expired.append(key)
+        return expired
@@ -0,0 +1,102 @@
+"""
+Signed member tokens.
+
+Tokens used to be f"{room_name}-{username}-{ip}": anyone could compute the token of another
+member, and two users with the same name behind the same IP got the same token. A token is
+now a compact signed binary record, hex encoded so it fits in JSON strings and in the
+one-byte token length of the binary protocol (58 characters):
+
+    version (1 byte) | room id (4 bytes) | member id (4 bytes) | expiry (4 bytes, unix time)
+    | MAC (16 bytes, keyed BLAKE2b over the preceding fields)
+
+The ids are allocated by the RoomRegistry and are never reused, so every token is unique,
+and the registry reads them back from the token (RoomRegistry.decode_token) when it is
+restored from a snapshot, which keeps the persisted format unchanged.
+
+The UDP handler checks the MAC and expiry with verify() whenever a token claims a new
+endpoint; the datagrams that follow from that endpoint are matched against the issued token
+by the registry lookup, which is cheaper in Python than recomputing the MAC per datagram.
+
+The key is random per process, or stored in the state directory (load_key) so tokens stay
+valid across restarts.
+
+Classes:
+    TokenSigner: Issues and verifies tokens with one key.
+Functions:
+    load_key(path): Reads a key file, creating it on first use.
+Global Variables:
+    TOKEN_TTL (float): Default lifetime of a token in seconds.
+"""
+
+import hashlib
+import hmac
+import os
+import struct
+import time
+
+TOKEN_VERSION = 1
+TOKEN_TTL = 7 * 24 * 3600.0
+
+CLAIMS = struct.Struct("!BIII")
+MAC_SIZE = 16
+TOKEN_SIZE = CLAIMS.size + MAC_SIZE
+KEY_SIZE = 32
+
+def load_key(path):
+    # The key file is created with owner-only permissions.
+    try:
+        with open(path, "rb") as f:
+            key = f.read()
+        if len(key) == KEY_SIZE:
+            return key
+    except FileNotFoundError:
+        pass
+    key = os.urandom(KEY_SIZE)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+        f.flush()
+        os.fsync(f.fileno())
+    return key
+
+class TokenSigner:
+
+    def __init__(self, key=None, ttl=TOKEN_TTL):
+        self.key = key if key is not None else os.urandom(KEY_SIZE)
+        self.ttl = ttl
+
+    def _mac(self, claims):
+        return hashlib.blake2b(claims, key=self.key, digest_size=MAC_SIZE).digest()
+
+    def issue(self, room_id, member_id, now=None):
+        now = time.time() if now is None else now
+        claims = CLAIMS.pack(TOKEN_VERSION, room_id, member_id, int(now + self.ttl))
+        return (claims + self._mac(claims)).hex()
+
+    def decode(self, token):
+        # Returns (room_id, member_id, expires) without checking the MAC, or None.
+        try:
+            raw = bytes.fromhex(token)
+        except (TypeError, ValueError):
+            return None
+        if len(raw) != TOKEN_SIZE or raw[0] != TOKEN_VERSION:
+            return None
+        _, room_id, member_id, expires = CLAIMS.unpack_from(raw)
+        return room_id, member_id, expires
+
+    def verify(self, token, now=None):
+        # Returns (room_id, member_id) if the token was issued with this key and has not
+        # expired, else None.
+        try:
+            raw = bytes.fromhex(token)
+        except (TypeError, ValueError):
+            return None
+        if len(raw) != TOKEN_SIZE or raw[0] != TOKEN_VERSION:
+            return None
+        claims = raw[:CLAIMS.size]
+        if not hmac.compare_digest(self._mac(claims), raw[CLAIMS.size:]):
+            return None
+        _, room_id, member_id, expires = CLAIMS.unpack(claims)
+        if expires < (time.time() if now is None else now):
+            return None
+        return room_id, member_id
@@ -0,0 +1,257 @@
+"""
+Multi-process UDP ingestion for the chat server (Linux, SO_REUSEPORT).
+
+`python server.py --workers N` forks N worker processes. Every worker binds UDP_PORT with
+SO_REUSEPORT, so the kernel spreads incoming datagrams over all of them, and owns the rooms
+whose name hashes to its index (shard_of). Each worker keeps its own server.registry with
+only its shard of the rooms.
+
+A datagram that lands on a worker which does not own its room is forwarded to the owner
+over a Unix datagram socketpair, prefixed with the client's address. The owner handles it
+exactly like a datagram it received itself and sends the fan-out from its own socket,
+which is bound to the same UDP_PORT, so clients always see replies from the server port.
+The forward channels are non-blocking: a worker whose owner's queue is full drops the
+datagram (counted as forward_dropped), as the kernel would on a full UDP socket, instead
+of blocking while that owner may itself be blocked forwarding to it.
+
+The parent process keeps accepting TCP connections. It reads the request, picks the worker
+owning the requested room and passes the request together with the connected socket
+(SCM_RIGHTS) to that worker, which answers the client directly. Only one-shot requests
+are handed off; persistent control sessions (control.py) need the single-process engines.
+Every worker's room directory holds only its shard, so list_rooms, search_rooms and
+top_rooms are answered with an error (DIRECTORY_OPERATIONS) rather than with one shard.
+
+With a state directory, worker i persists its shard in DIR/worker-i (see persistence.py).
+Shards follow the worker count, so restart with the same --workers to find the rooms again.
+
+Classes:
+    Worker: One worker process: its UDP socket, forward channel and control channel.
+Functions:
+    shard_of(room_name, num_workers): Index of the worker owning a room.
+    peek_room_name(data): Room name of a JSON or binary datagram.
+    run_workers(num_workers, host, tcp_port, udp_port, stats_port, stats_interval, state_dir,
+                snapshot_interval): Forks the workers and serves TCP. Worker i serves its metrics
+        on stats_port + 1 + i and persists its rooms in state_dir/worker-i.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import zlib
+
+import control
+import metrics
+import protocol
+import server
+
+log = logging.getLogger("chat.workers")
+
+# client address prepended to forwarded datagrams: IPv4 address and port
+FORWARD_HEADER = struct.Struct("!4sH")
+# operations that read the whole room directory, which no single worker has
+DIRECTORY_OPERATIONS = ("list_rooms", "search_rooms", "top_rooms")
+
+def shard_of(room_name, num_workers):
+    # crc32 is stable across processes, unlike hash() with hash randomization
+    return zlib.crc32(room_name.encode('utf-8')) % num_workers
+
+def peek_room_name(data):
+    if protocol.is_compact(data) or protocol.is_reliable(data) or protocol.is_ack(data) \
+            or protocol.is_fragment(data):
+        # not offered in this mode (see server.COMPACT_DATAGRAMS, server.RELIABLE_DELIVERY and
+        # server.FRAGMENTATION); handled and rejected locally
+        return None
+    if protocol.is_binary(data):
+        return protocol.decode_request(data)[1]
+    return json.loads(data.decode('utf-8')).get("room_name")
+
+class Worker:
+
+    def __init__(self, index, num_workers, udp_socket, forward_socket, peers, control_socket, parent_pid=None):
+        self.index = index
+        self.num_workers = num_workers
+        self.udp_socket = udp_socket
+        # receiving end of this worker's forward channel
+        self.forward_socket = forward_socket
+        # sending ends of every worker's forward channel, by index
+        self.peers = peers
+        # receiving end of the TCP hand-off channel from the parent
+        self.control_socket = control_socket
+        # the worker exits when this process goes away
+        self.parent_pid = parent_pid
+
+    def handle_datagram(self, data, address):
+        # Handles a datagram from a client, forwarding it if another worker owns the room.
+        room_name = peek_room_name(data)
+        owner = shard_of(room_name, self.num_workers) if isinstance(room_name, str) else self.index
+        if owner == self.index:
+            server.handle_udp_packet(self.udp_socket, data, address)
+        else:
+            header = FORWARD_HEADER.pack(socket.inet_aton(address[0]), address[1])
+            try:
+                self.peers[owner].send(header + data)
+            except BlockingIOError:
+                if metrics.STATS.enabled:
+                    metrics.STATS.inc("forward_dropped")
+
+    def handle_forwarded(self, packet):
+        ip, port = FORWARD_HEADER.unpack_from(packet)
+        server.handle_udp_packet(self.udp_socket, packet[FORWARD_HEADER.size:], (socket.inet_ntoa(ip), port))
+
+    def handle_control(self):
+        # Receives a TCP request and its client socket from the parent and answers it.
+        message, fds, _, _ = socket.recv_fds(self.control_socket, server.BUFFER_SIZE * 2, 1)
+        if not fds:
+            return
+        client_socket = socket.socket(fileno=fds[0])
+        try:
+            handoff = json.loads(message.decode('utf-8'))
+            request, address = handoff["request"], tuple(handoff["address"])
+            kdf = server.password_future(request, address)
+        except Exception as e:
+            log.warning("Error handling TCP connection: %s", e)
+            client_socket.close()
+            return
+        if kdf is None:
+            self.answer(client_socket, request, address)
+        else:
+            # scrypt would stall this worker's datagrams; answer once the hasher pool is done
+            kdf.add_done_callback(lambda done: self.answer(client_socket, request, address, done))
+
+    def answer(self, client_socket, request, address, kdf=None):
+        try:
+            response = server.process_tcp_request(request, address, kdf=kdf)
+            client_socket.sendall(json.dumps(response).encode('utf-8'))
+        except Exception as e:
+            log.warning("Error handling TCP connection: %s", e)
+        finally:
+            client_socket.close()
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.udp_socket, selectors.EVENT_READ, "udp")
+        selector.register(self.forward_socket, selectors.EVENT_READ, "forward")
+        selector.register(self.control_socket, selectors.EVENT_READ, "control")
+        log.info("Worker %d (pid %d) is serving UDP", self.index, os.getpid())
+
+        while self.parent_pid is None or os.getppid() == self.parent_pid:
+            for key, _ in selector.select(timeout=1.0):
+                try:
+                    if key.data == "udp":
+                        data, address = self.udp_socket.recvfrom(server.BUFFER_SIZE)
+                        self.handle_datagram(data, address)
+                    elif key.data == "forward":
+                        self.handle_forwarded(self.forward_socket.recv(server.BUFFER_SIZE + FORWARD_HEADER.size))
+                    else:
+                        self.handle_control()
+                except Exception as e:
+                    log.warning("Error handling UDP handler: %s", e)
+            # the select timeout makes this run at least once a second
+            try:
+                server.reap_idle_members(self.udp_socket)
+            except Exception as e:
+                log.warning("Error reaping idle members: %s", e)
+
+def _bind_udp(host, udp_port):
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.tune_udp_socket(udp_socket)
+    udp_socket.bind((host, udp_port))
+    return udp_socket
+
+def _worker_main(index, num_workers, host, udp_port, forward_pairs, control_pairs, parent_pid,
+                 stats_port, stats_interval, state_dir, snapshot_interval):
+    if state_dir:
+        server.open_state_store(os.path.join(state_dir, f"worker-{index}"), snapshot_interval)
+    if stats_port or stats_interval:
+        # worker i serves its metrics on stats_port + 1 + i; stats_port is left to the parent
+        metrics.start_reporting(stats_port + 1 + index if stats_port else None, stats_interval)
+    udp_socket = _bind_udp(host, udp_port)
+    server.udp_transport = udp_socket
+    # datagrams are sharded by room name, which compact datagrams do not carry
+    server.COMPACT_DATAGRAMS = False
+    # a member's delivery windows live in the worker that handled its join
+    server.RELIABLE_DELIVERY = False
+    # fragments do not carry the room name
+    server.FRAGMENTATION = False
+    peers = [pair[1] for pair in forward_pairs]
+    for peer in peers:
+        # two workers forwarding to each other must never both wait for room in the other's queue
+        peer.setblocking(False)
+    try:
+        Worker(index, num_workers, udp_socket, forward_pairs[index][0], peers, control_pairs[index][0], parent_pid).run()
+    finally:
+        # forked workers leave through os._exit, which skips atexit
+        if server.state_store is not None:
+            server.state_store.close()
+
+def _hand_off(client_socket, address, num_workers, control_pairs):
+    # Reads a TCP request and passes it with the client socket to the worker owning the room.
+    try:
+        data = client_socket.recv(server.BUFFER_SIZE)
+        if not control.is_legacy_request(data):
+            # the rooms of one session may live on different workers
+            log.warning("Control sessions are not supported with --workers; closing %s", address)
+            return
+        request = control.read_legacy_request(client_socket, data, server.BUFFER_SIZE)
+        if request.get("operation") in DIRECTORY_OPERATIONS:
+            # every worker only knows its own shard of the rooms
+            client_socket.sendall(json.dumps({"status": "error",
+                                              "message": "Room listing is not supported with --workers."}).encode('utf-8'))
+            return
+        room_name = request.get("room_name")
+        owner = shard_of(room_name, num_workers) if isinstance(room_name, str) else 0
+        handoff = json.dumps({"request": request, "address": list(address)}).encode('utf-8')
+        socket.send_fds(control_pairs[owner][1], [handoff], [client_socket.fileno()])
+    except Exception as e:
+        log.warning("Error handling TCP connection: %s", e)
+    finally:
+        # the worker holds its own copy of the descriptor
+        client_socket.close()
+
+def run_workers(num_workers, host="0.0.0.0", tcp_port=server.TCP_PORT, udp_port=server.UDP_PORT,
+                stats_port=0, stats_interval=0, state_dir=None, snapshot_interval=60.0):
+    if not hasattr(socket, "SO_REUSEPORT") or not hasattr(socket, "send_fds"):
+        raise RuntimeError("--workers needs SO_REUSEPORT and SCM_RIGHTS support (Linux, Python 3.9+).")
+
+    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp_socket.bind((host, tcp_port))
+    tcp_socket.listen(server.TCP_BACKLOG)
+
+    forward_pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(num_workers)]
+    control_pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(num_workers)]
+
+    # fork keeps the socketpairs and gives every worker an empty registry
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for index in range(num_workers):
+        process = context.Process(
+            target=_worker_main,
+            args=(index, num_workers, host, udp_port, forward_pairs, control_pairs, os.getpid(),
+                  stats_port, stats_interval, state_dir, snapshot_interval),
+            daemon=True
+        )
+        process.start()
+        processes.append(process)
+
+    if stats_port or stats_interval:
+        metrics.start_reporting(stats_port, stats_interval)
+    # make SIGTERM run the cleanup below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log.info("Server is running on TCP:%d and UDP:%d with %d workers", tcp_port, udp_port, num_workers)
+
+    try:
+        while True:
+            client_socket, address = tcp_socket.accept()
+            threading.Thread(target=_hand_off, args=(client_socket, address, num_workers, control_pairs), daemon=True).start()
+    finally:
+        for process in processes:
+            process.terminate()